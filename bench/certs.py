@@ -0,0 +1,35 @@
+import os
+import base64
+import datetime
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+COMMON_NAME = x509.NameOID.COMMON_NAME
+
+
+def generate_client_certificate(directory, name):
+    # self-signed client certificate, fingerprinted the same way jetforce
+    # fills in TLS_CLIENT_HASH_B64
+    key = ec.generate_private_key(ec.SECP256R1())
+    subject = x509.Name([x509.NameAttribute(COMMON_NAME, name)])
+    now = datetime.datetime.utcnow()
+    cert = (x509.CertificateBuilder()
+            .subject_name(subject)
+            .issuer_name(subject)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=30))
+            .sign(key, hashes.SHA256()))
+
+    certfile = os.path.join(directory, f'{name}.crt')
+    keyfile = os.path.join(directory, f'{name}.key')
+    with open(certfile, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(keyfile, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                  serialization.NoEncryption()))
+
+    fingerprint = base64.urlsafe_b64encode(cert.fingerprint(hashes.SHA256())).decode()
+    return certfile, keyfile, fingerprint
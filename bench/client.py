@@ -0,0 +1,55 @@
+import ssl
+import time
+import socket
+import threading
+
+BUFFER_SIZE = 1024 * 64
+
+
+class GeminiClient:
+    # Minimal Gemini client for load testing. TLS contexts are built once
+    # per client certificate and shared between threads.
+    def __init__(self, host, port, hostname='localhost', timeout=60):
+        self.host = host
+        self.port = port
+        self.hostname = hostname
+        self.timeout = timeout
+        self.contexts = {}
+        self.lock = threading.Lock()
+
+    def context(self, cert):
+        with self.lock:
+            context = self.contexts.get(cert)
+            if context is None:
+                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+                if cert is not None:
+                    context.load_cert_chain(*cert)
+                context = self.contexts[cert] = context
+            return context
+
+    def request(self, path, cert=None):
+        # returns (status, meta, body size, seconds until the body was read)
+        started = time.perf_counter()
+        with socket.create_connection((self.host, self.port), timeout=self.timeout) as sock:
+            with self.context(cert).wrap_socket(sock, server_hostname=self.hostname) as conn:
+                conn.sendall(f'gemini://{self.hostname}{path}\r\n'.encode())
+                header = b''
+                size = 0
+                reading_header = True
+                while True:
+                    data = conn.recv(BUFFER_SIZE)
+                    if not data:
+                        break
+                    if reading_header:
+                        header += data
+                        if b'\r\n' in header:
+                            header, _, rest = header.partition(b'\r\n')
+                            size += len(rest)
+                            reading_header = False
+                    else:
+                        size += len(data)
+        elapsed = time.perf_counter() - started
+        status, _, meta = header.decode(errors='replace').partition(' ')
+        return int(status or 0), meta, size, elapsed
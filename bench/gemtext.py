@@ -0,0 +1,48 @@
+import sys
+import time
+import argparse
+import tracemalloc
+from rocketcaster.gemtext import html_to_gemtext
+from .stub import StubUpstream
+
+# Throughput and peak memory of the show notes converter. Pass real
+# description files to measure those instead of the synthetic ones:
+#
+#     python -m bench.gemtext notes1.html notes2.html
+
+
+def measure(name, html, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        html_to_gemtext(html)
+    seconds = (time.perf_counter() - started) / repeat
+
+    tracemalloc.start()
+    html_to_gemtext(html)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    size = len(html.encode())
+    print(f'{name:<28} {size / 1024:9.1f} {seconds * 1000:9.2f} {size / seconds / 1024 / 1024:9.1f} '
+          f'{peak / 1024:10.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the HTML to gemtext converter.')
+    parser.add_argument('files', nargs='*', help='HTML files to convert')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f'{"input":<28} {"KB":>9} {"ms":>9} {"MB/s":>9} {"peak KB":>10}')
+    if args.files:
+        for path in args.files:
+            with open(path, encoding='utf-8', errors='replace') as f:
+                measure(path[-28:], f.read(), args.repeat)
+    else:
+        for size in (1024 * 4, 1024 * 64, 1024 * 512):
+            measure(f'synthetic {size // 1024}KB', StubUpstream.show_notes(size), args.repeat)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,344 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict
+from urllib.parse import quote
+from .certs import generate_client_certificate
+from .client import GeminiClient
+from .seed import seed
+from .stub import StubUpstream, FEEDS, EPISODES_PER_FEED
+
+# Load test for RocketCaster: seeds a database, starts the real server
+# against a stub podcastindex and enclosure host, then drives it with
+# concurrent TLS clients. Run from the repository root:
+#
+#     python -m bench.run --save before
+#     ...change something...
+#     python -m bench.run --compare before
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(ROOT, 'bench', 'baselines')
+
+# relative weight of each route in the mixed phase
+MIX = {
+    'front': 25,
+    'front_auth': 15,
+    'post': 20,
+    'archive': 10,
+    'search': 10,
+    'share': 3,
+    'comment': 7,
+    'play': 5,
+}
+PLAYED_EPISODES = 20  # plays pick from a small set, like a popular new release
+
+
+class Traffic:
+    def __init__(self, post_ids, certs, rng):
+        self.post_ids = post_ids
+        self.certs = certs
+        self.rng = rng
+
+    def episode_id(self):
+        return self.rng.randint(1, FEEDS) * 1000 + self.rng.randrange(EPISODES_PER_FEED)
+
+    def route(self, name):
+        # returns the path and client certificate for one request
+        rng = self.rng
+        cert = rng.choice(self.certs)
+        if name == 'front':
+            return '/', None
+        if name == 'front_auth':
+            return '/', cert
+        if name == 'post':
+            return f'/post/{rng.choice(self.post_ids)}', None
+        if name == 'archive':
+            return '/archive', None
+        if name == 'search':
+            return '/search?' + quote(f'podcast {rng.randint(1, FEEDS)}'), None
+        if name == 'share':
+            return f'/share/{self.episode_id()}?' + quote('Benchmark post about this episode'), cert
+        if name == 'comment':
+            return f'/comment/{rng.choice(self.post_ids)}?' + quote('Benchmark comment'), cert
+        if name == 'play':
+            episode_id = 1000 + rng.randrange(PLAYED_EPISODES)
+            return f'/episode/{episode_id}/play', None
+        raise ValueError(name)
+
+
+class RSSMonitor:
+    # samples the server's resident set size, with its worker processes if
+    # it has any, so each phase can report its peak
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.running = True
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def rss(self):
+        try:
+            with open(f'/proc/{self.pid}/task/{self.pid}/children') as f:
+                pids = [self.pid] + [int(pid) for pid in f.read().split()]
+        except OSError:
+            pids = [self.pid]
+        return sum(self.process_rss(pid) for pid in pids)
+
+    @staticmethod
+    def process_rss(pid):
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, self.rss())
+            time.sleep(self.interval)
+
+    def reset(self):
+        self.peak = self.rss()
+
+    def stop(self):
+        self.running = False
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def summarize(samples, seconds):
+    latencies = [sample['seconds'] for sample in samples if sample['error'] is None]
+    statuses = defaultdict(int)
+    for sample in samples:
+        statuses[str(sample['status'])] += 1
+    return {
+        'requests': len(samples),
+        'rps': len(samples) / seconds if seconds else 0,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'errors': sum(1 for sample in samples if sample['error'] is not None),
+        'statuses': dict(statuses),
+        'bytes': sum(sample['size'] for sample in samples),
+    }
+
+
+def drive(client, traffic, routes, weights, concurrency, seconds):
+    # concurrency client threads send requests back to back until the time is up
+    samples = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker(seed):
+        rng = random.Random(seed)
+        local = []
+        while time.perf_counter() < deadline:
+            name = rng.choices(routes, weights)[0]
+            with lock:
+                path, cert = traffic.route(name)
+            try:
+                status, _, size, elapsed = client.request(path, cert)
+                local.append({'route': name, 'status': status, 'size': size, 'seconds': elapsed, 'error': None})
+            except OSError as e:
+                local.append({'route': name, 'status': 0, 'size': 0, 'seconds': 0, 'error': str(e)})
+        with lock:
+            samples.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - started
+
+
+def start_server(args, db_path, upstream, workdir):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    command = [sys.executable, '-m', 'bench.server', '--port', str(port), '--db', db_path,
+               '--upstream', upstream.url, '--threads', str(args.threads), '--queue', str(args.queue),
+               '--metrics-file', os.path.join(workdir, 'metrics.prom')]
+    if not args.no_episode_cache:
+        command += ['--episode-cache', os.path.join(workdir, 'episode_cache')]
+    if args.rate_limits:
+        command.append('--rate-limits')
+    if args.workers > 1:
+        run_dir = os.path.join(workdir, 'run')
+        os.makedirs(run_dir)
+        command += ['--workers', str(args.workers), '--run-dir', run_dir]
+    env = dict(os.environ, TMPDIR=workdir)
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=log, text=True)
+    for line in process.stdout:
+        if line.startswith('ready'):
+            break
+    else:
+        raise RuntimeError(f'server exited early, see {log.name}')
+    threading.Thread(target=process.stdout.read, daemon=True).start()
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('server did not start listening')
+
+
+def print_table(title, rows):
+    print(f'\n{title}')
+    print(f'{"route":<12} {"reqs":>7} {"rps":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"errors":>7} {"peak MB":>8}  statuses')
+    for name, row in rows.items():
+        def ms(value):
+            return f'{value * 1000:8.1f}' if value is not None else '       -'
+        rss = f'{row["peak_rss"] / 1024 / 1024:8.1f}' if row.get('peak_rss') else '       -'
+        statuses = ' '.join(f'{status}:{count}' for status, count in sorted(row['statuses'].items()))
+        print(f'{name:<12} {row["requests"]:>7} {row["rps"]:8.1f} {ms(row["p50"])} {ms(row["p95"])} {ms(row["p99"])} '
+              f'{row["errors"]:>7} {rss}  {statuses}')
+
+
+def compare(results, baseline, tolerance):
+    # latency may grow and throughput may drop by tolerance before a
+    # route counts as a regression
+    regressions = []
+    print(f'\nCompared with baseline {baseline["name"]} (tolerance {tolerance:.0%})')
+    for phase in ('routes', 'mixed'):
+        for name, row in results[phase].items():
+            old = baseline.get(phase, {}).get(name)
+            if old is None:
+                continue
+            changes = []
+            for metric in ('p50', 'p95', 'p99', 'rps'):
+                if not old.get(metric) or row.get(metric) is None:
+                    continue
+                change = row[metric] / old[metric] - 1
+                worse = change < -tolerance if metric == 'rps' else change > tolerance
+                changes.append(f'{metric} {change:+.0%}{" !" if worse else ""}')
+                if worse:
+                    regressions.append(f'{phase}/{name} {metric}')
+            print(f'{phase + "/" + name:<20} ' + ', '.join(changes))
+    if regressions:
+        print('\nRegressions: ' + ', '.join(regressions))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test RocketCaster against stub upstream servers.')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent TLS clients')
+    parser.add_argument('--seconds', type=float, default=20, help='length of the mixed traffic phase')
+    parser.add_argument('--route-seconds', type=float, default=5,
+                        help='length of each single route phase, 0 to skip them')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds of mixed traffic before measuring')
+    parser.add_argument('--routes', type=str, default=','.join(MIX), help='comma separated routes to include')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--posts', type=int, default=2000)
+    parser.add_argument('--comments', type=int, default=10000)
+    parser.add_argument('--notifications', type=int, default=5000)
+    parser.add_argument('--certs', type=int, default=20, help='client certificates registered as users')
+    parser.add_argument('--upstream-latency', type=float, default=50, help='podcastindex stub latency in ms')
+    parser.add_argument('--enclosure-latency', type=float, default=50, help='enclosure host latency in ms')
+    parser.add_argument('--enclosure-size', type=int, default=1024, help='episode file size in KB')
+    parser.add_argument('--description-size', type=int, default=4096, help='episode show notes size in bytes')
+    parser.add_argument('--threads', type=int, default=8, help='server worker threads')
+    parser.add_argument('--queue', type=int, default=64, help='server worker queue')
+    parser.add_argument('--workers', type=int, default=1, help='server processes, each with --threads threads')
+    parser.add_argument('--no-episode-cache', action='store_true', help='proxy plays without the disk cache')
+    parser.add_argument('--rate-limits', action='store_true', help='keep the play and search limits')
+    parser.add_argument('--save', type=str, help='save the results as this baseline')
+    parser.add_argument('--compare', type=str, help='compare with this saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='allowed relative change before a regression')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory with the database, logs and server metrics')
+    args = parser.parse_args()
+
+    routes = [route for route in args.routes.split(',') if route]
+    weights = [MIX[route] for route in routes]
+    workdir = tempfile.mkdtemp(prefix='rocketcaster-bench-')
+    rng = random.Random(1965)
+
+    print(f'Working in {workdir}')
+    certs = []
+    for i in range(args.certs):
+        certfile, keyfile, fingerprint = generate_client_certificate(workdir, f'user{i}')
+        certs.append(((certfile, keyfile), fingerprint))
+    db_path = os.path.join(workdir, 'db.sqlite')
+    started = time.perf_counter()
+    post_ids = seed(db_path, [fingerprint for _, fingerprint in certs], users=args.users, posts=args.posts,
+                    comments=args.comments, notifications=args.notifications, rng=rng)
+    print(f'Seeded {args.users} users, {args.posts} posts, {args.comments} comments, '
+          f'{args.notifications} notifications in {time.perf_counter() - started:.1f}s')
+
+    upstream = StubUpstream(latency=args.upstream_latency / 1000, enclosure_latency=args.enclosure_latency / 1000,
+                            enclosure_size=args.enclosure_size * 1024,
+                            description_size=args.description_size).start()
+    process, port = start_server(args, db_path, upstream, workdir)
+    monitor = RSSMonitor(process.pid)
+    client = GeminiClient('127.0.0.1', port)
+    traffic = Traffic(post_ids, [cert for cert, _ in certs], rng)
+
+    results = {'routes': {}, 'mixed': {}}
+    try:
+        if args.warmup:
+            drive(client, traffic, routes, weights, args.concurrency, args.warmup)
+
+        if args.route_seconds:
+            for route in routes:
+                monitor.reset()
+                samples, seconds = drive(client, traffic, [route], [1], args.concurrency, args.route_seconds)
+                results['routes'][route] = dict(summarize(samples, seconds), peak_rss=monitor.peak)
+            print_table(f'Single route, {args.concurrency} clients, {args.route_seconds:g}s each', results['routes'])
+
+        monitor.reset()
+        samples, seconds = drive(client, traffic, routes, weights, args.concurrency, args.seconds)
+        for route in routes:
+            route_samples = [sample for sample in samples if sample['route'] == route]
+            results['mixed'][route] = summarize(route_samples, seconds)
+        results['mixed']['all'] = dict(summarize(samples, seconds), peak_rss=monitor.peak)
+        print_table(f'Mixed traffic, {args.concurrency} clients, {args.seconds:g}s', results['mixed'])
+        print(f'\nUpstream requests: {upstream.requests}')
+    finally:
+        monitor.stop()
+        process.terminate()
+        process.wait(timeout=10)
+        upstream.stop()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results['config'] = {key: value for key, value in vars(args).items() if key not in ('save', 'compare', 'keep')}
+    results['created'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    regressions = []
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f'{args.compare}.json')) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        results['name'] = args.save
+        path = os.path.join(BASELINE_DIR, f'{args.save}.json')
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Saved baseline to {path}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
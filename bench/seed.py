@@ -0,0 +1,58 @@
+import random
+from datetime import datetime, timedelta
+from peewee import chunked
+from rocketcaster.models import init_db, build_search_index, User, Certificate, Post, Comment, Notification
+from .stub import FEEDS, EPISODES_PER_FEED
+
+
+def seed(db_path, fingerprints, users=200, posts=2000, comments=10000, notifications=5000, rng=None):
+    # a synthetic community: the first len(fingerprints) users can log in
+    # with the benchmark's client certificates
+    rng = rng or random.Random(1965)
+    init_db(db_path)
+    db = User._meta.database
+    now = datetime.now()
+
+    with db.atomic():
+        user_rows = [{'name': f'user{i}', 'name_lower': f'user{i}', 'created': now - timedelta(days=365)}
+                     for i in range(max(users, len(fingerprints)))]
+        for batch in chunked(user_rows, 100):
+            User.insert_many(batch).execute()
+        user_ids = [user.id for user in User.select(User.id).order_by(User.id)]
+
+        cert_rows = [{'user': user_id, 'fingerprint': fingerprint, 'subject': f'CN=user{i}'}
+                     for i, (user_id, fingerprint) in enumerate(zip(user_ids, fingerprints))]
+        for batch in chunked(cert_rows, 100):
+            Certificate.insert_many(batch).execute()
+
+        post_rows = []
+        for i in range(posts):
+            feed_id = rng.randint(1, FEEDS)
+            episode_id = feed_id * 1000 + rng.randrange(EPISODES_PER_FEED)
+            content = f'Thoughts on this one, @user{rng.randrange(users)} you should listen ' * rng.randint(1, 4)
+            post_rows.append({
+                'author': rng.choice(user_ids), 'episode_id': str(episode_id),
+                'episode_title': f'Episode {episode_id % 1000} of podcast {feed_id}',
+                'podcast_id': str(feed_id), 'podcast_title': f'Podcast {feed_id}', 'content': content,
+                'created': now - timedelta(minutes=posts - i), **Post.formatting(content),
+            })
+        for batch in chunked(post_rows, 100):
+            Post.insert_many(batch).execute()
+        post_ids = [post.id for post in Post.select(Post.id)]
+
+        comment_rows = []
+        for i in range(comments):
+            content = f'Comment number {i}, great episode'
+            comment_rows.append({'author': rng.choice(user_ids), 'post': rng.choice(post_ids), 'content': content,
+                                 'created': now - timedelta(seconds=comments - i), **Comment.formatting(content)})
+        for batch in chunked(comment_rows, 100):
+            Comment.insert_many(batch).execute()
+
+        notification_rows = [{'user': rng.choice(user_ids), 'post': rng.choice(post_ids),
+                              'message': 'Someone mentioned you in a post', 'created': now}
+                             for _ in range(notifications)]
+        Notification.add(notification_rows)
+
+    build_search_index(db)
+    db.close()
+    return post_ids
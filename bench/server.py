@@ -0,0 +1,78 @@
+import os
+import sys
+import argparse
+from rocketcaster import app, mirror, init_db, init_episode_cache, init_processes, precompile_templates
+from rocketcaster import views
+from rocketcaster.processes import Server, Health, Supervisor
+from rocketcaster.transport import PodcastIndexClient
+from rocketcaster.limits import RequestLimiter, StreamLimiter
+from rocketcaster.metrics import metrics
+from twisted.internet.task import LoopingCall
+
+# Runs the real application the way main.py does, except that podcastindex
+# requests go to the benchmark's stub upstream. Started by bench/run.py.
+parser = argparse.ArgumentParser()
+parser.add_argument('--port', type=int, required=True)
+parser.add_argument('--db', type=str, required=True)
+parser.add_argument('--upstream', type=str, required=True, help='base url of the stub podcastindex api')
+parser.add_argument('--episode-cache', type=str, default=None)
+parser.add_argument('--threads', type=int, default=8)
+parser.add_argument('--upstream-threads', type=int, default=4)
+parser.add_argument('--queue', type=int, default=64)
+parser.add_argument('--rate-limits', action='store_true',
+                    help='keep the per-client play and search limits instead of lifting them for the load test')
+parser.add_argument('--metrics-file', type=str, default=None, help='write Prometheus metrics here every few seconds')
+parser.add_argument('--slow-request', type=float, default=None, help='log requests slower than this many milliseconds')
+parser.add_argument('--workers', type=int, default=1, help='server processes sharing the port')
+parser.add_argument('--run-dir', type=str, default=None, help='the supervisor\'s run directory, required with --workers')
+parser.add_argument('--worker-index', type=int, default=None, help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+if args.workers > 1 and args.worker_index is None:
+    init_db(args.db)
+    precompile_templates()
+    command = [sys.executable, '-m', 'bench.server'] + sys.argv[1:]
+    Supervisor(command, args.workers, args.run_dir, drain_timeout=5).run(
+        ready=lambda: print(f'ready {os.getpid()}', flush=True))
+    raise SystemExit
+
+client = PodcastIndexClient({'api_key': 'bench', 'api_secret': 'bench'})
+client.base_url = args.upstream + '/api/1.0'
+views.index.client = client
+if not args.rate_limits:
+    # every benchmark client comes from the same address
+    views.play_limiter = RequestLimiter(1000000, 1)
+    views.play_streams = StreamLimiter(max_streams=100000, max_streams_per_client=100000)
+    views.search_limiter = RequestLimiter(1000000, 1)
+
+metrics_file = args.metrics_file
+if args.worker_index is not None:
+    init_processes(args.run_dir, args.worker_index)
+    if metrics_file:
+        root, extension = os.path.splitext(metrics_file)
+        metrics_file = f'{root}-{args.worker_index}{extension}'
+if metrics_file:
+    LoopingCall(metrics.dump, metrics_file).start(2, now=False)
+if args.slow_request is not None:
+    metrics.slow_request_seconds = args.slow_request / 1000
+
+app.workers.size = args.threads
+app.workers.max_queue = args.queue
+app.upstream_workers.size = args.upstream_threads
+init_db(args.db)
+if args.episode_cache:
+    episode_cache = args.episode_cache
+    if args.worker_index is not None:
+        episode_cache = os.path.join(episode_cache, f'worker-{args.worker_index}')
+    init_episode_cache(episode_cache, 1024 * 1024 * 512)
+precompile_templates()
+mirror.start(refresh=args.worker_index in (None, 0))
+
+server = Server(app, reuse_port=args.worker_index is not None, drain_timeout=5,
+                host='127.0.0.1', port=args.port, hostname='localhost')
+if args.worker_index is not None:
+    Health(args.run_dir, args.worker_index, server,
+           lambda: {'requests': metrics.requests(), 'workers': app.workers.stats()}).start()
+else:
+    print(f'ready {os.getpid()}', flush=True)
+server.run()
@@ -0,0 +1,125 @@
+import json
+import zlib
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+FEEDS = 500
+EPISODES_PER_FEED = 200
+CHUNK_SIZE = 1024 * 64
+
+
+def episode_ids(feed_id):
+    return range(feed_id * 1000 + EPISODES_PER_FEED - 1, feed_id * 1000 - 1, -1)
+
+
+class StubUpstream:
+    # Stands in for both the podcastindex API and the hosts serving episode
+    # enclosures. Responses are generated from the ids, so any feed or
+    # episode id in range exists.
+    def __init__(self, latency=0.05, enclosure_latency=0.05, enclosure_size=1024 * 1024,
+                 description_size=4096, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.enclosure_latency = enclosure_latency
+        self.enclosure_size = enclosure_size
+        self.description = self.show_notes(description_size)
+        self.requests = 0
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        self.url = f'http://{host}:{self.server.server_port}'
+
+    @staticmethod
+    def show_notes(size):
+        paragraph = ('<p>In this episode we talk about <a href="https://example.com/topic">the topic</a> '
+                     '&amp; answer listener mail.</p><ul><li>Chapter one</li><li>Chapter <b>two</b></li></ul>')
+        return (paragraph * (size // len(paragraph) + 1))[:size]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def feed(self, feed_id):
+        return {
+            'id': feed_id, 'title': f'Podcast {feed_id}', 'author': f'Host {feed_id % 37}',
+            'description': f'A show about subject {feed_id}', 'url': f'{self.url}/feeds/{feed_id}.xml',
+            'link': f'https://example.com/{feed_id}', 'categories': {'1': 'Technology', '2': 'News'},
+            'episodeCount': EPISODES_PER_FEED,
+        }
+
+    def episode(self, episode_id):
+        feed_id = episode_id // 1000
+        return {
+            'id': episode_id, 'feedId': feed_id, 'feedTitle': f'Podcast {feed_id}',
+            'title': f'Episode {episode_id % 1000} of podcast {feed_id}',
+            'datePublished': 1700000000 + (episode_id % 1000) * 86400,
+            'datePublishedPretty': 'November 14, 2023 10:13pm', 'season': 1, 'episode': episode_id % 1000,
+            'duration': 3600, 'description': self.description,
+            'enclosureUrl': f'{self.url}/enclosures/{episode_id}.mp3',
+        }
+
+    def api(self, path, params):
+        if path.endswith('/podcasts/byfeedid'):
+            feed_id = int(params['id'])
+            return {'status': 'true', 'feed': self.feed(feed_id) if 0 < feed_id <= FEEDS else []}
+        if path.endswith('/episodes/byfeedid'):
+            feed_id = int(params['id'])
+            since = int(params.get('since', 0))
+            items = [self.episode(episode_id) for episode_id in episode_ids(feed_id)]
+            items = [item for item in items if item['datePublished'] >= since][:int(params.get('max', 10))]
+            return {'status': 'true', 'items': items, 'count': len(items)}
+        if path.endswith('/episodes/byid'):
+            episode_id = int(params['id'])
+            exists = 0 < episode_id // 1000 <= FEEDS and episode_id % 1000 < EPISODES_PER_FEED
+            return {'status': 'true', 'episode': self.episode(episode_id) if exists else []}
+        if path.endswith('/search/byterm'):
+            term = params.get('q', '')
+            feeds = [self.feed(feed_id) for feed_id in range(1, FEEDS + 1) if str(feed_id) in term][:40]
+            if not feeds:
+                feeds = [self.feed(zlib.crc32(term.encode()) % FEEDS + 1)]
+            return {'status': 'true', 'feeds': feeds, 'count': len(feeds)}
+        return None
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                stub.requests += 1
+                length = int(self.headers.get('Content-Length') or 0)
+                params = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+                time.sleep(stub.latency)
+                result = stub.api(self.path, params)
+                if result is None:
+                    return self.send_error(404)
+                body = json.dumps(result).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                stub.requests += 1
+                if not self.path.startswith('/enclosures/'):
+                    return self.send_error(404)
+                time.sleep(stub.enclosure_latency)
+                self.send_response(200)
+                self.send_header('Content-Type', 'audio/mpeg')
+                self.send_header('Content-Length', str(stub.enclosure_size))
+                self.end_headers()
+                chunk = b'\0' * CHUNK_SIZE
+                remaining = stub.enclosure_size
+                while remaining > 0:
+                    self.wfile.write(chunk[:remaining])
+                    remaining -= CHUNK_SIZE
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
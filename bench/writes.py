@@ -0,0 +1,124 @@
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from peewee import SqliteDatabase, OperationalError
+from rocketcaster import database
+from rocketcaster.models import MODELS, User, Post
+from rocketcaster.views import create_comment
+from .run import percentile
+from .seed import seed
+
+# Concurrent comment load against the database, with readers loading the
+# front page at the same time. Compares the writer thread with WAL against
+# writing directly from each thread on a default journal database, the way
+# requests wrote before the writer existed:
+#
+#     python -m bench.writes --writers 16 --readers 8
+
+
+def open_direct(db_path):
+    User._meta.database.close()
+    db = SqliteDatabase(db_path)
+    db.execute_sql('PRAGMA journal_mode=delete')
+    db.bind(MODELS)
+    database.writer = None
+    return db
+
+
+def drive(seconds, writers, readers, users, posts, mentions):
+    write_samples, read_samples = [], []
+    errors = {'write': 0, 'read': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def write_loop(i):
+        rng = random.Random(i)
+        samples = []
+        while time.perf_counter() < deadline:
+            author = rng.choice(users)
+            post = rng.choice(posts)
+            content = 'Good episode'
+            if rng.random() < mentions:
+                content += f' @{rng.choice(users).name}'
+            started = time.perf_counter()
+            try:
+                database.write(create_comment, author, post, content)
+            except OperationalError:  # database is locked
+                with lock:
+                    errors['write'] += 1
+                continue
+            samples.append(time.perf_counter() - started)
+        with lock:
+            write_samples.extend(samples)
+
+    def read_loop(i):
+        samples = []
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                list(Post.most_recent())
+            except OperationalError:
+                with lock:
+                    errors['read'] += 1
+                continue
+            samples.append(time.perf_counter() - started)
+        with lock:
+            read_samples.extend(samples)
+
+    threads = [threading.Thread(target=write_loop, args=(i,)) for i in range(writers)]
+    threads += [threading.Thread(target=read_loop, args=(i,)) for i in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return write_samples, read_samples, errors
+
+
+def report(mode, seconds, write_samples, read_samples, errors):
+    def ms(samples, q):
+        value = percentile(samples, q)
+        return f'{value * 1000:8.1f}' if value is not None else '       -'
+
+    for kind, samples in (('write', write_samples), ('read', read_samples)):
+        print(f'{mode:<8} {kind:<6} {len(samples):>7} {len(samples) / seconds:8.1f} {ms(samples, 0.5)} '
+              f'{ms(samples, 0.95)} {ms(samples, 0.99)} {errors[kind]:>7}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark concurrent comment writes.')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--writers', type=int, default=16, help='threads adding comments')
+    parser.add_argument('--readers', type=int, default=8, help='threads loading the front page posts')
+    parser.add_argument('--mentions', type=float, default=0.2, help='share of comments mentioning a user')
+    parser.add_argument('--modes', type=str, default='direct,writer')
+    args = parser.parse_args()
+
+    print(f'{"mode":<8} {"kind":<6} {"ops":>7} {"ops/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"errors":>7}')
+    for mode in args.modes.split(','):
+        workdir = tempfile.mkdtemp(prefix='rocketcaster-writes-')
+        try:
+            db_path = os.path.join(workdir, 'db.sqlite')
+            seed(db_path, [], users=200, posts=2000, comments=10000, notifications=5000)
+            if mode == 'direct':
+                open_direct(db_path)
+            users = list(User.select())
+            posts = list(Post.select().order_by(Post.created.desc()).limit(50))
+            write_samples, read_samples, errors = drive(args.seconds, args.writers, args.readers,
+                                                        users, posts, args.mentions)
+            report(mode, args.seconds, write_samples, read_samples, errors)
+            if database.writer is not None:
+                database.writer.stop()
+                stats = database.writer.stats()
+                print(f'{"":<8} {stats["committed"]} comments in {stats["transactions"]} transactions')
+        finally:
+            shutil.rmtree(workdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,19 @@
 #!/usr/bin/env python3
-import jetforce
+import time
+started = time.perf_counter()
+
+import os
+import sys
 import argparse
+from jetforce.tls import generate_ad_hoc_certificate
 
-from rocketcaster import app, init_db
+from rocketcaster import app, mirror, init_db, init_episode_cache, init_processes, precompile_templates
+from rocketcaster.processes import Server, Health, Supervisor
+from rocketcaster.transport import Transport, set_transport
+from rocketcaster.metrics import metrics
+from rocketcaster.proxy import chunk_readers
+from rocketcaster.views import play_streams
+from twisted.internet.task import LoopingCall
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--hostname, -H', type=str,
@@ -15,15 +26,127 @@ parser.add_argument('--keyfile, -k', type=str,
                     help='the path to the server\'s keyfile', dest='keyfile', default=None)
 parser.add_argument('--db', type=str, help='the path to the database',
                     dest='db_path', default='./db.sqlite')
+parser.add_argument('--episode-cache', type=str, help='the directory to cache proxied episodes in, or "none" to disable',
+                    dest='episode_cache', default='./episode_cache')
+parser.add_argument('--episode-cache-size', type=int, help='the episode cache budget in megabytes',
+                    dest='episode_cache_size', default=2048)
+parser.add_argument('--threads', type=int, help='the number of worker threads handling requests',
+                    dest='threads', default=8)
+parser.add_argument('--upstream-threads', type=int, help='worker threads for requests that wait on podcastindex or episode hosts, kept apart from the others',
+                    dest='upstream_threads', default=4)
+parser.add_argument('--queue', type=int, help='the number of requests that may wait for a worker before new ones are turned away',
+                    dest='queue', default=64)
+parser.add_argument('--connect-timeout', type=float, help='seconds to wait when connecting to upstream servers',
+                    dest='connect_timeout', default=5)
+parser.add_argument('--read-timeout', type=float, help='seconds to wait for data from upstream servers',
+                    dest='read_timeout', default=30)
+parser.add_argument('--max-connections', type=int, help='the number of open connections to upstream servers allowed at once',
+                    dest='max_connections', default=64)
+parser.add_argument('--template-cache', type=str, help='the directory to keep compiled templates in, or "none" to disable',
+                    dest='template_cache', default='./template_cache')
+parser.add_argument('--precompile', action='store_true',
+                    help='compile the templates into the template cache and exit', dest='precompile')
+parser.add_argument('--migrate-dry-run', action='store_true',
+                    help='show the schema upgrades the database needs and how they change query plans, then exit without saving them',
+                    dest='migrate_dry_run')
+parser.add_argument('--play-bandwidth', type=float, help='megabytes per second shared by all proxied episode plays, 0 for no limit',
+                    dest='play_bandwidth', default=0)
+parser.add_argument('--max-plays', type=int, help='the number of proxied episode plays allowed at once',
+                    dest='max_plays', default=32)
+parser.add_argument('--max-plays-per-client', type=int, help='the number of proxied episode plays allowed at once per client',
+                    dest='max_plays_per_client', default=2)
+parser.add_argument('--operator', type=str, action='append', default=[],
+                    help='a client certificate fingerprint allowed to see /admin/metrics, may be given more than once',
+                    dest='operators')
+parser.add_argument('--slow-request', type=float, help='log requests slower than this many milliseconds with their SQL queries',
+                    dest='slow_request', default=None)
+parser.add_argument('--metrics-file', type=str, help='write Prometheus metrics to this file every 15 seconds, for the node_exporter textfile collector; with several workers each writes its own, numbered',
+                    dest='metrics_file', default=None)
+parser.add_argument('--workers', type=int, help='the number of server processes sharing the port, restarted one at a time on SIGHUP',
+                    dest='workers', default=1)
+parser.add_argument('--run-dir', type=str, help='the directory server processes report their health in and share cache invalidations through',
+                    dest='run_dir', default='./run')
+parser.add_argument('--shutdown-timeout', type=float, help='seconds a stopping server waits for open connections to finish',
+                    dest='shutdown_timeout', default=30)
+parser.add_argument('--worker-index', type=int, help=argparse.SUPPRESS, dest='worker_index', default=None)
 args = parser.parse_args()
+imported = time.perf_counter()
+
+template_cache = args.template_cache if args.template_cache.lower() != 'none' else None
+if args.precompile:
+    count = precompile_templates(template_cache)
+    print(f'Compiled {count} templates in {time.perf_counter() - imported:.3f}s')
+    raise SystemExit
+
+if args.migrate_dry_run:
+    print('\n'.join(init_db(args.db_path, dry_run=True).lines()))
+    raise SystemExit
+
+if args.workers > 1 and args.worker_index is None:
+    # the supervisor upgrades the database and compiles the templates once,
+    # then starts the workers with the same arguments
+    os.makedirs(args.run_dir, exist_ok=True)
+    migration = init_db(args.db_path)
+    if migration.applied:
+        print('\n'.join(migration.lines()), flush=True)
+    precompile_templates(template_cache)
+    command = [sys.executable] + sys.argv
+    if not args.certfile:
+        # every worker has to present the same certificate
+        certfile, keyfile = generate_ad_hoc_certificate(args.hostname or 'localhost')
+        command += ['--certfile', certfile, '--keyfile', keyfile]
+    Supervisor(command, args.workers, args.run_dir, drain_timeout=args.shutdown_timeout).run()
+    raise SystemExit
+
+server = Server(app, reuse_port=args.worker_index is not None, drain_timeout=args.shutdown_timeout,
+                host=args.host, hostname=args.hostname or 'localhost', certfile=args.certfile, keyfile=args.keyfile)
+app.workers.size = args.threads
+app.workers.max_queue = args.queue
+app.upstream_workers.size = args.upstream_threads
+# budgets for the whole server are split between its workers; per client
+# limits apply per worker
+play_streams.bytes_per_second = args.play_bandwidth * 1024 * 1024 / args.workers or None
+play_streams.max_streams = max(args.max_plays // args.workers, 1)
+play_streams.max_streams_per_client = args.max_plays_per_client
+chunk_readers.size = play_streams.max_streams
+metrics.operators.update(args.operators)
+if args.slow_request is not None:
+    metrics.slow_request_seconds = args.slow_request / 1000
+metrics_file = args.metrics_file
+episode_cache = args.episode_cache
+if args.worker_index is not None:
+    init_processes(args.run_dir, args.worker_index)
+    Health(args.run_dir, args.worker_index, server,
+           lambda: {'requests': metrics.requests(), 'workers': app.workers.stats()}).start()
+    if metrics_file:
+        root, extension = os.path.splitext(metrics_file)
+        metrics_file = f'{root}-{args.worker_index}{extension}'
+    # a cache directory each, their indexes aren't shared; a restarted
+    # worker's replacement takes over its files
+    episode_cache = os.path.join(episode_cache, f'worker-{args.worker_index}')
+if metrics_file:
+    LoopingCall(metrics.dump, metrics_file).start(15, now=False)
+set_transport(Transport(connect_timeout=args.connect_timeout, read_timeout=args.read_timeout,
+                        max_connections=args.max_connections))
+
+timings = [('import', imported - started)]
+
+step = time.perf_counter()
+migration = init_db(args.db_path)
+timings.append(('database', time.perf_counter() - step))
+if migration.applied:
+    print('\n'.join(migration.lines()), flush=True)
+
+step = time.perf_counter()
+if args.episode_cache.lower() != 'none':
+    init_episode_cache(episode_cache, args.episode_cache_size * 1024 * 1024 // args.workers)
+timings.append(('episode cache', time.perf_counter() - step))
+
+step = time.perf_counter()
+template_count = precompile_templates(template_cache)
+timings.append((f'templates ({template_count})', time.perf_counter() - step))
 
-server = jetforce.GeminiServer(app)
-if args.hostname:
-    server.hostname = args.hostname
-if args.certfile:
-    server.certfile = args.certfile
-if args.keyfile:
-    server.keyfile = args.keyfile
-server.host = args.host
-init_db(args.db_path)
+mirror.start(refresh=args.worker_index in (None, 0))
+report = ', '.join(f'{name} {seconds:.3f}s' for name, seconds in timings)
+print(f'Started in {time.perf_counter() - started:.3f}s: {report}', flush=True)
 server.run()
@@ -1,4 +1,5 @@
-from .views import app
+from .views import app, mirror, precompile_templates, init_processes
 from .models import init_db
+from .proxy import init_episode_cache
 
-__all__ = ['app', 'init_db']
+__all__ = ['app', 'mirror', 'precompile_templates', 'init_db', 'init_episode_cache', 'init_processes']
@@ -0,0 +1,435 @@
+import os
+import json
+import mmap
+import time
+import zlib
+import fcntl
+import struct
+import threading
+import functools
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from .database import renew_snapshot
+from .metrics import metrics
+
+GENERATION = struct.Struct('=Q')
+
+
+def approximate_size(value):
+    try:
+        return len(json.dumps(value, default=str))
+    except (TypeError, ValueError):
+        return len(repr(value))
+
+
+def key_size(key):
+    return len(key) if isinstance(key, (str, bytes)) else approximate_size(key)
+
+
+class CacheEntry:
+    __slots__ = ['value', 'size', 'fresh_until', 'stale_until']
+
+    def __init__(self, value, size, fresh_until, stale_until):
+        self.value = value
+        self.size = size
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+
+
+class LRUCache:
+    def __init__(self, max_bytes=1024 * 1024 * 32, sizeof=approximate_size):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.size = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        # entries are returned until their stale time, callers that serve
+        # stale entries check fresh_until themselves
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() >= entry.stale_until:
+                del self.entries[key]
+                self.size -= entry.size
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, value, ttl, stale_ttl=0):
+        now = time.monotonic()
+        size = self.sizeof(value) + key_size(key)
+        if size > self.max_bytes:
+            return
+        entry = CacheEntry(value, size, now + ttl, now + ttl + stale_ttl)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            self.entries[key] = entry
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry.size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class CachedIndex:
+    # Expired entries are served for up to stale_ttl while a background
+    # refresh runs. Identical lookups that miss at the same time share one
+    # upstream request, and submit() lets views start independent lookups
+    # concurrently.
+    # connect() creates the upstream client on first use, so importing the
+    # app doesn't need API credentials
+    def __init__(self, connect, ttls, cache=None, stale_ttl=60 * 60 * 24, max_workers=16):
+        self.connect = connect
+        self.connection = None
+        self.ttls = ttls
+        self.cache = cache if cache is not None else LRUCache()
+        self.stale_ttl = stale_ttl
+        self.max_workers = max_workers
+        self.executor = None
+        self.counters = defaultdict(lambda: defaultdict(int))
+        self.inflight = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self.connection is None:
+            with self.lock:
+                if self.connection is None:
+                    self.connection = self.connect()
+        return self.connection
+
+    @client.setter
+    def client(self, client):
+        self.connection = client
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name not in self.ttls:
+            return getattr(self.client, name)
+        return functools.partial(self.call, name)
+
+    def lookup(self, endpoint, key):
+        entry = self.cache.get(key)
+        if entry is not None:
+            now = time.monotonic()
+            if now < entry.fresh_until:
+                self.counters[endpoint]['hits'] += 1
+                return entry
+            if now < entry.stale_until:
+                self.counters[endpoint]['stale_hits'] += 1
+                return entry
+        return None
+
+    def call(self, endpoint, *args, **kwargs):
+        key = (endpoint, args, tuple(sorted(kwargs.items())))
+        entry = self.lookup(endpoint, key)
+        if entry is not None:
+            if time.monotonic() >= entry.fresh_until:
+                self.refresh(key, endpoint, args, kwargs)
+            return entry.value
+
+        self.counters[endpoint]['misses'] += 1
+        return self.fetch(key, endpoint, args, kwargs)
+
+    def submit(self, endpoint, *args, **kwargs):
+        # cached results come back as completed futures without a thread hop
+        key = (endpoint, args, tuple(sorted(kwargs.items())))
+        entry = self.lookup(endpoint, key)
+        if entry is not None:
+            if time.monotonic() >= entry.fresh_until:
+                self.refresh(key, endpoint, args, kwargs)
+            future = Future()
+            future.set_result(entry.value)
+            return future
+
+        self.counters[endpoint]['misses'] += 1
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='upstream')
+        # the fetch counts towards the request that asked for it
+        fetch = metrics.run_in(metrics.current(), self.fetch)
+        return self.executor.submit(fetch, key, endpoint, args, kwargs)
+
+    def then(self, future, func):
+        # chains a dependent lookup: func receives the result of future and
+        # returns another future (or None) as soon as its key is known
+        chained = Future()
+
+        def resolved(done):
+            try:
+                next_future = func(done.result())
+            except BaseException as e:
+                chained.set_exception(e)
+                return
+            if next_future is None:
+                chained.set_result(None)
+            else:
+                next_future.add_done_callback(lambda d: copy_result(d, chained))
+
+        future.add_done_callback(metrics.run_in(metrics.current(), resolved))
+        return chained
+
+    def fetch(self, key, endpoint, args, kwargs):
+        with self.lock:
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self.inflight[key] = Future()
+        if not leader:
+            self.counters[endpoint]['coalesced'] += 1
+            return future.result()
+
+        try:
+            # another leader may have filled the entry while this call was queued
+            entry = self.cache.get(key)
+            if entry is not None and time.monotonic() < entry.fresh_until:
+                value = entry.value
+            else:
+                value = getattr(self.client, endpoint)(*args, **kwargs)
+                self.cache.set(key, value, self.ttls[endpoint], self.stale_ttl)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+
+    def refresh(self, key, endpoint, args, kwargs):
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def run():
+            try:
+                self.fetch(key, endpoint, args, kwargs)
+            except Exception:
+                self.counters[endpoint]['refresh_errors'] += 1
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def stats(self):
+        return {
+            'entries': len(self.cache),
+            'bytes': self.cache.size,
+            'evictions': self.cache.evictions,
+            'inflight': len(self.inflight),
+            'endpoints': {endpoint: dict(counts) for endpoint, counts in self.counters.items()},
+        }
+
+
+def copy_result(source, target):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+class Generations:
+    # counters bumped on writes; a cached page is only valid for the
+    # generations it was rendered at
+    def __init__(self):
+        self.values = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def get(self, names):
+        return tuple(self.values.get(name, 0) for name in names)
+
+    def bump(self, *names):
+        with self.lock:
+            for name in names:
+                self.values[name] += 1
+
+
+class SharedGenerations:
+    # Generations in a memory mapped file, for server processes sharing a
+    # database: a write in one invalidates what all of them cached. Names
+    # hash to a fixed number of slots, so two names sharing one only costs
+    # some extra renders.
+    def __init__(self, path, slots=4096):
+        self.slots = slots
+        size = slots * GENERATION.size
+        with open(path, 'ab') as f:  # created if missing, never truncated
+            if os.fstat(f.fileno()).st_size < size:
+                f.truncate(size)
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.lock = threading.Lock()
+
+    def offset(self, name):
+        # crc32 rather than hash(), which differs between processes
+        return zlib.crc32(name.encode()) % self.slots * GENERATION.size
+
+    def get(self, names):
+        return tuple(GENERATION.unpack_from(self.map, self.offset(name))[0] for name in names)
+
+    def bump(self, *names):
+        # the file lock makes the increments atomic across processes
+        with self.lock:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+            try:
+                for name in names:
+                    offset = self.offset(name)
+                    GENERATION.pack_into(self.map, offset, GENERATION.unpack_from(self.map, offset)[0] + 1)
+            finally:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+
+
+class PageCache:
+    def __init__(self, ttl=60, max_bytes=1024 * 1024 * 8, generations=None):
+        self.ttl = ttl
+        self.generations = generations if generations is not None else Generations()
+        self.cache = LRUCache(max_bytes, sizeof=lambda value: len(value[1]))
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_render(self, key, depends, render):
+        # read the generations before rendering so a write that lands
+        # mid-render leaves the new entry already outdated
+        stamp = self.generations.get(depends)
+        entry = self.cache.get(key)
+        if entry is not None and entry.value[0] == stamp and time.monotonic() < entry.fresh_until:
+            self.hits += 1
+            return entry.value[1]
+
+        self.misses += 1
+        # the request's snapshot may predate the stamp, render from one that doesn't
+        renew_snapshot()
+        body = render()
+        if body is not None:
+            self.cache.set(key, (stamp, body), self.ttl)
+        return body
+
+    def invalidate(self, *names):
+        self.generations.bump(*names)
+
+    def stats(self):
+        return {
+            'entries': len(self.cache),
+            'bytes': self.cache.size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class FeedEpisodes:
+    # The newest page of each feed's episodes. Once it goes stale only the
+    # episodes published since the newest one we have are requested and
+    # merged in, so polling a long-running show stays cheap.
+    def __init__(self, index, ttl, count=50, cache=None, stale_ttl=60 * 60 * 24):
+        self.index = index
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl  # how long a stale page is kept to merge into
+        self.count = count
+        self.cache = cache if cache is not None else LRUCache()
+        self.full_fetches = 0
+        self.incremental_fetches = 0
+        self.stale_serves = 0
+        self.coalesced = 0
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def newest(self, feed_id):
+        key = str(feed_id)
+        entry = self.cache.get(key)
+        if entry is not None and time.monotonic() < entry.fresh_until:
+            return entry.value
+
+        # like CachedIndex.fetch, requests for the same feed share one update
+        with self.lock:
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self.inflight[key] = Future()
+        if not leader:
+            self.coalesced += 1
+            return future.result()
+
+        try:
+            items = self.update(key, feed_id)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(items)
+            return items
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+
+    def update(self, key, feed_id):
+        # another leader may have updated the feed while this call was queued
+        entry = self.cache.get(key)
+        if entry is not None and time.monotonic() < entry.fresh_until:
+            return entry.value
+
+        try:
+            if entry is None or not entry.value:
+                items = self.fetch(feed_id)
+            else:
+                items = self.merge(feed_id, entry.value)
+        except Exception:
+            # keep serving what we had while upstream is unavailable
+            if entry is None:
+                raise
+            self.stale_serves += 1
+            return entry.value
+
+        self.cache.set(key, items, self.ttl, self.stale_ttl)
+        return items
+
+    def fetch(self, feed_id):
+        self.full_fetches += 1
+        return self.index.client.episodesByFeedId(feedId=feed_id, max_results=self.count)['items']
+
+    def merge(self, feed_id, items):
+        self.incremental_fetches += 1
+        since = items[0]['datePublished']
+        new_items = self.index.client.episodesByFeedId(
+            feedId=feed_id, since=since, max_results=self.count)['items']
+        if len(new_items) >= self.count:
+            # a full page of new episodes, nothing older survives the cut
+            return new_items
+
+        # since is inclusive and episodes can be edited, so newer copies win
+        known = {episode['id'] for episode in new_items}
+        merged = new_items + [episode for episode in items if episode['id'] not in known]
+        merged.sort(key=lambda episode: episode['datePublished'], reverse=True)
+        return merged[:self.count]
+
+    def stats(self):
+        return {
+            'feeds': len(self.cache),
+            'full_fetches': self.full_fetches,
+            'incremental_fetches': self.incremental_fetches,
+            'stale_serves': self.stale_serves,
+            'coalesced': self.coalesced,
+        }
@@ -0,0 +1,223 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from twisted.internet import reactor
+from twisted.python import log
+from .metrics import metrics, InstrumentedSqliteDatabase
+
+PRAGMAS = {
+    'journal_mode': 'wal',  # readers and the writer don't block each other
+    'synchronous': 'normal',  # durable at checkpoints, safe against corruption
+    'cache_size': -1024 * 4,  # KB per connection, there's one per thread
+    'mmap_size': 1024 * 1024 * 256,
+    'temp_store': 'memory',
+    'busy_timeout': 5000,  # ms, for writes from outside the writer thread
+}
+
+
+class Database(InstrumentedSqliteDatabase):
+    # Every thread has its own connection. Inside snapshot() a thread's
+    # reads all see the database as of its first query; the transaction is
+    # only opened if a query is actually made.
+    def __init__(self, path, **kwargs):
+        kwargs.setdefault('pragmas', PRAGMAS)
+        super().__init__(path, **kwargs)
+        self.snapshots = threading.local()
+
+    @contextmanager
+    def snapshot(self):
+        self.snapshots.pending = True
+        self.snapshots.transaction = None
+        try:
+            yield
+        finally:
+            self.snapshots.pending = False
+            transaction = self.snapshots.transaction
+            self.snapshots.transaction = None
+            if transaction is not None:
+                # nothing was written, so ending it either way is the same
+                transaction.__exit__(None, None, None)
+
+    def renew_snapshot(self):
+        # ends the snapshot if a query has opened it, so the next one sees
+        # everything committed since
+        transaction = getattr(self.snapshots, 'transaction', None)
+        if transaction is not None:
+            self.snapshots.transaction = None
+            self.snapshots.pending = True
+            transaction.__exit__(None, None, None)
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        if getattr(self.snapshots, 'pending', False):
+            self.snapshots.pending = False
+            if not self.in_transaction():
+                self.snapshots.transaction = self.transaction()
+                self.snapshots.transaction.__enter__()
+        return super().execute_sql(sql, params, *args, **kwargs)
+
+
+class WriteQueueFull(Exception):
+    pass
+
+
+class Writer:
+    # All writes made while serving requests go through one thread, so they
+    # never contend for SQLite's write lock. Each job runs in its own
+    # savepoint and whatever is queued is committed together, so a burst of
+    # writes costs one commit instead of one each.
+    def __init__(self, database, max_queue=256, batch=64, put_timeout=5):
+        self.database = database
+        self.jobs = queue.Queue(max_queue)
+        self.batch = batch
+        self.put_timeout = put_timeout
+        self.thread = None
+        self.committed = 0
+        self.transactions = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_seconds = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='writer', daemon=True)
+                self.thread.start()
+                # the first write may come from any thread, and the reactor's
+                # triggers may only be changed from its own
+                reactor.callFromThread(reactor.addSystemEventTrigger, 'during', 'shutdown', self.stop)
+
+    def stop(self):
+        # lets the writes already queued finish before the process exits
+        if self.thread is not None:
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, func, *args, **kwargs):
+        if self.thread is None:
+            self.start()
+        future = Future()
+        if threading.current_thread() is self.thread:
+            # a job making another write is already inside the transaction
+            future.set_result(func(*args, **kwargs))
+            return future
+        job = (metrics.run_in(metrics.current(), func), args, kwargs, future, time.perf_counter())
+        try:
+            self.jobs.put(job, timeout=self.put_timeout)
+        except queue.Full:
+            self.rejected += 1
+            raise WriteQueueFull('Too many writes waiting for the database')
+        return future
+
+    def write(self, func, *args, **kwargs):
+        # blocks until the write has been committed
+        return self.submit(func, *args, **kwargs).result()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            jobs = [job]
+            while len(jobs) < self.batch:
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    self.jobs.put(None)
+                    break
+                jobs.append(job)
+            self.commit(jobs)
+
+    def commit(self, jobs):
+        results = []
+        failed = 0
+        started = time.perf_counter()
+        try:
+            with self.database.atomic('IMMEDIATE'):
+                for func, args, kwargs, future, queued in jobs:
+                    self.wait_seconds += started - queued
+                    try:
+                        with self.database.atomic():
+                            results.append((future, func(*args, **kwargs), None))
+                    except Exception as e:
+                        failed += 1
+                        results.append((future, None, e))
+        except Exception as e:
+            log.err(None, 'Error committing writes')
+            self.failed += len(jobs)
+            results = [(future, None, e) for _, _, _, future, _ in jobs]
+        else:
+            self.transactions += 1
+            self.committed += len(jobs) - failed
+            self.failed += failed
+
+        # only reported once the transaction is durable
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            'queued': self.jobs.qsize(),
+            'committed': self.committed,
+            'transactions': self.transactions,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'average_wait_ms': round(self.wait_seconds / self.committed * 1000, 2) if self.committed else None,
+        }
+
+
+writer = None
+
+
+def init_writer(database, max_queue=256):
+    global writer
+    writer = Writer(database, max_queue)
+
+
+def write(func, *args, **kwargs):
+    # runs func in a transaction on the writer thread and returns its result;
+    # before init_db there's no writer and it's called directly
+    if writer is None:
+        return func(*args, **kwargs)
+    return writer.write(func, *args, **kwargs)
+
+
+def write_later(func, *args, **kwargs):
+    # for writes nobody waits on, like keeping the local mirror up to date
+    if writer is None:
+        func(*args, **kwargs)
+        return
+    try:
+        future = writer.submit(func, *args, **kwargs)
+    except WriteQueueFull:
+        log.msg('Dropped a background write, the write queue is full')
+        return
+    future.add_done_callback(log_failure)
+
+
+def renew_snapshot():
+    if writer is not None:
+        writer.database.renew_snapshot()
+
+
+def log_failure(future):
+    if future.exception() is not None:
+        log.err(future.exception(), 'Error in background write')
+
+
+def read_snapshot(func):
+    def wrapped(request, **kwargs):
+        if writer is None:
+            return func(request, **kwargs)
+        with writer.database.snapshot():
+            return func(request, **kwargs)
+
+    return wrapped
@@ -0,0 +1,122 @@
+import re
+from html import unescape
+from urllib.parse import urljoin
+
+MAIN_FORMATTING = re.compile(r"(^(#+)|(=>)|(```)|(\*)|(>)|(^\n))", re.MULTILINE)
+POST_FORMATTING = re.compile(r"(^(#+)|(```))", re.MULTILINE)
+
+# one token per match: a comment, an element whose content is dropped, a tag
+# (closing flag, name, attributes) or text
+HTML_TOKEN = re.compile(r'<!--.*?(?:-->|$)'
+                        r'|(?i:<(script|style|head|title)\b[^>]*>.*?(?:</\1\s*>|$))'
+                        r'|<(/?)([a-zA-Z][a-zA-Z0-9]*)([^>]*)>'
+                        r'|([^<]+|<)', re.DOTALL)
+HREF = re.compile(r'''href\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''', re.IGNORECASE)
+WHITESPACE = re.compile(r'\s+')
+BLANK_LINES = re.compile(r'\n{3,}')
+
+BLOCK_TAGS = {'p', 'div', 'blockquote', 'pre', 'table', 'tr', 'section', 'article',
+              'ul', 'ol', 'dl', 'h4', 'h5', 'h6', 'hr', 'figure'}
+HEADING_TAGS = {'h1': '# ', 'h2': '## ', 'h3': '### '}
+# what a line of text can't start with without being read as something else
+LINE_MARKERS = ('=>', '```', '#', '*', '>')
+
+
+def strip_formatting_main(text):
+    return MAIN_FORMATTING.sub('', text)
+
+
+def strip_formatting_post(text):
+    return POST_FORMATTING.sub('', text)
+
+
+class GemtextConverter:
+    # Converts HTML to gemtext in one pass over the markup: paragraphs and
+    # breaks become newlines, list items become bullets and links are
+    # collected and written as => lines after the block they appeared in,
+    # resolved against base if they're relative.
+    def __init__(self, base=None):
+        self.base = base
+        self.out = []
+        self.line = []
+        self.marker = ''
+        self.links = []
+        self.href = None
+        self.link_text = []
+
+    def convert(self, html):
+        for match in HTML_TOKEN.finditer(html):
+            _, closing, tag, attrs, text = match.groups()
+            if text is not None:
+                self.text(text)
+            elif tag is not None:
+                if closing:
+                    self.end_tag(tag.lower())
+                else:
+                    self.start_tag(tag.lower(), attrs)
+        return self.result()
+
+    def start_tag(self, tag, attrs):
+        if tag == 'br':
+            self.end_line()
+        elif tag == 'li':
+            self.end_block(blank=False)
+            self.marker = '* '
+        elif tag in HEADING_TAGS:
+            self.end_block()
+            self.marker = HEADING_TAGS[tag]
+        elif tag in BLOCK_TAGS:
+            self.end_block()
+        elif tag == 'a':
+            href = HREF.search(attrs)
+            self.href = unescape(next(group for group in href.groups() if group is not None)) if href else None
+            if self.href and self.href.startswith(('javascript:', '#')):
+                self.href = None
+            elif self.href and self.base:
+                self.href = urljoin(self.base, self.href)
+            self.link_text = []
+
+    def end_tag(self, tag):
+        if tag == 'a':
+            if self.href:
+                label = WHITESPACE.sub(' ', ''.join(self.link_text)).strip()
+                self.links.append((self.href, label))
+            self.href = None
+        elif tag == 'li':
+            self.end_block(blank=False)
+        elif tag in BLOCK_TAGS or tag in HEADING_TAGS:
+            self.end_block()
+
+    def text(self, data):
+        text = WHITESPACE.sub(' ', unescape(data) if '&' in data else data)
+        if not self.line or self.line[-1].endswith(' '):
+            text = text.lstrip()
+        self.line.append(text)
+        if self.href is not None:
+            self.link_text.append(text)
+
+    def end_line(self):
+        line = ''.join(self.line).strip()
+        self.line = []
+        # text can't start a line with a gemtext marker of its own
+        if line.startswith(LINE_MARKERS) and not self.marker:
+            line = ' ' + line
+        self.out.append((self.marker + line).rstrip())
+        self.marker = ''
+
+    def end_block(self, blank=True):
+        if self.line or self.marker:
+            self.end_line()
+        for href, label in self.links:
+            self.out.append(f'=> {href} {label}'.rstrip())
+        self.links = []
+        if blank and self.out and self.out[-1]:
+            self.out.append('')
+
+    def result(self):
+        self.end_block()
+        return BLANK_LINES.sub('\n\n', '\n'.join(self.out)).strip('\n')
+
+
+def html_to_gemtext(html, base=None):
+    return GemtextConverter(base).convert(html)
@@ -0,0 +1,254 @@
+import math
+import time
+import threading
+from collections import OrderedDict, defaultdict
+from jetforce import Response, Status
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.task import deferLater
+
+DEFAULT_RETRY = 30  # seconds, when there's nothing better to go on
+MAX_RETRY = 60 * 10
+
+
+def identity(request):
+    # clients with a certificate are limited per certificate, everyone
+    # else per address
+    if 'REMOTE_USER' in request.environ:
+        return 'cert:' + request.environ['TLS_CLIENT_HASH_B64']
+    return 'ip:' + request.environ['REMOTE_ADDR']
+
+
+def slow_down(seconds):
+    # the gemini spec has the number of seconds to wait as the whole meta
+    return Response(Status.SLOW_DOWN, str(min(max(math.ceil(seconds), 1), MAX_RETRY)))
+
+
+class RequestLimiter:
+    # A token bucket per client: rate requests per period on average, with
+    # bursts of up to burst requests. Buckets that have filled up again are
+    # the same as new ones, so only the most recently seen clients are kept.
+    def __init__(self, rate, period, burst=None, max_clients=10000):
+        self.rate = rate / period
+        self.burst = burst if burst is not None else rate
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()  # identity -> (tokens, updated)
+        self.allowed = 0
+        self.limited = 0
+        self.lock = threading.Lock()
+
+    def take(self, key, cost=1):
+        # seconds until the request may be made, 0 if it's allowed now
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= cost:
+                tokens -= cost
+                wait = 0
+                self.allowed += 1
+            else:
+                wait = (cost - tokens) / self.rate
+                self.limited += 1
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        return wait
+
+    def check(self, request):
+        wait = self.take(identity(request))
+        if wait:
+            return slow_down(wait)
+        return None
+
+    def apply(self, func):
+        def wrapped(request, **kwargs):
+            response = self.check(request)
+            if response:
+                return response
+            return func(request, **kwargs)
+
+        return wrapped
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            buckets = list(self.buckets.values())
+        return {
+            'clients': len(buckets),
+            'limited_clients': sum(1 for tokens, updated in buckets
+                                   if tokens + (now - updated) * self.rate < 1),
+            'allowed': self.allowed,
+            'limited': self.limited,
+        }
+
+
+class Stream:
+    def __init__(self, key):
+        self.key = key
+        self.started = time.monotonic()
+        self.sent = 0
+        self.next_send = self.started
+        self.active = self.started
+
+
+class LimitedBody:
+    # Closing it gives back the stream's slot and closes the wrapped body
+    # even if it was never sent, which closing a generator that hasn't
+    # started doesn't do.
+    def __init__(self, limiter, stream, body):
+        self.limiter = limiter
+        self.stream = stream
+        self.body = body
+        self.chunks = limiter.chunks(stream, body)
+
+    def __iter__(self):
+        return self.chunks
+
+    def close(self):
+        self.chunks.close()
+        if hasattr(self.body, 'close'):
+            self.body.close()
+        self.limiter.close(self.stream)
+
+
+class StreamLimiter:
+    # Caps concurrent downloads overall and per client, and paces every
+    # stream to an equal share of a global bytes per second budget. A client
+    # over a cap waits up to queue_timeout for a slot to free up before it's
+    # told to slow down.
+    def __init__(self, bytes_per_second=None, max_streams=32, max_streams_per_client=2, queue_timeout=2,
+                 idle_timeout=120):
+        self.bytes_per_second = bytes_per_second
+        self.max_streams = max_streams
+        self.max_streams_per_client = max_streams_per_client
+        self.queue_timeout = queue_timeout
+        self.idle_timeout = idle_timeout
+        self.streams = set()
+        self.clients = defaultdict(int)
+        self.waiting = 0
+        self.average_duration = None  # of finished streams, for retry hints
+        self.opened = 0
+        self.limited = 0
+        self.sent = 0
+        self.condition = threading.Condition()
+
+    def available(self, key):
+        return len(self.streams) < self.max_streams and self.clients.get(key, 0) < self.max_streams_per_client
+
+    def reap(self):
+        # in case a response is dropped without being written or closed
+        now = time.monotonic()
+        for stream in [stream for stream in self.streams if now - stream.active > self.idle_timeout]:
+            self.remove(stream)
+
+    def open(self, key):
+        # returns a stream, or None if no slot freed up in time; blocks, so
+        # call from a worker thread
+        deadline = time.monotonic() + self.queue_timeout
+        with self.condition:
+            self.reap()
+            if not self.available(key) and self.waiting < self.max_streams:
+                self.waiting += 1
+                try:
+                    while not self.available(key):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            if not self.available(key):
+                self.limited += 1
+                return None
+            stream = Stream(key)
+            self.streams.add(stream)
+            self.clients[key] += 1
+            self.opened += 1
+            return stream
+
+    def close(self, stream):
+        with self.condition:
+            if stream not in self.streams:
+                return
+            self.remove(stream)
+            duration = time.monotonic() - stream.started
+            if self.average_duration is None:
+                self.average_duration = duration
+            else:
+                self.average_duration += (duration - self.average_duration) * 0.1
+
+    def remove(self, stream):
+        self.streams.remove(stream)
+        self.clients[stream.key] -= 1
+        if not self.clients[stream.key]:
+            del self.clients[stream.key]
+        self.condition.notify_all()
+
+    def retry_after(self, key):
+        # when the first stream holding up this client is expected to finish
+        with self.condition:
+            if self.clients.get(key, 0) >= self.max_streams_per_client:
+                streams = [stream for stream in self.streams if stream.key == key]
+            else:
+                streams = list(self.streams)
+            if not streams or self.average_duration is None:
+                return DEFAULT_RETRY
+            now = time.monotonic()
+            return min(self.average_duration - (now - stream.started) for stream in streams)
+
+    def check(self, request):
+        # a stream for the request, or a SLOW_DOWN response
+        key = identity(request)
+        stream = self.open(key)
+        if stream is None:
+            return None, slow_down(self.retry_after(key))
+        return stream, None
+
+    def share(self):
+        return self.bytes_per_second / max(len(self.streams), 1)
+
+    def limit(self, stream, body):
+        # wraps a response body so it's paced and the slot is given back
+        # once it's done, however it ends
+        return LimitedBody(self, stream, body)
+
+    def chunks(self, stream, body):
+        try:
+            if isinstance(body, (bytes, str)):
+                body = [body]
+            for chunk in body or ():
+                delay = stream.next_send - time.monotonic()
+                if delay > 0:
+                    yield deferLater(reactor, delay)
+                if isinstance(chunk, Deferred):
+                    yield chunk.addCallback(self.sent_chunk, stream)
+                else:
+                    yield self.sent_chunk(chunk, stream)
+        finally:
+            self.close(stream)
+
+    def sent_chunk(self, chunk, stream):
+        if chunk:
+            now = time.monotonic()
+            stream.active = now
+            stream.sent += len(chunk)
+            self.sent += len(chunk)
+            if self.bytes_per_second:
+                stream.next_send = max(stream.next_send, now) + len(chunk) / self.share()
+        return chunk
+
+    def stats(self):
+        with self.condition:
+            return {
+                'streams': len(self.streams),
+                'clients': len(self.clients),
+                'waiting': self.waiting,
+                'max_streams': self.max_streams,
+                'max_streams_per_client': self.max_streams_per_client,
+                'bytes_per_second': self.bytes_per_second,
+                'opened': self.opened,
+                'limited': self.limited,
+                'bytes_sent': self.sent,
+                'average_seconds': round(self.average_duration, 1) if self.average_duration is not None else None,
+            }
@@ -0,0 +1,303 @@
+import os
+import time
+import bisect
+import threading
+from collections import deque
+from jetforce import Status
+from peewee import SqliteDatabase
+from twisted.python import log
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+BYTES_BUCKETS = (256, 1024, 1024 * 4, 1024 * 16, 1024 * 64, 1024 * 256, 1024 * 1024, 1024 * 1024 * 16)
+MAX_TRACED_QUERIES = 200  # per request, for the slow request log
+
+
+class Histogram:
+    # fixed buckets, so recording is a bisect and an increment
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # upper bound of the bucket the quantile falls in
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+
+class RouteMetrics:
+    def __init__(self):
+        self.statuses = {}
+        self.duration = Histogram(SECONDS_BUCKETS)
+        self.queries = Histogram(COUNT_BUCKETS)
+        self.query_seconds = Histogram(SECONDS_BUCKETS)
+        self.upstream_calls = Histogram(COUNT_BUCKETS)
+        self.upstream_seconds = Histogram(SECONDS_BUCKETS)
+        self.render_seconds = Histogram(SECONDS_BUCKETS)
+        self.response_bytes = Histogram(BYTES_BUCKETS)
+
+
+class Trace:
+    # everything one request did, filled in from the threads working on it
+    def __init__(self, route, path, started, keep_queries):
+        self.route = route
+        self.path = path
+        self.started = started
+        self.status = None
+        self.queries = 0
+        self.query_seconds = 0
+        self.query_log = [] if keep_queries else None
+        self.upstream_calls = 0
+        self.upstream_seconds = 0
+        self.render_seconds = 0
+        self.size = 0
+        self.finished = False
+
+    def query(self, sql, seconds):
+        self.queries += 1
+        self.query_seconds += seconds
+        if self.query_log is not None and len(self.query_log) < MAX_TRACED_QUERIES:
+            self.query_log.append((sql, seconds))
+
+
+class Metrics:
+    def __init__(self, slow_request_seconds=None, slow_log_size=50):
+        self.routes = {}
+        self.upstream = {}  # host -> Histogram of request seconds
+        self.slow_request_seconds = slow_request_seconds
+        self.slow_requests = deque(maxlen=slow_log_size)
+        self.operators = set()  # certificate fingerprints allowed to see the metrics pages
+        self.worker = None  # added as a label when running several server processes
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def current(self):
+        return getattr(self.local, 'trace', None)
+
+    def run_in(self, trace, func):
+        # carries the current request's trace over to another thread
+        def run(*args, **kwargs):
+            previous = self.current()
+            self.local.trace = trace
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.local.trace = previous
+
+        return run
+
+    def wrap(self, route, func, error_status=None):
+        # runs in the worker thread, the trace is finished once the body has
+        # been written so streamed responses are measured in full.
+        # error_status gives the status a client is answered with when func
+        # raises, see WorkerPool.error_status
+        def traced(request, **kwargs):
+            started = request.environ.get('rocketcaster.received', time.perf_counter())
+            trace = Trace(route, request.path, started,
+                          keep_queries=self.slow_request_seconds is not None)
+            # for WorkerPool to record a timeout in
+            request.environ['rocketcaster.trace'] = trace
+            try:
+                response = self.run_in(trace, func)(request, **kwargs)
+            except BaseException as e:
+                trace.status = error_status(e)[0] if error_status is not None else Status.CGI_ERROR
+                self.finish(trace)
+                raise
+            trace.status = response.status
+            response.body = self.measure_body(trace, response.body)
+            return response
+
+        return traced
+
+    def measure_body(self, trace, body):
+        try:
+            if isinstance(body, (bytes, str)):
+                trace.size += len(body)
+                yield body
+            elif body is not None:
+                # generated bodies run on the reactor thread, so the trace is
+                # put in place around each step to catch their queries
+                chunks = iter(body)
+                while True:
+                    previous = self.current()
+                    self.local.trace = trace
+                    try:
+                        chunk = next(chunks)
+                    except StopIteration:
+                        break
+                    finally:
+                        self.local.trace = previous
+                    if isinstance(chunk, (bytes, str)):
+                        trace.size += len(chunk)
+                        yield chunk
+                    else:
+                        # a Deferred; count what it resolves to
+                        yield chunk.addCallback(self.count_chunk, trace)
+        finally:
+            self.finish(trace)
+
+    @staticmethod
+    def count_chunk(chunk, trace):
+        if isinstance(chunk, (bytes, str)):
+            trace.size += len(chunk)
+        return chunk
+
+    def finish(self, trace):
+        # once per trace; a request that timed out is finished then, and
+        # again if its handler fails later
+        seconds = time.perf_counter() - trace.started
+        with self.lock:
+            if trace.finished:
+                return
+            trace.finished = True
+            route = self.routes.get(trace.route)
+            if route is None:
+                route = self.routes[trace.route] = RouteMetrics()
+            status = int(trace.status) if trace.status is not None else 0
+            route.statuses[status] = route.statuses.get(status, 0) + 1
+            route.duration.observe(seconds)
+            route.queries.observe(trace.queries)
+            route.query_seconds.observe(trace.query_seconds)
+            route.upstream_calls.observe(trace.upstream_calls)
+            route.upstream_seconds.observe(trace.upstream_seconds)
+            route.render_seconds.observe(trace.render_seconds)
+            route.response_bytes.observe(trace.size)
+
+        if self.slow_request_seconds is not None and seconds >= self.slow_request_seconds:
+            entry = {
+                'time': time.time(), 'route': trace.route, 'path': trace.path, 'status': status,
+                'seconds': seconds, 'query_count': trace.queries, 'query_seconds': trace.query_seconds,
+                'upstream_calls': trace.upstream_calls, 'upstream_seconds': trace.upstream_seconds,
+                'render_seconds': trace.render_seconds, 'queries': trace.query_log or [],
+            }
+            self.slow_requests.append(entry)
+            queries = ''.join(f'\n    {query_seconds * 1000:7.1f}ms {sql}' for sql, query_seconds in entry['queries'])
+            log.msg(f'Slow request {trace.path} ({trace.route}) {seconds * 1000:.0f}ms: '
+                    f'{trace.queries} queries {trace.query_seconds * 1000:.0f}ms, '
+                    f'{trace.upstream_calls} upstream {trace.upstream_seconds * 1000:.0f}ms, '
+                    f'render {trace.render_seconds * 1000:.0f}ms{queries}')
+
+    def record_query(self, sql, seconds):
+        trace = self.current()
+        if trace is not None:
+            trace.query(sql, seconds)
+
+    def record_upstream(self, host, seconds):
+        with self.lock:
+            histogram = self.upstream.get(host)
+            if histogram is None:
+                histogram = self.upstream[host] = Histogram(SECONDS_BUCKETS)
+            histogram.observe(seconds)
+        trace = self.current()
+        if trace is not None:
+            trace.upstream_calls += 1
+            trace.upstream_seconds += seconds
+
+    def record_render(self, seconds):
+        trace = self.current()
+        if trace is not None:
+            trace.render_seconds += seconds
+
+    def requests(self):
+        with self.lock:
+            return sum(data.duration.count for data in self.routes.values())
+
+    def prometheus(self):
+        lines = []
+        worker = f'worker="{self.worker}",' if self.worker is not None else ''
+
+        def histogram(name, help, labels, histograms):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} histogram')
+            for label_value, data in histograms:
+                label = f'{worker}{labels}="{escape_label(label_value)}"'
+                cumulative = 0
+                for bound, count in zip(data.buckets, data.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{{label},le="+Inf"}} {data.count}')
+                lines.append(f'{name}_sum{{{label}}} {data.sum}')
+                lines.append(f'{name}_count{{{label}}} {data.count}')
+
+        with self.lock:
+            routes = sorted(self.routes.items())
+            histogram('rocketcaster_request_seconds', 'Time from receiving a request to writing the last byte.',
+                      'route', [(route, data.duration) for route, data in routes])
+            histogram('rocketcaster_request_queries', 'SQL statements executed per request.',
+                      'route', [(route, data.queries) for route, data in routes])
+            histogram('rocketcaster_request_query_seconds', 'Time spent in SQL per request.',
+                      'route', [(route, data.query_seconds) for route, data in routes])
+            histogram('rocketcaster_request_upstream_calls', 'Upstream HTTP requests per request.',
+                      'route', [(route, data.upstream_calls) for route, data in routes])
+            histogram('rocketcaster_request_upstream_seconds', 'Time spent waiting on upstream HTTP per request.',
+                      'route', [(route, data.upstream_seconds) for route, data in routes])
+            histogram('rocketcaster_request_render_seconds', 'Time spent rendering templates per request.',
+                      'route', [(route, data.render_seconds) for route, data in routes])
+            histogram('rocketcaster_response_bytes', 'Response body size.',
+                      'route', [(route, data.response_bytes) for route, data in routes])
+            histogram('rocketcaster_upstream_seconds', 'Upstream HTTP request latency.',
+                      'host', sorted(self.upstream.items()))
+
+            lines.append('# HELP rocketcaster_responses_total Responses by route and status.')
+            lines.append('# TYPE rocketcaster_responses_total counter')
+            for route, data in routes:
+                for status, count in sorted(data.statuses.items()):
+                    lines.append(f'rocketcaster_responses_total{{{worker}route="{escape_label(route)}",status="{status}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        # written atomically for the node_exporter textfile collector
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.prometheus())
+        os.replace(path + '.tmp', path)
+
+    def summary(self):
+        with self.lock:
+            return [{
+                'route': route,
+                'requests': data.duration.count,
+                'statuses': dict(sorted(data.statuses.items())),
+                'p50': data.duration.quantile(0.5),
+                'p95': data.duration.quantile(0.95),
+                'p99': data.duration.quantile(0.99),
+                'queries': data.queries.mean(),
+                'query_seconds': data.query_seconds.mean(),
+                'upstream_calls': data.upstream_calls.mean(),
+                'upstream_seconds': data.upstream_seconds.mean(),
+                'render_seconds': data.render_seconds.mean(),
+                'response_bytes': data.response_bytes.mean(),
+            } for route, data in sorted(self.routes.items())]
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = Metrics()
+
+
+class InstrumentedSqliteDatabase(SqliteDatabase):
+    # times every statement and adds it to the current request's trace
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().execute_sql(sql, params, *args, **kwargs)
+        finally:
+            metrics.record_query(sql, time.perf_counter() - started)
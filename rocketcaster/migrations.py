@@ -0,0 +1,158 @@
+import time
+from .metrics import Trace, metrics
+
+
+class Migration:
+    def __init__(self, version, description, apply):
+        self.version = version
+        self.description = description
+        self.apply = apply  # called with the database, inside the upgrade's transaction
+
+
+class MigrationReport:
+    def __init__(self, from_version, to_version, created=False, dry_run=False):
+        self.from_version = from_version
+        self.to_version = to_version
+        self.created = created
+        self.dry_run = dry_run
+        self.applied = []  # (migration, seconds)
+        self.plans = {}  # query name -> (plan before, plan after)
+
+    def changed_plans(self):
+        return {name: plans for name, plans in self.plans.items() if plans[0] != plans[1]}
+
+    def lines(self):
+        if self.created:
+            return [f'Created a new database at schema version {self.to_version}']
+        if not self.applied:
+            return [f'Database is at schema version {self.from_version}']
+        suffix = ' (dry run, rolled back)' if self.dry_run else ''
+        lines = [f'Upgraded schema from version {self.from_version} to {self.to_version}{suffix}']
+        for migration, seconds in self.applied:
+            lines.append(f'  {migration.version}: {migration.description} ({seconds:.2f}s)')
+        changed = self.changed_plans()
+        if changed:
+            lines.append('Query plans changed:')
+            for name, (before, after) in changed.items():
+                lines.append(f'  {name}')
+                lines += [f'    - {step}' for step in before]
+                lines += [f'    + {step}' for step in after]
+        else:
+            lines.append('No query plans changed')
+        return lines
+
+
+def schema_version(db):
+    return db.execute_sql('PRAGMA user_version').fetchone()[0]
+
+
+def set_schema_version(db, version):
+    db.execute_sql(f'PRAGMA user_version = {int(version)}')
+
+
+def query_statements(db, queries):
+    # runs each hot query and returns the statements it made; a query that
+    # fails (say its table doesn't exist yet) made none
+    statements = {}
+    for name, run in queries.items():
+        trace = Trace('migrations', name, time.perf_counter(), keep_queries=True)
+        try:
+            with db.atomic():
+                metrics.run_in(trace, run)()
+        except Exception:
+            statements[name] = []
+            continue
+        statements[name] = [sql for sql, _ in trace.query_log
+                            if not sql.startswith(('BEGIN', 'SAVEPOINT', 'RELEASE', 'ROLLBACK', 'COMMIT'))]
+    return statements
+
+
+def explain(db, statements):
+    steps = []
+    for sql in statements:
+        # plans don't depend on the values bound, so NULLs will do
+        cursor = db.execute_sql('EXPLAIN QUERY PLAN ' + sql, [None] * sql.count('?'))
+        steps += [row[3] for row in cursor.fetchall()]
+    return tuple(steps)
+
+
+def index_schema(db):
+    # the tables, the indexes declared on them and the planner's statistics
+    tables = {row[0] for row in db.execute_sql("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    indexes = db.execute_sql("SELECT name, tbl_name, sql FROM sqlite_master "
+                             "WHERE type = 'index' AND sql IS NOT NULL").fetchall()
+    stats = db.execute_sql('SELECT tbl, idx, stat FROM sqlite_stat1').fetchall() \
+        if 'sqlite_stat1' in tables else []
+    return tables, indexes, stats
+
+
+def planned_with(db, schema, statements):
+    # Plans the statements against an earlier schema's indexes and
+    # statistics, in a savepoint that's rolled back. Queries can then use
+    # columns only added by the upgrade and still show how they'd have run
+    # on the old database.
+    tables, indexes, stats = schema
+    plans = {}
+    try:
+        with db.atomic():
+            _, current, _ = index_schema(db)
+            for name, table, _ in current:
+                if table in tables:
+                    db.execute_sql(f'DROP INDEX "{name}"')
+            for _, _, sql in indexes:
+                db.execute_sql(sql)
+            for table in tables:
+                db.execute_sql('DELETE FROM sqlite_stat1 WHERE tbl = ?', [table])
+            for row in stats:
+                db.execute_sql('INSERT INTO sqlite_stat1 (tbl, idx, stat) VALUES (?, ?, ?)', row)
+            db.execute_sql('ANALYZE sqlite_master')  # reloads the statistics
+            plans = {name: explain(db, sql) for name, sql in statements.items()}
+            raise RollBack()
+    except RollBack:
+        pass
+    return plans
+
+
+class RollBack(Exception):
+    pass
+
+
+def upgrade(db, migrations, create_tables, queries, dry_run=False):
+    # Brings the database up to the newest migration in one transaction:
+    # SQLite's ALTER TABLE, CREATE INDEX and ANALYZE are all transactional,
+    # so a failed upgrade leaves the old schema untouched and a dry run can
+    # apply everything for real and then roll it back.
+    latest = max(migration.version for migration in migrations)
+    if not db.table_exists('user'):
+        if not dry_run:
+            with db.atomic():
+                create_tables()
+                set_schema_version(db, latest)
+        return MigrationReport(0, latest, created=True, dry_run=dry_run)
+
+    version = schema_version(db)
+    pending = [migration for migration in sorted(migrations, key=lambda m: m.version)
+               if migration.version > version]
+    report = MigrationReport(version, latest if pending else version, dry_run=dry_run)
+    before = index_schema(db)
+    try:
+        with db.atomic():
+            for migration in pending:
+                started = time.perf_counter()
+                migration.apply(db)
+                report.applied.append((migration, time.perf_counter() - started))
+            # tables added since, with their indexes
+            create_tables()
+            if pending:
+                db.execute_sql('ANALYZE')
+                set_schema_version(db, latest)
+                # the queries as they are now, planned on the old indexes
+                # and on the new ones
+                statements = query_statements(db, queries)
+                old_plans = planned_with(db, before, statements)
+                report.plans = {name: (old_plans[name], explain(db, statements[name])) for name in queries}
+            if dry_run:
+                raise RollBack()
+    except RollBack:
+        pass
+    return report
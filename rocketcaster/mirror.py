@@ -0,0 +1,196 @@
+import json
+import time
+import threading
+from collections import Counter
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from twisted.python import log
+from .models import Feed, Episode, FeedSearch, EpisodeSearch
+from .database import write, write_later
+
+MIN_INTERVAL = 60 * 10  # seconds between refreshes of the most viewed feeds
+MAX_INTERVAL = 60 * 60 * 24  # and of feeds nobody looks at
+SCORE_HALF_LIFE = 60 * 60 * 24  # view counts halve daily so popularity follows current interest
+DECAY_INTERVAL = 60 * 60
+
+
+def completed(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def refresh_interval(score):
+    seconds = MAX_INTERVAL / (1 + (score or 0))
+    return timedelta(seconds=min(max(seconds, MIN_INTERVAL), MAX_INTERVAL))
+
+
+class Mirror:
+    # Feed and episode metadata for anything that was viewed or shared is
+    # kept in the database and read from there first. A background thread
+    # refreshes it from podcastindex, popular feeds more often than cold
+    # ones, and keeps the last known copy when upstream fails.
+    def __init__(self, index, tick=60, batch=20):
+        self.index = index
+        self.tick = tick
+        self.batch = batch
+        self.views = Counter()
+        self.last_decay = time.monotonic()
+        self.thread = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshed = 0
+        self.refresh_errors = 0
+        self.lock = threading.Lock()
+
+    def feed(self, feed_id):
+        return self.submit_feed(feed_id).result()
+
+    def episode(self, episode_id):
+        return self.submit_episode(episode_id).result()
+
+    def submit_feed(self, feed_id):
+        # results have the same shape as the podcastindex responses
+        self.viewed(feed_id)
+        record = Feed.get_or_none(Feed.id == feed_id)
+        if record is not None:
+            self.hits += 1
+            return completed({'feed': json.loads(record.data)})
+
+        self.misses += 1
+        future = self.index.submit('podcastByFeedId', feedId=feed_id)
+        return self.index.then(future, lambda result: completed(self.store_feed(result)))
+
+    def submit_episode(self, episode_id):
+        record = Episode.get_or_none(Episode.id == episode_id)
+        if record is not None:
+            self.hits += 1
+            self.viewed(record.feed_id)
+            return completed({'episode': json.loads(record.data)})
+
+        self.misses += 1
+        future = self.index.submit('episodeById', id=episode_id)
+        return self.index.then(future, lambda result: completed(self.store_episode(result)))
+
+    def viewed(self, feed_id):
+        with self.lock:
+            self.views[int(feed_id)] += 1
+
+    def store_feed(self, result):
+        # the caller has the result already, so it doesn't wait for the write
+        feed = result['feed']
+        if feed:
+            write_later(self.write_feed, feed)
+        return result
+
+    def store_episode(self, result):
+        episode = result['episode']
+        if episode:
+            write_later(self.write_episode, episode)
+            self.viewed(episode['feedId'])
+        return result
+
+    @staticmethod
+    def write_feed(feed):
+        now = datetime.now()
+        (Feed.insert(id=feed['id'], data=json.dumps(feed), fetched=now,
+                     next_refresh=now + refresh_interval(0))
+         .on_conflict(conflict_target=[Feed.id], preserve=[Feed.data, Feed.fetched])
+         .execute())
+        FeedSearch.add(feed)
+
+    @staticmethod
+    def write_episode(episode):
+        now = datetime.now()
+        (Episode.insert(id=episode['id'], feed_id=episode['feedId'], data=json.dumps(episode),
+                        fetched=now, next_refresh=now + refresh_interval(0))
+         .on_conflict(conflict_target=[Episode.id], preserve=[Episode.data, Episode.fetched])
+         .execute())
+        EpisodeSearch.add(episode)
+
+    def start(self, refresh=True):
+        # with several server processes only one refreshes the mirror, they
+        # all record views
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, args=(refresh,), name='mirror', daemon=True)
+            self.thread.start()
+
+    def run(self, refresh):
+        while True:
+            time.sleep(self.tick)
+            try:
+                self.flush_views()
+                if refresh:
+                    self.refresh_due()
+            except Exception:
+                log.err(None, 'Error refreshing the podcast mirror')
+
+    def flush_views(self):
+        with self.lock:
+            views, self.views = self.views, Counter()
+
+        elapsed = time.monotonic() - self.last_decay
+        decay = elapsed >= DECAY_INTERVAL
+        if views or decay:
+            write(self.write_views, views, elapsed if decay else None)
+        if decay:
+            self.last_decay = time.monotonic()
+
+    @staticmethod
+    def write_views(views, elapsed):
+        if elapsed is not None:
+            Feed.update(score=Feed.score * 0.5 ** (elapsed / SCORE_HALF_LIFE)).execute()
+
+        # feeds that just got popular shouldn't wait out a long interval
+        for feed in Feed.select().where(Feed.id << list(views)):
+            feed.score += views[feed.id]
+            feed.next_refresh = min(feed.next_refresh, feed.fetched + refresh_interval(feed.score))
+            feed.save(only=[Feed.score, Feed.next_refresh])
+
+    def refresh_due(self):
+        now = datetime.now()
+        for feed in list(Feed.due(now, self.batch)):
+            data, next_refresh = self.refresh(self.index.client.podcastByFeedId, 'feed', feed.score, feedId=feed.id)
+            write(self.write_refreshed_feed, feed.id, data, now, next_refresh)
+
+        for episode in list(Episode.due(now, self.batch)):
+            data, next_refresh = self.refresh(self.index.client.episodeById, 'episode', episode.score, id=episode.id)
+            write(self.write_refreshed_episode, episode.id, data, now, next_refresh)
+
+    @staticmethod
+    def write_refreshed_feed(feed_id, data, now, next_refresh):
+        update = {Feed.next_refresh: next_refresh}
+        if data:
+            update.update({Feed.data: json.dumps(data), Feed.fetched: now})
+            FeedSearch.add(data)
+        Feed.update(update).where(Feed.id == feed_id).execute()
+
+    @staticmethod
+    def write_refreshed_episode(episode_id, data, now, next_refresh):
+        update = {Episode.next_refresh: next_refresh}
+        if data:
+            update.update({Episode.data: json.dumps(data), Episode.fetched: now})
+            EpisodeSearch.add(data)
+        Episode.update(update).where(Episode.id == episode_id).execute()
+
+    def refresh(self, lookup, key, score, **kwargs):
+        # on failure the last known copy stays in place and is retried soon;
+        # an empty result (removed upstream) keeps it too
+        now = datetime.now()
+        try:
+            data = lookup(**kwargs)[key]
+        except Exception:
+            self.refresh_errors += 1
+            return None, now + timedelta(seconds=MIN_INTERVAL)
+        self.refreshed += 1
+        return data, now + refresh_interval(score)
+
+    def stats(self):
+        return {
+            'feeds': Feed.select().count(),
+            'episodes': Episode.select().count(),
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshed': self.refreshed,
+            'refresh_errors': self.refresh_errors,
+        }
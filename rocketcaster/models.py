@@ -1,23 +1,140 @@
+import re
+import json
+from collections import Counter, defaultdict
 from datetime import datetime
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
+from playhouse.sqlite_ext import FTS5Model, SearchField, RowIDField
+from .gemtext import strip_formatting_main, strip_formatting_post
+from .database import Database, init_writer
+from .migrations import Migration, upgrade
 
+HTML_TAG = re.compile(r'<[^>]+>')
+SEARCH_TERM = re.compile(r'\w+')
 
-def init_db(db_path):
-    db = SqliteDatabase(db_path)
-    model_list = [User, Certificate, Post, Comment, Notification]
-    db.bind(model_list)
-    db.create_tables(model_list)
+
+def init_db(db_path, dry_run=False):
+    db = Database(db_path)
+    db.bind(MODELS)
+    report = upgrade(db, MIGRATIONS, lambda: db.create_tables(MODELS), HOT_QUERIES, dry_run)
+    if not dry_run:
+        build_search_index(db)
+        init_writer(db)
+    return report
+
+
+# Schema changes for databases created by older versions, applied in order
+# by migrations.upgrade. New databases are created at the latest version,
+# so anything added here must be declared on the models as well. Each one
+# may find its change already made by a version that predates numbering.
+
+def add_user_name_lower(db):
+    if 'name_lower' not in [column.name for column in db.get_columns('user')]:
+        migrate(SqliteMigrator(db).add_column('user', 'name_lower', TextField(null=True)))
+        User.update(name_lower=fn.LOWER(User.name)).execute()
+
+
+def add_post_formatting(db):
+    # gemtext formatting is applied once when posts and comments are written
+    if 'summary' not in [column.name for column in db.get_columns('post')]:
+        migrator = SqliteMigrator(db)
+        migrate(migrator.add_column('post', 'summary', TextField(null=True)),
+                migrator.add_column('post', 'formatted', TextField(null=True)))
+        for post in list(Post.select(Post.id, Post.content)):
+            Post.update(Post.formatting(post.content)).where(Post.id == post.id).execute()
+
+
+def add_comment_formatting(db):
+    if 'formatted' not in [column.name for column in db.get_columns('comment')]:
+        migrate(SqliteMigrator(db).add_column('comment', 'formatted', TextField(null=True)))
+        for comment in list(Comment.select(Comment.id, Comment.content)):
+            Comment.update(Comment.formatting(comment.content)).where(Comment.id == comment.id).execute()
+
+
+def add_notification_counts(db):
+    if 'notification_count' not in [column.name for column in db.get_columns('user')]:
+        migrate(SqliteMigrator(db).add_column('user', 'notification_count', IntegerField(null=True)))
+    counts = Notification.select(fn.COUNT(Notification.id)).where(Notification.user == User.id)
+    User.update(notification_count=counts).execute()
+
+
+def add_hot_path_indexes(db):
+    # indexes in the order the hot queries sort, each replacing the single
+    # column index it starts with
+    for sql in ('CREATE INDEX IF NOT EXISTS "post_created_id" ON "post" ("created", "id")',
+                'CREATE INDEX IF NOT EXISTS "post_episode_id_created" ON "post" ("episode_id", "created")',
+                'CREATE INDEX IF NOT EXISTS "comment_post_id_created" ON "comment" ("post_id", "created")',
+                'CREATE INDEX IF NOT EXISTS "notification_user_id_created" ON "notification" ("user_id", "created")',
+                'DROP INDEX IF EXISTS "post_created"',
+                'DROP INDEX IF EXISTS "post_episode_id"',
+                'DROP INDEX IF EXISTS "comment_post_id"',
+                'DROP INDEX IF EXISTS "notification_user_id"'):
+        db.execute_sql(sql)
+
+
+MIGRATIONS = [
+    Migration(1, 'user.name_lower for case insensitive names', add_user_name_lower),
+    Migration(2, 'post.summary and post.formatted', add_post_formatting),
+    Migration(3, 'comment.formatted', add_comment_formatting),
+    Migration(4, 'indexes for the front page, archive, comments and notifications', add_hot_path_indexes),
+    Migration(5, 'user.notification_count', add_notification_counts),
+]
+
+# What a schema upgrade is checked against: the queries made on every page
+# view, run with placeholder arguments so their query plans can be compared
+# before and after.
+HOT_QUERIES = {
+    'front page': lambda: list(Post.most_recent()),
+    'archive page': lambda: Post.page(30, before=(datetime.now(), 0)),
+    'post comments': lambda: list(Comment.for_post(0)),
+    'post commenters': lambda: list(User.get_commenters(0)),
+    'notifications': lambda: Notification.page(0, 50, before=(datetime.now(), 0)),
+    'notification count': lambda: User.count_notifications(0),
+    'active discussion': lambda: Post.active_discussion(''),
+    'podcast discussions': lambda: Post.discussions_by_episode(''),
+    'login': lambda: User.login(''),
+    'feeds due': lambda: list(Feed.due(datetime.now(), 10)),
+    'episodes due': lambda: list(Episode.due(datetime.now(), 10)),
+}
+
+
+def build_search_index(db):
+    # index posts and mirrored feeds that existed before search did,
+    # everything after that is added as it is written
+    with db.atomic():
+        if not PostSearch.select().exists():
+            for post in Post.select():
+                PostSearch.add(post)
+        if not FeedSearch.select().exists():
+            for feed in Feed.select():
+                FeedSearch.add(json.loads(feed.data))
+        if not EpisodeSearch.select().exists():
+            for episode in Episode.select():
+                EpisodeSearch.add(json.loads(episode.data))
+
+
+def match_expression(query):
+    # every word must match; quoting keeps FTS5 operators out of user input
+    terms = SEARCH_TERM.findall(query)
+    return ' '.join(f'"{term}"' for term in terms) or None
+
+
+def strip_tags(text):
+    return HTML_TAG.sub(' ', text or '')
 
 
 class User(Model):
     name = TextField(unique=True)
+    name_lower = TextField(index=True)
     created = DateTimeField()
+    notification_count = IntegerField(default=0)  # kept up to date by Notification.add and remove
 
     @classmethod
     def register(cls, name):
         try:
             user = cls.create(
                 name=name,
+                name_lower=name.lower(),
                 created=datetime.now()
             )
             return user
@@ -26,7 +143,8 @@ class User(Model):
 
     @classmethod
     def login(cls, fingerprint):
-        query = Certificate.select().where(Certificate.fingerprint == fingerprint)
+        query = Certificate.select(Certificate, User).join(User).where(
+            Certificate.fingerprint == fingerprint)
 
         try:
             cert = query.get()
@@ -35,6 +153,16 @@ class User(Model):
 
         return cert
 
+    @classmethod
+    def by_names(cls, names):
+        names = [name.lower() for name in names]
+        return User.select().where(User.name_lower << names)
+
+    @classmethod
+    def count_notifications(cls, user_id):
+        # read fresh, sessions cache the rest of the user
+        return User.select(User.notification_count).where(User.id == user_id).scalar() or 0
+
     @classmethod
     def get_commenters(cls, post_id):
         query = User.select(User).join(Comment).where(
@@ -54,32 +182,284 @@ class Post(Model):
     author = ForeignKeyField(User, backref='posts')
     episode_id = TextField()
     episode_title = TextField()
-    podcast_id = TextField()
+    podcast_id = TextField(index=True)
     podcast_title = TextField()
     content = TextField()
+    summary = TextField()  # content as shown on the front page
+    formatted = TextField()  # content as shown on the post page
     created = DateTimeField()
 
+    class Meta:
+        indexes = (
+            (('created', 'id'), False),  # front page and archive, newest first
+            (('episode_id', 'created'), False),  # active discussions
+        )
+
+    @staticmethod
+    def formatting(content):
+        return {'summary': strip_formatting_main(content), 'formatted': strip_formatting_post(content)}
+
     @classmethod
     def most_recent(cls, count=15):
+        # authors and comment counts are loaded in the same query; counting
+        # per post rather than grouping every post lets the newest be read
+        # straight off the created index
+        comment_count = Comment.select(fn.COUNT(Comment.id)).where(Comment.post == Post.id)
+        query = (Post.select(Post, User, comment_count.alias('comment_count'))
+                 .join(User)
+                 .order_by(Post.created.desc()))
         if count != None:
-            return Post.select().order_by(Post.created.desc()).limit(count)
+            return query.limit(count)
         else:
-            return Post.select().order_by(Post.created.desc())
+            return query
+
+    @classmethod
+    def active_discussion(cls, episode_id, count=15):
+        # the newest post about the episode if it's still among the count
+        # most recent posts, i.e. on the front page
+        cutoff = (Post.select(Post.created)
+                  .order_by(Post.created.desc())
+                  .offset(count - 1)
+                  .limit(1))
+        return (Post.select(Post, User).join(User)
+                .where((Post.episode_id == episode_id) & (Post.created >= fn.COALESCE(cutoff, '')))
+                .order_by(Post.created.desc())
+                .first())
+
+    @classmethod
+    def discussions_by_episode(cls, podcast_id):
+        # one grouped query per podcast however many episodes are shown
+        query = (Post.select(Post.episode_id, fn.MAX(Post.id).alias('post_id'),
+                             fn.COUNT(fn.DISTINCT(Post.id)).alias('post_count'),
+                             fn.COUNT(Comment.id).alias('comment_count'))
+                 .join(Comment, JOIN.LEFT_OUTER)
+                 .where(Post.podcast_id == podcast_id)
+                 .group_by(Post.episode_id))
+        return {row.episode_id: row for row in query}
+
+    @classmethod
+    def page(cls, count, before=None, after=None):
+        # keyset pagination on (created, id), newest first
+        query = Post.select(Post, User).join(User)
+        if after is not None:
+            query = query.where(Tuple(Post.created, Post.id) > Tuple(*after))
+            return list(reversed(query.order_by(Post.created, Post.id).limit(count)))
+        if before is not None:
+            query = query.where(Tuple(Post.created, Post.id) < Tuple(*before))
+        return list(query.order_by(Post.created.desc(), Post.id.desc()).limit(count))
 
 
 class Comment(Model):
     author = ForeignKeyField(User, backref='comments')
-    post = ForeignKeyField(Post, backref='comments')
+    post = ForeignKeyField(Post, backref='comments', index=False)
     content = TextField()
+    formatted = TextField()
     created = DateTimeField()
 
+    class Meta:
+        indexes = (
+            (('post', 'created'), False),
+        )
+
+    @staticmethod
+    def formatting(content):
+        return {'formatted': strip_formatting_post(content)}
+
+    @classmethod
+    def for_post(cls, post_id):
+        return Comment.select(Comment, User).join(User).where(
+            Comment.post == post_id).order_by(Comment.created.desc())
+
 
 class Notification(Model):
-    user = ForeignKeyField(User, backref='notifications')
+    user = ForeignKeyField(User, backref='notifications', index=False)
     message = TextField()
     post = ForeignKeyField(Post, backref='mentions', null=True)
     comment = ForeignKeyField(Comment, backref='mentions', null=True)
     created = DateTimeField()
 
-    def clear(cls, user):
-        Notification.delete().where(Notification.user == user).execute()
+    class Meta:
+        indexes = (
+            (('user', 'created'), False),
+        )
+
+    @classmethod
+    def add(cls, rows):
+        # rows are dicts of fields; chunked to stay under SQLite's bound
+        # parameter limit
+        counts = Counter(row['user'] for row in rows)
+        with cls._meta.database.atomic():
+            for batch in chunked(rows, 100):
+                Notification.insert_many(batch).execute()
+            cls.update_counts(counts)
+
+    @classmethod
+    def remove(cls, condition):
+        with cls._meta.database.atomic():
+            counts = dict(Notification.select(Notification.user, fn.COUNT(Notification.id))
+                          .where(condition)
+                          .group_by(Notification.user)
+                          .tuples())
+            Notification.delete().where(condition).execute()
+            cls.update_counts({user_id: -count for user_id, count in counts.items()})
+
+    @staticmethod
+    def update_counts(counts):
+        # one statement per distinct change, usually +1 for every recipient
+        by_delta = defaultdict(list)
+        for user_id, count in counts.items():
+            if count:
+                by_delta[count].append(user_id)
+        for count, user_ids in by_delta.items():
+            for batch in chunked(user_ids, 500):
+                (User.update(notification_count=User.notification_count + count)
+                 .where(User.id.in_(batch))
+                 .execute())
+
+    @classmethod
+    def page(cls, user, count, before=None):
+        # keyset pagination on (created, id), newest first; the post each
+        # notification links to is resolved in the same query
+        query = (Notification.select(Notification.id, Notification.message, Notification.created,
+                                     fn.COALESCE(Notification.post, Comment.post).alias('target_id'))
+                 .join(Comment, JOIN.LEFT_OUTER, on=(Notification.comment == Comment.id))
+                 .where(Notification.user == user))
+        if before is not None:
+            query = query.where(Tuple(Notification.created, Notification.id) < Tuple(*before))
+        return list(query.order_by(Notification.created.desc(), Notification.id.desc()).limit(count))
+
+    @classmethod
+    def clear(cls, user, newest_id, count=500):
+        # deletes up to count of the user's notifications, none newer than
+        # newest_id, and returns how many; callers repeat it in separate
+        # transactions so clearing thousands doesn't hold up other writes
+        ids = [row.id for row in Notification.select(Notification.id)
+               .where((Notification.user == user) & (Notification.id <= newest_id))
+               .limit(count)]
+        if ids:
+            with cls._meta.database.atomic():
+                Notification.delete().where(Notification.id << ids).execute()
+                cls.update_counts({user.id: -len(ids)})
+        return len(ids)
+
+    @classmethod
+    def newest_id(cls, user):
+        return Notification.select(fn.MAX(Notification.id)).where(Notification.user == user).scalar()
+
+
+class Feed(Model):
+    # local copy of podcastindex feed metadata, refreshed in the background
+    id = IntegerField(primary_key=True)
+    data = TextField()  # the upstream feed as JSON
+    fetched = DateTimeField()
+    score = FloatField(default=0)  # decaying view count
+    next_refresh = DateTimeField(index=True)
+
+    @classmethod
+    def due(cls, now, count):
+        return Feed.select().where(Feed.next_refresh <= now).order_by(Feed.next_refresh).limit(count)
+
+
+class Episode(Model):
+    id = IntegerField(primary_key=True)
+    feed_id = IntegerField(index=True)
+    data = TextField()  # the upstream episode as JSON
+    fetched = DateTimeField()
+    next_refresh = DateTimeField(index=True)
+
+    @classmethod
+    def due(cls, now, count):
+        # episodes are refreshed as often as their feed is popular
+        return (Episode.select(Episode, Feed.score.alias('score'))
+                .join(Feed, JOIN.LEFT_OUTER, on=(Episode.feed_id == Feed.id))
+                .where(Episode.next_refresh <= now)
+                .order_by(Episode.next_refresh)
+                .limit(count)
+                .objects())
+
+
+class FeedSearch(FTS5Model):
+    # full text index over every feed we have seen, rowid is the feed id
+    rowid = RowIDField()
+    title = SearchField()
+    author = SearchField()
+    description = SearchField()
+    categories = SearchField()
+
+    class Meta:
+        options = {'tokenize': 'porter unicode61 remove_diacritics 2'}
+
+    @classmethod
+    def add(cls, feed):
+        categories = feed.get('categories') or {}
+        (cls.insert(rowid=feed['id'], title=feed.get('title') or '', author=feed.get('author') or '',
+                    description=strip_tags(feed.get('description')), categories=' '.join(categories.values()))
+         .on_conflict_replace()
+         .execute())
+
+    @classmethod
+    def ranked(cls, query, count):
+        expression = match_expression(query)
+        if expression is None:
+            return []
+        return list(cls.search_bm25(expression, weights={'title': 8.0, 'author': 4.0, 'categories': 2.0},
+                                    with_score=True).limit(count))
+
+
+class EpisodeSearch(FTS5Model):
+    rowid = RowIDField()  # episode id
+    feed_id = SearchField(unindexed=True)
+    title = SearchField()
+    feed_title = SearchField()
+    description = SearchField()
+
+    class Meta:
+        options = {'tokenize': 'porter unicode61 remove_diacritics 2'}
+
+    @classmethod
+    def add(cls, episode):
+        (cls.insert(rowid=episode['id'], feed_id=episode.get('feedId'), title=episode.get('title') or '',
+                    feed_title=episode.get('feedTitle') or '', description=strip_tags(episode.get('description')))
+         .on_conflict_replace()
+         .execute())
+
+    @classmethod
+    def ranked(cls, query, count):
+        expression = match_expression(query)
+        if expression is None:
+            return []
+        return list(cls.search_bm25(expression, weights={'title': 8.0, 'feed_title': 2.0},
+                                    with_score=True).limit(count))
+
+
+class PostSearch(FTS5Model):
+    rowid = RowIDField()  # post id
+    podcast_id = SearchField(unindexed=True)
+    podcast_title = SearchField()
+    episode_title = SearchField()
+    content = SearchField()
+
+    class Meta:
+        options = {'tokenize': 'porter unicode61 remove_diacritics 2'}
+
+    @classmethod
+    def add(cls, post):
+        (cls.insert(rowid=post.id, podcast_id=post.podcast_id, podcast_title=post.podcast_title,
+                    episode_title=post.episode_title, content=post.content)
+         .on_conflict_replace()
+         .execute())
+
+    @classmethod
+    def remove(cls, post_id):
+        cls.delete().where(cls.rowid == post_id).execute()
+
+    @classmethod
+    def ranked(cls, query, count):
+        expression = match_expression(query)
+        if expression is None:
+            return []
+        return list(cls.search_bm25(expression, weights={'podcast_title': 4.0, 'episode_title': 4.0},
+                                    with_score=True).limit(count))
+
+
+MODELS = [User, Certificate, Post, Comment, Notification, Feed, Episode, FeedSearch, EpisodeSearch, PostSearch]
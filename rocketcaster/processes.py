@@ -0,0 +1,333 @@
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import subprocess
+from jetforce import GeminiServer
+from jetforce.protocol import GeminiProtocol
+from jetforce.tls import GeminiCertificateOptions
+from twisted.internet import tcp
+from twisted.internet.protocol import connectionDone
+from twisted.internet.task import LoopingCall
+from twisted.protocols.tls import TLSMemoryBIOFactory
+
+HEARTBEAT = 2  # seconds between health reports
+DRAIN_POLL = 0.1
+CRASH_WINDOW = 10  # seconds; a worker exiting sooner is restarted with a backoff
+MAX_BACKOFF = 60
+
+
+def log_message(message):
+    # the same place jetforce logs to
+    print(message, file=sys.stderr, flush=True)
+
+
+def write_json(path, value):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(value, f)
+    os.replace(path + '.tmp', path)
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def health_path(run_dir, pid):
+    return os.path.join(run_dir, f'worker-{pid}.json')
+
+
+def read_health(run_dir):
+    # the latest report of every worker, by pid
+    health = {}
+    for name in os.listdir(run_dir):
+        if name.startswith('worker-') and name.endswith('.json'):
+            try:
+                with open(os.path.join(run_dir, name)) as f:
+                    status = json.load(f)
+            except (OSError, ValueError):  # removed or replaced meanwhile
+                continue
+            health[status['pid']] = status
+    return health
+
+
+class ReusePort(tcp.Port):
+    # lets every worker bind the same address; the kernel spreads new
+    # connections across them
+    def createInternetSocket(self):
+        skt = super().createInternetSocket()
+        skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        return skt
+
+
+class TrackedProtocol(GeminiProtocol):
+    def connectionMade(self):
+        self.server.connections.add(self)
+        super().connectionMade()
+
+    def connectionLost(self, reason=connectionDone):
+        self.server.connections.discard(self)
+        super().connectionLost(reason)
+
+    def build_environ(self):
+        # lets response bodies wait for the connection to drain, see workers.paced
+        environ = super().build_environ()
+        environ['rocketcaster.transport'] = self.transport
+        return environ
+
+
+class Server(GeminiServer):
+    # jetforce's server, able to share its port with other processes and to
+    # stop gracefully: on SIGTERM it stops accepting connections and gives
+    # the open ones up to drain_timeout seconds to finish
+    protocol_class = TrackedProtocol
+
+    def __init__(self, app, reuse_port=False, drain_timeout=30, **kwargs):
+        super().__init__(app, **kwargs)
+        self.reuse_port = reuse_port
+        self.drain_timeout = drain_timeout
+        self.connections = set()
+        self.ports = []
+        self.draining = False
+
+    def bind_interface(self, interface):
+        factory = self
+        if self.use_tls:
+            options = GeminiCertificateOptions(certfile=self.certfile, keyfile=self.keyfile,
+                                               cafile=self.cafile, capath=self.capath)
+            factory = TLSMemoryBIOFactory(options, False, self)
+        port_class = ReusePort if self.reuse_port else tcp.Port
+        port = port_class(self.port, factory, interface=interface, reactor=self.reactor)
+        port.startListening()
+        self.ports.append(port)
+        self.on_bind_interface(port)
+
+    def run(self):
+        # replaces the reactor's own handler, which stops it straight away
+        self.reactor.callWhenRunning(
+            signal.signal, signal.SIGTERM, lambda *_: self.reactor.callFromThread(self.drain))
+        super().run()
+
+    def drain(self):
+        if self.draining:
+            return
+        self.draining = True
+        self.log_message(f'Stopping, waiting for {len(self.connections)} open connections')
+        for port in self.ports:
+            port.stopListening()
+        deadline = time.monotonic() + self.drain_timeout
+
+        def check():
+            if not self.connections or time.monotonic() >= deadline:
+                poll.stop()
+                self.reactor.stop()
+
+        poll = LoopingCall(check)
+        poll.start(DRAIN_POLL)
+
+
+class Health:
+    # A worker reports to the supervisor by rewriting a small JSON file in
+    # the run directory every HEARTBEAT seconds; one that stops doing so is
+    # considered hung.
+    def __init__(self, run_dir, index, server, stats):
+        self.path = health_path(run_dir, os.getpid())
+        self.index = index
+        self.server = server
+        self.stats = stats  # called for the rest of the report
+        self.started = time.time()
+        self.supervisor = os.getppid()
+
+    def start(self):
+        # only once the reactor runs, so the first report means it's serving
+        self.server.reactor.callWhenRunning(LoopingCall(self.report).start, HEARTBEAT)
+
+    def report(self):
+        if os.getppid() != self.supervisor:
+            # nothing would restart or stop this worker any more
+            self.server.log_message('Supervisor exited, stopping')
+            self.server.drain()
+        write_json(self.path, {
+            'index': self.index,
+            'pid': os.getpid(),
+            'started': self.started,
+            'heartbeat': time.time(),
+            'state': 'draining' if self.server.draining else 'serving',
+            'connections': len(self.server.connections),
+            **self.stats(),
+        })
+
+
+class Worker:
+    def __init__(self, index, process):
+        self.index = index
+        self.process = process
+        self.started = time.time()
+
+
+class Supervisor:
+    # Runs count copies of the server sharing one port. Workers that exit or
+    # stop reporting are replaced, and on SIGHUP every worker is replaced one
+    # at a time, each only once its successor is serving, so a deploy never
+    # leaves the port unserved.
+    def __init__(self, command, count, run_dir, heartbeat_timeout=30, start_timeout=60, drain_timeout=30):
+        self.command = command  # a worker's command line, without its index
+        self.count = count
+        self.run_dir = run_dir
+        self.heartbeat_timeout = heartbeat_timeout
+        self.start_timeout = start_timeout
+        self.drain_timeout = drain_timeout
+        self.workers = {}  # index -> Worker
+        self.retiring = []  # (Worker, deadline) draining after a restart
+        self.backoff = {}  # index -> (failures, restart at)
+        self.restarts = 0
+        self.stopping = False
+        self.reloading = False
+
+    def spawn(self, index):
+        process = subprocess.Popen(self.command + ['--worker-index', str(index)])
+        log_message(f'Started worker {index} (pid {process.pid})')
+        return Worker(index, process)
+
+    def run(self, ready=None):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        for index in range(self.count):
+            self.workers[index] = self.spawn(index)
+        serving = sum(self.wait_until_serving(worker) for worker in list(self.workers.values()))
+        log_message(f'{serving} of {self.count} workers serving')
+        if ready is not None:
+            ready()
+        while not self.stopping:
+            time.sleep(1)
+            if self.reloading:
+                self.reloading = False
+                self.rolling_restart()
+            self.check()
+            self.write_status()
+        self.shutdown()
+
+    def stop(self, *_):
+        self.stopping = True
+
+    def reload(self, *_):
+        self.reloading = True
+
+    def check(self):
+        health = read_health(self.run_dir)
+        now = time.time()
+        for index in range(self.count):
+            worker = self.workers.get(index)
+            if worker is None:
+                if now >= self.backoff[index][1]:
+                    self.workers[index] = self.spawn(index)
+                continue
+
+            code = worker.process.poll()
+            if code is None:
+                status = health.get(worker.process.pid)
+                if status is not None:
+                    hung = now - status['heartbeat'] > self.heartbeat_timeout
+                else:
+                    hung = now - worker.started > self.start_timeout
+                if not hung:
+                    continue
+                log_message(f'Worker {index} (pid {worker.process.pid}) stopped responding, killing it')
+                worker.process.kill()
+                worker.process.wait()
+            else:
+                log_message(f'Worker {index} (pid {worker.process.pid}) exited with status {code}')
+            self.forget(worker)
+            self.restarts += 1
+
+            if now - worker.started < CRASH_WINDOW:
+                # one that keeps crashing on startup is retried less and less often
+                failures = self.backoff.get(index, (0, 0))[0] + 1
+                delay = min(2 ** failures, MAX_BACKOFF)
+                log_message(f'Restarting worker {index} in {delay}s')
+                self.backoff[index] = (failures, now + delay)
+                del self.workers[index]
+            else:
+                self.backoff.pop(index, None)
+                self.workers[index] = self.spawn(index)
+
+        for worker, deadline in list(self.retiring):
+            if worker.process.poll() is None and time.monotonic() < deadline:
+                continue
+            if worker.process.poll() is None:
+                worker.process.kill()
+                worker.process.wait()
+            self.retiring.remove((worker, deadline))
+            self.forget(worker)
+
+    def rolling_restart(self):
+        log_message('Restarting workers')
+        for index in sorted(self.workers):
+            old = self.workers[index]
+            new = self.spawn(index)
+            if not self.wait_until_serving(new):
+                log_message(f'Worker {index} (pid {new.process.pid}) failed to start, keeping pid {old.process.pid}')
+                new.process.kill()
+                new.process.wait()
+                self.forget(new)
+                continue
+            self.workers[index] = new
+            self.retire(old)
+
+    def wait_until_serving(self, worker):
+        deadline = time.monotonic() + self.start_timeout
+        path = health_path(self.run_dir, worker.process.pid)
+        while time.monotonic() < deadline and not self.stopping:
+            if worker.process.poll() is not None:
+                return False
+            if os.path.exists(path):
+                return True
+            time.sleep(0.1)
+        return False
+
+    def retire(self, worker):
+        worker.process.send_signal(signal.SIGTERM)
+        self.retiring.append((worker, time.monotonic() + self.drain_timeout + 5))
+
+    def forget(self, worker):
+        remove(health_path(self.run_dir, worker.process.pid))
+
+    def shutdown(self):
+        log_message('Stopping workers')
+        for worker in self.workers.values():
+            self.retire(worker)
+        for worker, deadline in self.retiring:
+            try:
+                worker.process.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                worker.process.kill()
+                worker.process.wait()
+            self.forget(worker)
+        remove(os.path.join(self.run_dir, 'supervisor.json'))
+
+    def write_status(self):
+        # for operators and monitoring, alongside the workers' own reports
+        health = read_health(self.run_dir)
+        now = time.time()
+        workers = []
+        for index in range(self.count):
+            worker = self.workers.get(index)
+            status = health.get(worker.process.pid) if worker else None
+            workers.append({
+                'index': index,
+                'pid': worker.process.pid if worker else None,
+                'uptime': round(now - worker.started) if worker else None,
+                'heartbeat_age': round(now - status['heartbeat'], 1) if status else None,
+                'state': status['state'] if status else 'starting' if worker else 'waiting to restart',
+            })
+        write_json(os.path.join(self.run_dir, 'supervisor.json'), {
+            'pid': os.getpid(),
+            'workers': workers,
+            'restarts': self.restarts,
+            'retiring': len(self.retiring),
+        })
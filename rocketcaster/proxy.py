@@ -0,0 +1,337 @@
+import os
+import mmap
+import uuid
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import requests
+from jetforce import Response, Status
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from .transport import get_transport
+from .workers import WorkerPool
+
+CHUNK_SIZE = 1024 * 64
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+# reading a chunk can wait on the publisher for the whole read timeout, so
+# streams get threads of their own instead of the reactor's ten shared ones
+chunk_readers = WorkerPool(size=32, name='rocketcaster-episodes')
+# downloads write every chunk as it arrives, a temp file left alone this
+# long belongs to one that died with its process
+STALE_DOWNLOAD_SECONDS = 60 * 10
+
+
+class EpisodeStream:
+    # Chunks are only fetched from upstream when jetforce asks for the next
+    # piece of the body, so at most one chunk per download is held in memory
+    # and a slow gemini client slows down the upstream read.
+    def __init__(self, url, max_size, chunk_size=CHUNK_SIZE):
+        self.url = url
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.upstream = None
+        self.chunks = None
+        self.received = 0
+        self.finished = False
+
+    def open(self):
+        # blocks until the upstream headers arrive, call from a worker thread
+        try:
+            upstream = get_transport().get(self.url, stream=True)
+        except requests.RequestException:
+            return Response(Status.PROXY_ERROR, 'Error downloading episode')
+        if upstream.status_code != 200:
+            upstream.close()
+            return Response(Status.PROXY_ERROR, 'Error downloading episode')
+        content_length = upstream.headers.get('content-length')
+        if content_length and int(content_length) > self.max_size:
+            upstream.close()
+            return Response(Status.PROXY_ERROR, 'Episode file size is too large')
+
+        self.upstream = upstream
+        self.chunks = upstream.iter_content(self.chunk_size)
+        content_type = upstream.headers.get('content-type', DEFAULT_CONTENT_TYPE)
+        return Response(Status.SUCCESS, content_type, self)
+
+    def read_chunk(self):
+        try:
+            chunk = next(self.chunks)
+        except Exception:  # StopIteration or a dropped upstream connection
+            self.close()
+            return None
+
+        self.received += len(chunk)
+        if self.received > self.max_size:
+            self.close()
+            return None
+        return chunk
+
+    def close(self):
+        self.finished = True
+        if self.upstream is not None:
+            self.upstream.close()
+
+    def __iter__(self):
+        try:
+            while not self.finished:
+                yield chunk_readers.run(self.read_chunk)
+        finally:
+            self.close()
+
+
+class DownloadError(Exception):
+    pass
+
+
+class EpisodeDownload:
+    # A single upstream download into a temp file. Any number of readers can
+    # follow the file as it grows, so concurrent plays of an uncached episode
+    # share one request to the publisher.
+    def __init__(self, cache, key, url, max_size):
+        self.cache = cache
+        self.key = key
+        self.url = url
+        self.max_size = max_size
+        self.tmp_path = cache.path(key) + f'.{uuid.uuid4().hex}.tmp'
+        self.content_type = DEFAULT_CONTENT_TYPE
+        self.result = None
+        self.ready = threading.Event()
+        self.written = 0
+        self.finished = False
+        self.waiters = []
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        error = None
+        try:
+            self.fetch()
+        except DownloadError as e:
+            error = str(e)
+        except Exception:
+            error = 'Error downloading episode'
+        try:
+            self.cache.finish(self, success=error is None)
+        finally:
+            # readers waiting on the download are let go however it ended
+            if error is not None:
+                self.set_status(Status.PROXY_ERROR, error)
+            reactor.callFromThread(self.notify)
+
+    def fetch(self):
+        with get_transport().get(self.url, stream=True) as upstream:
+            if upstream.status_code != 200:
+                raise DownloadError('Error downloading episode')
+            content_length = upstream.headers.get('content-length')
+            if content_length and int(content_length) > self.max_size:
+                raise DownloadError('Episode file size is too large')
+            self.content_type = upstream.headers.get('content-type', DEFAULT_CONTENT_TYPE)
+
+            with open(self.tmp_path, 'wb') as f:
+                self.set_status(Status.SUCCESS, self.content_type)
+                for chunk in upstream.iter_content(CHUNK_SIZE):
+                    if self.written + len(chunk) > self.max_size:
+                        raise DownloadError('Episode file size is too large')
+                    f.write(chunk)
+                    f.flush()
+                    self.written += len(chunk)
+                    reactor.callFromThread(self.notify)
+
+    def set_status(self, status, meta):
+        if self.result is None:
+            self.result = (status, meta)
+            self.ready.set()
+
+    def notify(self):
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            waiter.callback(None)
+
+    def wait(self):
+        waiter = Deferred()
+        self.waiters.append(waiter)
+        return waiter
+
+    def response(self, timeout=None):
+        # blocks until the upstream headers arrive, call from a worker thread
+        if not self.ready.wait(timeout):
+            return Response(Status.PROXY_ERROR, 'Timed out downloading episode')
+        status, meta = self.result
+        if status != Status.SUCCESS:
+            return Response(status, meta)
+        return Response(status, meta, self.follow())
+
+    def follow(self):
+        try:
+            f = open(self.tmp_path, 'rb')
+        except FileNotFoundError:
+            # the download already finished and was moved into the cache
+            if self.key not in self.cache.entries:
+                return
+            f = open(self.cache.path(self.key), 'rb')
+
+        with f:
+            offset = 0
+            while True:
+                # finished is only set after the last write, so reading it
+                # first means everything up to written is all there is
+                finished = self.finished
+                if offset < self.written:
+                    chunk = os.pread(f.fileno(), CHUNK_SIZE, offset)
+                    offset += len(chunk)
+                    yield chunk
+                elif finished:
+                    break
+                else:
+                    yield self.wait()
+
+
+class EpisodeCache:
+    # Content-addressed episode files on disk, evicted least recently played
+    # first once max_bytes is exceeded.
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (size, content type)
+        self.size = 0
+        self.downloads = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def load(self):
+        # During a rolling restart the old worker still uses the directory,
+        # so its downloads are left alone and any of its files can go away
+        # while they're being listed.
+        blobs = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith('.tmp'):
+                    if os.stat(path).st_mtime < time.time() - STALE_DOWNLOAD_SECONDS:
+                        os.remove(path)
+                elif '.' not in name and os.path.exists(path + '.type'):
+                    blobs.append((os.stat(path).st_mtime, name))
+            except FileNotFoundError:
+                pass
+
+        for _, key in sorted(blobs):
+            try:
+                with open(self.path(key) + '.type') as f:
+                    content_type = f.read()
+                size = os.path.getsize(self.path(key))
+            except FileNotFoundError:
+                continue
+            self.entries[key] = (size, content_type)
+            self.size += size
+
+    @staticmethod
+    def key(episode_id, url):
+        return hashlib.sha256(f'{episode_id}\n{url}'.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def contains(self, episode_id, url):
+        key = self.key(episode_id, url)
+        with self.lock:
+            return key in self.entries or key in self.downloads
+
+    def open(self, episode_id, url, max_size, timeout=None):
+        key = self.key(episode_id, url)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                try:
+                    # open while locked so the file can't be evicted out from under us
+                    f = open(self.path(key), 'rb')
+                except FileNotFoundError:
+                    # evicted by another worker sharing the directory
+                    del self.entries[key]
+                    self.size -= entry[0]
+                    entry = None
+                else:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    os.utime(f.fileno())
+            if entry is None:
+                download = self.downloads.get(key)
+                if download is None:
+                    download = EpisodeDownload(self, key, url, max_size)
+                    self.downloads[key] = download
+                    self.misses += 1
+                    download.start()
+
+        if entry is not None:
+            size, content_type = entry
+            return Response(Status.SUCCESS, content_type, self.read(f, size))
+        return download.response(timeout)
+
+    def read(self, f, size):
+        with f:
+            if size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for offset in range(0, size, CHUNK_SIZE):
+                    yield mapped[offset:offset + CHUNK_SIZE]
+
+    def finish(self, download, success):
+        key = download.key
+        cached = success and download.written <= self.max_bytes
+        try:
+            if cached:
+                try:
+                    with open(self.path(key) + '.type', 'w') as f:
+                        f.write(download.content_type)
+                    os.replace(download.tmp_path, self.path(key))
+                except OSError:
+                    # a full disk, say: the readers got the episode, it just isn't kept
+                    cached = False
+            if not cached:
+                # readers keep their open handle, so unlinking here is safe
+                for path in (download.tmp_path, self.path(key) + '.type'):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+        finally:
+            # whatever happened on disk, the download is over, so readers
+            # stop following it and the next request starts a new one
+            with self.lock:
+                download.finished = True
+                self.downloads.pop(key, None)
+                if cached:
+                    self.entries[key] = (download.written, download.content_type)
+                    self.size += download.written
+                    self.evict()
+
+    def evict(self):
+        while self.size > self.max_bytes and self.entries:
+            key, (size, _) = self.entries.popitem(last=False)
+            self.size -= size
+            for path in (self.path(key), self.path(key) + '.type'):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'downloads': len(self.downloads),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+episode_cache = None
+
+
+def init_episode_cache(directory, max_bytes):
+    global episode_cache
+    episode_cache = EpisodeCache(directory, max_bytes)
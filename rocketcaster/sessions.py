@@ -0,0 +1,80 @@
+import time
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import timezone
+from .cache import Generations
+from .models import User, Certificate
+
+
+class Session(namedtuple('Session', ['cert_id', 'fingerprint', 'subject', 'not_valid_before', 'not_valid_after',
+                                     'user_id', 'user_name', 'user_name_lower', 'user_created'])):
+    __slots__ = ()
+
+    @classmethod
+    def from_certificate(cls, cert):
+        user = cert.user
+        return cls(cert.id, cert.fingerprint, cert.subject, cert.not_valid_before, cert.not_valid_after,
+                   user.id, user.name, user.name_lower, user.created)
+
+    def certificate(self):
+        # fresh model instances per request so views can't mutate the cached snapshot
+        user = User(id=self.user_id, name=self.user_name,
+                    name_lower=self.user_name_lower, created=self.user_created)
+        return Certificate(id=self.cert_id, user=user, fingerprint=self.fingerprint, subject=self.subject,
+                           not_valid_before=self.not_valid_before, not_valid_after=self.not_valid_after)
+
+
+class SessionCache:
+    # Maps client certificate fingerprints to sessions, including unknown
+    # fingerprints so unregistered visitors don't hit the database either.
+    def __init__(self, max_size=4096, ttl=60 * 5, generations=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generations = generations if generations is not None else Generations()
+        self.entries = OrderedDict()  # fingerprint -> (expires, generation, session or None)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def login(self, fingerprint):
+        now = time.time()
+        # read before the database, like PageCache.get_or_render
+        stamp = self.generations.get((f'session:{fingerprint}',))
+        with self.lock:
+            entry = self.entries.get(fingerprint)
+            if entry is not None and now < entry[0] and entry[1] == stamp:
+                self.entries.move_to_end(fingerprint)
+                self.hits += 1
+                return entry[2]
+
+        self.misses += 1
+        cert = User.login(fingerprint)
+        session = Session.from_certificate(cert) if cert is not None else None
+
+        expires = now + self.ttl
+        if session is not None and session.not_valid_after is not None:
+            # not_valid_after is stored as a naive UTC datetime
+            cert_expires = session.not_valid_after.replace(tzinfo=timezone.utc).timestamp()
+            expires = min(expires, cert_expires)
+
+        with self.lock:
+            self.entries[fingerprint] = (expires, stamp, session)
+            self.entries.move_to_end(fingerprint)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return session
+
+    def invalidate(self, fingerprint):
+        # bumped rather than dropped so other server processes see it too
+        self.generations.bump(f'session:{fingerprint}')
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,176 @@
+import time
+import random
+import threading
+from collections import defaultdict
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+import podcastindex.podcastindex
+from .metrics import metrics
+from .workers import time_left
+
+RETRY_STATUSES = (429, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class TransportBusy(requests.RequestException):
+    pass
+
+
+class Transport:
+    # One pooled, keep-alive session for all outbound HTTP. Connections are
+    # reused per host, every request gets a timeout, and idempotent requests
+    # are retried with jittered exponential backoff.
+    def __init__(self, connect_timeout=5, read_timeout=30, pool_size=16, max_connections=64,
+                 retries=2, backoff=0.25, user_agent='RocketCaster'):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_connections = max_connections
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.session.headers['User-Agent'] = user_agent
+        self.counters = defaultdict(lambda: defaultdict(int))
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def request(self, method, url, idempotent=None, **kwargs):
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        kwargs.setdefault('timeout', self.timeout)
+        host = urlsplit(url).netloc
+
+        # wait at most the connect timeout for a free connection slot
+        if not self.slots.acquire(timeout=self.timeout[0]):
+            self.counters[host]['rejected'] += 1
+            raise TransportBusy(f'Too many outbound connections to reach {host}')
+        with self.lock:
+            self.active += 1
+
+        started = time.perf_counter()
+        try:
+            response = self.send(method, url, host, idempotent, kwargs)
+        except BaseException:
+            self.release()
+            raise
+        finally:
+            metrics.record_upstream(host, time.perf_counter() - started)
+
+        if kwargs.get('stream'):
+            # streamed bodies keep their connection until the caller closes them
+            close = response.close
+
+            def release_on_close():
+                try:
+                    close()
+                finally:
+                    if response.__dict__.pop('_slot', None):
+                        self.release()
+
+            response._slot = True
+            response.close = release_on_close
+        else:
+            self.release()
+        return response
+
+    def send(self, method, url, host, idempotent, kwargs):
+        # Within a request handler every attempt, and the backoff between
+        # them, fits in the time the request has left, so an upstream that
+        # stops answering can't hold the worker past its route's timeout.
+        # Read timeouts aren't retried: a server that slow won't do better.
+        attempts = self.retries + 1 if idempotent else 1
+        timeout = kwargs['timeout']
+        for attempt in range(attempts):
+            remaining = time_left()
+            if remaining is not None:
+                if remaining <= 0:
+                    raise requests.Timeout(f'No time left to reach {host}')
+                connect_timeout, read_timeout = timeout
+                if not kwargs.get('stream'):
+                    # a streamed body is read long after the handler returns
+                    read_timeout = min(read_timeout, remaining)
+                kwargs['timeout'] = (min(connect_timeout, remaining), read_timeout)
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.ReadTimeout:
+                self.counters[host]['errors'] += 1
+                raise
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.counters[host]['errors'] += 1
+                response, error = None, e
+            else:
+                self.counters[host]['requests'] += 1
+                self.counters[host]['seconds'] += time.monotonic() - started
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+
+            delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+            remaining = time_left()
+            if attempt == attempts - 1 or (remaining is not None and delay >= remaining):
+                if response is None:
+                    raise error
+                return response
+            if response is not None:
+                response.close()
+            self.counters[host]['retries'] += 1
+            time.sleep(delay)
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+        self.slots.release()
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        pools = {}
+        for key in self.adapter.poolmanager.pools.keys():
+            pool = self.adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            pools[f'{key.key_scheme}://{key.key_host}:{key.key_port}'] = {
+                'connections': pool.num_connections,
+                'requests': pool.num_requests,
+                # the pool queue is padded with None for connections not yet opened
+                'idle': sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0,
+            }
+        return {
+            'active': self.active,
+            'max_connections': self.max_connections,
+            'pools': pools,
+            'hosts': {host: dict(counts) for host, counts in self.counters.items()},
+        }
+
+
+transport = None
+
+
+def get_transport():
+    global transport
+    if transport is None:
+        transport = Transport()
+    return transport
+
+
+def set_transport(new_transport):
+    global transport
+    transport = new_transport
+
+
+class PodcastIndexClient(podcastindex.podcastindex.PodcastIndex):
+    # podcastindex calls requests.post directly, send them through the
+    # shared transport and its timeouts instead. The API's POSTs are
+    # lookups, so they are safe to retry.
+    def _make_request_get_result_helper(self, url, payload):
+        headers = self._create_headers()
+        result = get_transport().post(url, headers=headers, data=payload, idempotent=True)
+        result.raise_for_status()
+        return result.json()
@@ -1,32 +1,112 @@
 import os
+import time
+import hashlib
 from datetime import datetime
 import typing
 import re
-import requests
 import jinja2
-from jetforce import JetforceApplication, Request, Response, Status, RateLimiter
+import requests
+from jetforce import JetforceApplication, Request, Response, Status
 from jetforce.app.base import EnvironDict, RoutePattern, RouteHandler
-from twisted.internet.threads import deferToThread
-from .models import User, Certificate, Post, Comment, Notification
+from .models import User, Certificate, Post, Comment, Notification, FeedSearch, EpisodeSearch, PostSearch
+from .cache import CachedIndex, PageCache, FeedEpisodes, LRUCache, SharedGenerations
+from .mirror import Mirror
+from .gemtext import html_to_gemtext
+from .sessions import SessionCache
+from .workers import WorkerPool
+from .metrics import metrics
+from .limits import RequestLimiter, StreamLimiter
+from .processes import read_health
+from . import database
+from .database import write, write_later, read_snapshot
+from . import proxy
+from .proxy import EpisodeStream
+from .transport import PodcastIndexClient, get_transport
 import podcastindex
 
 TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
 
+class Marker(str):
+    # text left in a cached page for personalize() to fill in
+    pass
+
+
+def strip_markers(value):
+    # NUL never belongs in gemtext, removing it from everything else that's
+    # rendered keeps posts or episode titles from faking a marker
+    if isinstance(value, str) and not isinstance(value, Marker):
+        return value.replace('\x00', '')
+    return value
+
+
 template_env = jinja2.Environment(
     loader=jinja2.FileSystemLoader(TEMPLATE_DIR),
     undefined=jinja2.StrictUndefined,
     trim_blocks=True,
     lstrip_blocks=True,
+    finalize=strip_markers,
 )
 
-# $PODCAST_INDEX_API_KEY and $PODCAST_INDEX_API_SECRET
-pi_config = podcastindex.get_config_from_env()
-index = podcastindex.init(pi_config)
+# seconds before a cached podcastindex response is considered stale
+UPSTREAM_TTLS = {
+    'podcastByFeedId': 60 * 60,
+    'episodesByFeedId': 60 * 15,
+    'episodeById': 60 * 60 * 6,
+    'search': 60 * 10,
+}
+
+
+def podcastindex_client():
+    # $PODCAST_INDEX_API_KEY and $PODCAST_INDEX_API_SECRET
+    pi_config = podcastindex.get_config_from_env()
+    return PodcastIndexClient(pi_config)
+
+
+index = CachedIndex(podcastindex_client, UPSTREAM_TTLS)
 
 RESERVED_NAMES = ['admin', 'all']
+MENTION_REGEX = re.compile(r"(?:^|[^\w\d])(?:@)([a-zA-Z0-9_-]+)")
 MAX_FILE_SIZE = 1024 * 1024 * 200  # 200MB max file size for proxied episodes
+UPSTREAM_TIMEOUT = 15  # seconds before routes waiting on podcastindex give up
+PROXY_TIMEOUT = 30  # seconds to wait for an episode download to start
+ARCHIVE_PAGE_SIZE = 50
+NOTIFICATIONS_PAGE_SIZE = 50
+NOTIFICATIONS_CLEAR_CHUNK = 500
+PODCAST_PAGE_SIZE = 50
+MAX_PODCAST_PAGES = 20  # podcastindex returns at most 1000 episodes per lookup
+ARCHIVE_STREAM_BATCH = 500  # posts fetched and written at a time in the full archive
+
+mirror = Mirror(index)
+feed_episodes = FeedEpisodes(index, UPSTREAM_TTLS['episodesByFeedId'], count=PODCAST_PAGE_SIZE)
+
+# converted show notes, keyed by episode and a hash of the description
+description_cache = LRUCache(max_bytes=1024 * 1024 * 16, sizeof=len)
+
+SEARCH_RESULTS = 20
+MIN_LOCAL_RESULTS = 5  # fewer local feed matches than this also asks upstream
+SEARCHED_TTL = 60 * 60 * 24  # seconds before a term is looked up upstream again
+searched_terms = LRUCache(max_bytes=1024 * 1024)
+
+# plays that start an upstream download, per certificate or address
+play_limiter = RequestLimiter(2, 60)
+# concurrent plays and their share of the bandwidth, set from main.py
+play_streams = StreamLimiter()
+search_limiter = RequestLimiter(20, 60, burst=10)
+
+sessions = SessionCache()
+
+# rendered pages are shared between users and expire after this many seconds
+# so relative timestamps don't drift too far
+PAGE_CACHE_TTL = 60
+page_cache = PageCache(ttl=PAGE_CACHE_TTL)
+
+# the supervisor's run directory when running several server processes
+run_dir = None
 
-proxy_rate_limiter = RateLimiter('2/m')
+# per-user parts of a cached page are rendered as these markers and
+# filled in for each request by personalize()
+USER_BLOCK = Marker('\x00user\x00')
+OWNER_LINE = re.compile('^\x00owner:([0-9]+)\x00(.*\n?)', re.MULTILINE)
 
 
 def readable_timedelta(value):
@@ -73,84 +153,109 @@ def timestamp_to_date(value):
     return datetime.fromtimestamp(value).strftime('%Y-%m-%d')
 
 
-def strip_formatting_main(text):
-    regex = r"(^(#+)|(=>)|(```)|(\*)|(>)|(^\n))"
-    return re.sub(regex, '', text, flags=re.MULTILINE)
-
-
-def strip_formatting_post(text):
-    regex = r"(^(#+)|(```))"
-    return re.sub(regex, '', text, flags=re.MULTILINE)
-
-
-def strip_html(text):
-    p_regex = r"(?<!^)<p>"
-    br_regex = r"(?<!^)<br ?/?>"
-    strip_regex = r"</? ?[a-zA-Z0-9]* ?/?>"
-    text = re.sub(r"\n", '', text)
-    text = re.sub(p_regex, '\n\n', text)
-    text = re.sub(br_regex, '\n', text)
-    text = re.sub(strip_regex, '', text)
-    return text
-
-
 template_env.filters['readable_timedelta'] = readable_timedelta
 template_env.filters['readable_duration'] = readable_duration
 template_env.filters['timestamp_to_date'] = timestamp_to_date
-template_env.filters['strip_formatting_main'] = strip_formatting_main
-template_env.filters['strip_formatting_post'] = strip_formatting_post
-template_env.filters['strip_html'] = strip_html
+template_env.globals['user_block'] = USER_BLOCK
+template_env.globals['owner_only'] = lambda author_id: Marker(f'\x00owner:{author_id}\x00')
 
 
 def parse_mentions(post=None, comment=None):
-    regex = "(?:^|[^\w\d])(?:@)([a-zA-Z0-9_-]+)"
+    content = post.content if post is not None else comment.content
+    usernames = {username.lower() for username in MENTION_REGEX.findall(content)}
+    if not usernames:
+        return
+
+    now = datetime.now()
+    notifications = []
     if post is not None:
-        usernames = re.findall(regex, post.content)
-        for username in usernames:
-            try:
-                user = User.select().where(User.name ** username).get()
-            except:
-                user = None
-            if user is not None:
-                Notification.create(
-                    user=user,
-                    post=post,
-                    message=f"{post.author.name} mentioned you in a post",
-                    created=datetime.now()
-                )
+        for user in User.by_names(usernames):
+            notifications.append({
+                'user': user.id,
+                'post': post.id,
+                'message': f"{post.author.name} mentioned you in a post",
+                'created': now,
+            })
     elif comment is not None:
-        usernames = re.findall(regex, comment.content)
-        for username in usernames:
-            if str.lower(username) == 'all':
-                try:
-                    users = User.get_commenters(comment.post.id)
-                except:
-                    users = []
-                for user in users:
-                    if user == comment.post.author or user == comment.author:
-                        continue
-                    Notification.create(
-                        user=user,
-                        comment=comment,
-                        message=f"{comment.author.name} mentioned you in a comment by tagging @all",
-                        created=datetime.now()
-                    )
-            else:
-                try:
-                    user = User.select().where(User.name ** username).get()
-                except:
-                    user = None
-                if user is not None:
-                    Notification.create(
-                        user=user,
-                        comment=comment,
-                        message=f"{comment.author.name} mentioned you in a comment",
-                        created=datetime.now()
-                    )
+        tag_all = 'all' in usernames
+        usernames.discard('all')
+        mentioned = set()
+        for user in User.by_names(usernames):
+            mentioned.add(user.id)
+            notifications.append({
+                'user': user.id,
+                'comment': comment.id,
+                'message': f"{comment.author.name} mentioned you in a comment",
+                'created': now,
+            })
+        if tag_all:
+            skipped = mentioned | {comment.post.author_id, comment.author_id}
+            for user in User.get_commenters(comment.post_id):
+                if user.id in skipped:
+                    continue
+                notifications.append({
+                    'user': user.id,
+                    'comment': comment.id,
+                    'message': f"{comment.author.name} mentioned you in a comment by tagging @all",
+                    'created': now,
+                })
+
+    Notification.add(notifications)
+
+
+def init_processes(directory, index):
+    # every server process's caches are invalidated through one shared
+    # table, so a write in any of them is seen by all
+    global run_dir
+    run_dir = directory
+    generations = SharedGenerations(os.path.join(directory, 'generations'))
+    page_cache.generations = generations
+    sessions.generations = generations
+    metrics.worker = index
+
+
+def precompile_templates(cache_dir=None):
+    # compiles every template up front instead of on the first request
+    # that uses it; with cache_dir the bytecode is kept on disk so later
+    # starts skip compiling as well
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # not jinja's default file names, which may hold bytecode compiled
+        # before the environment had strip_markers
+        template_env.bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir, 'rocketcaster-%s.cache')
+    names = template_env.list_templates()
+    for name in names:
+        template_env.get_template(name)
+    return len(names)
+
+
+def episode_description(episode_id, description, link=None):
+    # relative links in the show notes are relative to the episode's page
+    key = (episode_id, link, hashlib.blake2b(description.encode(), digest_size=16).digest())
+    entry = description_cache.get(key)
+    if entry is not None:
+        return entry.value
+    text = html_to_gemtext(description, link)
+    description_cache.set(key, text, ttl=float('inf'))
+    return text
 
 
 def render_template(name: str, *args, **kwargs) -> str:
-    return template_env.get_template(name).render(*args, **kwargs)
+    started = time.perf_counter()
+    try:
+        return template_env.get_template(name).render(*args, **kwargs)
+    finally:
+        metrics.record_render(time.perf_counter() - started)
+
+
+def personalize(body, user, user_block=''):
+    user_id = user.id if user else None
+
+    def owner_line(match):
+        return match.group(2) if int(match.group(1)) == user_id else ''
+
+    body = OWNER_LINE.sub(owner_line, body)
+    return body.replace(USER_BLOCK + '\n', user_block)
 
 
 class AuthenticatedRequest(Request):
@@ -172,22 +277,56 @@ class AuthenticatedRequest(Request):
 
 
 class RocketCasterApplication(JetforceApplication):
-    def auth_route(self, path):
+    def __init__(self, workers=None, upstream_workers=None, **kwargs):
+        super().__init__(**kwargs)
+        self.workers = workers if workers is not None else WorkerPool()
+        # routes waiting on podcastindex or episode hosts get their own few
+        # threads, so a slow upstream can't take the ones serving local pages
+        self.upstream_workers = (upstream_workers if upstream_workers is not None
+                                 else WorkerPool(size=4, max_queue=32, name='rocketcaster-upstream'))
+        self.metrics = metrics
+
+    def add_route(self, route_pattern, func, timeout, upstream=False):
+        # requests are timed per route pattern, from the worker queue until
+        # the last byte of the body is written
+        workers = self.upstream_workers if upstream else self.workers
+        traced_func = self.metrics.wrap(route_pattern.path or '/', read_snapshot(func), workers.error_status)
+        self.routes.append((route_pattern, workers.wrap(traced_func, timeout)))
+
+    def route(self, path='.*', timeout=None, upstream=False, **kwargs):
+        route_pattern = RoutePattern(path, **kwargs)
+
+        def wrap(func: RouteHandler):
+            self.add_route(route_pattern, func, timeout, upstream)
+            return func
+
+        return wrap
+
+    def auth_route(self, path, timeout=None, upstream=False):
         route_pattern = RoutePattern(path)
 
         def wrap(func: RouteHandler):
             authenticated_func = authenticated_route(func)
-            app.routes.append((route_pattern, authenticated_func))
+            self.add_route(route_pattern, authenticated_func, timeout, upstream)
             return func
 
         return wrap
 
-    def optional_auth_route(self, path):
+    def optional_auth_route(self, path, timeout=None):
         route_pattern = RoutePattern(path)
 
         def wrap(func: RouteHandler):
             authenticated_func = optional_authenticated_route(func)
-            app.routes.append((route_pattern, authenticated_func))
+            self.add_route(route_pattern, authenticated_func, timeout)
+            return func
+
+        return wrap
+
+    def operator_route(self, path, timeout=None):
+        route_pattern = RoutePattern(path)
+
+        def wrap(func: RouteHandler):
+            self.add_route(route_pattern, operator_route(func), timeout)
             return func
 
         return wrap
@@ -201,11 +340,11 @@ def authenticated_route(func: RouteHandler):
             fingerprint = typing.cast(
                 str, request.environ['TLS_CLIENT_HASH_B64'])
 
-        cert = User.login(fingerprint)
-        if cert is None:
+        session = sessions.login(fingerprint)
+        if session is None:
             return Response(Status.REDIRECT_TEMPORARY, '/register')
 
-        request = AuthenticatedRequest(request.environ, cert)
+        request = AuthenticatedRequest(request.environ, session.certificate())
         response = func(request, **kwargs)
         return response
 
@@ -219,7 +358,8 @@ def optional_authenticated_route(func: RouteHandler):
         else:
             fingerprint = typing.cast(
                 str, request.environ['TLS_CLIENT_HASH_B64'])
-            cert = User.login(fingerprint)
+            session = sessions.login(fingerprint)
+            cert = session.certificate() if session is not None else None
         request = AuthenticatedRequest(request.environ, cert)
         response = func(request, **kwargs)
         return response
@@ -227,91 +367,166 @@ def optional_authenticated_route(func: RouteHandler):
     return wrapped
 
 
+def operator_route(func: RouteHandler):
+    # operators are recognised by certificate fingerprint alone, set with
+    # --operator, so the pages work without a registered account
+    def wrapped(request: Request, **kwargs):
+        if 'REMOTE_USER' not in request.environ:
+            return Response(Status.CLIENT_CERTIFICATE_REQUIRED, "You must attach a client certificate to do this.")
+        if request.environ['TLS_CLIENT_HASH_B64'] not in metrics.operators:
+            return Response(Status.CERTIFICATE_NOT_AUTHORISED, "You don't have permission to do that.")
+        return func(request, **kwargs)
+
+    return wrapped
+
+
 app = RocketCasterApplication()
 
 
+def lookup_episode_feed(episode_result):
+    episode = episode_result['episode']
+    if not episode:
+        return None
+    return mirror.submit_feed(episode['feedId'])
+
+
 @app.optional_auth_route('')
 def index_view(request):
-    posts = Post.most_recent()
-    body = render_template('index.gmi', user=request.user,
-                           posts=posts, now=datetime.now())
+    def render():
+        posts = list(Post.most_recent())
+        return render_template('index.gmi', posts=posts, now=datetime.now())
+
+    body = page_cache.get_or_render('index', ('posts', 'comments'), render)
+    notifications = User.count_notifications(request.user.id) if request.user else 0
+    user_block = render_template('index_user.gmi', user=request.user, notifications=notifications)
+    body = personalize(body, request.user, user_block)
     return Response(Status.SUCCESS, 'text/gemini', body)
 
 
-@app.route('/podcast/(?P<feed_id>[0-9]+)')
+@app.route('/podcast/(?P<feed_id>[0-9]+)', timeout=UPSTREAM_TIMEOUT, upstream=True)
 def podcast_view(request, feed_id: str):
-    feed_result = index.podcastByFeedId(feedId=feed_id)
-    feed = feed_result['feed']
+    return render_podcast_page(feed_id, 1)
+
+
+@app.route('/podcast/(?P<feed_id>[0-9]+)/page/(?P<page>[0-9]+)', timeout=UPSTREAM_TIMEOUT, upstream=True)
+def podcast_page_view(request, feed_id: str, page: str):
+    page = int(page)
+    if page < 1 or page > MAX_PODCAST_PAGES:
+        return Response(Status.NOT_FOUND, 'Page not found')
+    return render_podcast_page(feed_id, page)
+
+
+def render_podcast_page(feed_id, page):
+    # the first page is what gemsub subscribers poll, so it comes from the
+    # incrementally refreshed newest episodes
+    feed_future = mirror.submit_feed(feed_id)
+    if page == 1:
+        episodes = feed_episodes.newest(feed_id)
+    else:
+        episodes_result = index.episodesByFeedId(feedId=feed_id, max_results=page * PODCAST_PAGE_SIZE)
+        episodes = episodes_result['items'][(page - 1) * PODCAST_PAGE_SIZE:]
+    feed = feed_future.result()['feed']
     if not feed:
         return Response(Status.NOT_FOUND)
-    episodes_result = index.episodesByFeedId(
-        feedId=feed_id, max_results=feed['episodeCount'])
-    episodes = episodes_result['items']
+    discussions = Post.discussions_by_episode(feed['id'])
 
+    has_older = page < MAX_PODCAST_PAGES and page * PODCAST_PAGE_SIZE < feed['episodeCount']
     body = render_template(
-        'podcast.gmi', title=feed['title'], author=feed['author'], description=feed['description'], feed=feed['url'], link=feed['link'], categories=feed['categories'].values(), episodes=episodes)
+        'podcast.gmi', id=feed['id'], title=feed['title'], author=feed['author'], description=feed['description'], feed=feed['url'], link=feed['link'], categories=feed['categories'].values(), episodes=episodes,
+        discussions=discussions, page=page, newer=page - 1 if page > 1 else None, older=page + 1 if has_older else None)
     return Response(Status.SUCCESS, 'text/gemini', body)
 
 
-@app.route('/episode/(?P<episode_id>[0-9]+)')
+@app.route('/episode/(?P<episode_id>[0-9]+)', timeout=UPSTREAM_TIMEOUT, upstream=True)
 def episode_view(request, episode_id: str):
-    episode_result = index.episodeById(id=episode_id)
-    episode = episode_result['episode']
+    # the feed lookup starts as soon as the episode arrives, while the
+    # database is queried here
+    episode_future = mirror.submit_episode(episode_id)
+    feed_future = index.then(episode_future, lookup_episode_feed)
+
+    recent_post = Post.active_discussion(episode_id)
+
+    episode = episode_future.result()['episode']
     if not episode:
         return Response(Status.NOT_FOUND)
-    feed_result = index.podcastByFeedId(feedId=episode['feedId'])
-    feed = feed_result['feed']
-
-    all_recent_posts = Post.most_recent()
-    recent_post = None
-    for post in all_recent_posts:
-        if post.episode_id == episode_id:
-            recent_post = post
-            break
+    feed = feed_future.result()['feed']
 
     body = render_template('episode.gmi', feed_title=feed['title'], author=feed['author'], episode_title=episode['title'], season=episode['season'], episode_num=episode['episode'],
-                           episode_url=episode['enclosureUrl'], duration=episode['duration'], published=episode['datePublishedPretty'], description=episode['description'], feed_id=feed['id'], episode_id=episode_id, recent_post=recent_post, now=datetime.now())
+                           episode_url=episode['enclosureUrl'], duration=episode['duration'], published=episode['datePublishedPretty'], description=episode_description(episode_id, episode['description'] or '', episode.get('link') or feed.get('link')), feed_id=feed['id'], episode_id=episode_id, recent_post=recent_post, now=datetime.now())
     return Response(Status.SUCCESS, 'text/gemini', body)
 
 
-@app.route('/episode/(?P<episode_id>[0-9]+)/play')
-@proxy_rate_limiter.apply
+@app.route('/episode/(?P<episode_id>[0-9]+)/play', timeout=PROXY_TIMEOUT, upstream=True)
 def episode_play_view(request, episode_id: str):
-
-    def download_episode(url):
-        def get_content(url):
-            return requests.get(url).content
-
-        yield deferToThread(get_content, url)
-
-    episode_result = index.episodeById(id=episode_id)
-    episode = episode_result['episode']
+    episode = mirror.episode(episode_id)['episode']
     if not episode:
         return Response(Status.NOT_FOUND)
     episode_url = episode['enclosureUrl']
 
-    r = requests.head(episode_url, allow_redirects=True)
-    if r.status_code == 200:
-        # check file size
-        if int(r.headers['content-length']) > MAX_FILE_SIZE:
-            return Response(Status.PROXY_ERROR, 'Episode file size is too large')
-        return Response(Status.SUCCESS, r.headers['content-type'], download_episode(episode_url))
-    else:
-        return Response(Status.PROXY_ERROR, 'Error downloading episode')
+    # episodes already cached or being cached don't cost another upstream download
+    episode_cache = proxy.episode_cache
+    if episode_cache is None or not episode_cache.contains(episode_id, episode_url):
+        rate_response = play_limiter.check(request)
+        if rate_response:
+            return rate_response
+
+    stream, slow_response = play_streams.check(request)
+    if slow_response:
+        return slow_response
+    try:
+        if episode_cache is None:
+            response = EpisodeStream(episode_url, MAX_FILE_SIZE).open()
+        else:
+            response = episode_cache.open(episode_id, episode_url, MAX_FILE_SIZE, timeout=PROXY_TIMEOUT)
+    except BaseException:
+        play_streams.close(stream)
+        raise
+    response.body = play_streams.limit(stream, response.body)
+    return response
 
 
-@app.route('/search')
+@app.route('/search', timeout=UPSTREAM_TIMEOUT, upstream=True)
 def search_view(request):
     if not request.query:
         return Response(Status.INPUT, "Enter a search term")
+    rate_response = search_limiter.check(request)
+    if rate_response:
+        return rate_response
+    query = request.query
+
+    feeds = [{'id': feed.rowid, 'title': feed.title, 'author': feed.author, 'description': feed.description}
+             for feed in FeedSearch.ranked(query, SEARCH_RESULTS)]
+
+    # upstream is only asked about terms it hasn't been asked about recently
+    # or that the local index knows too little about
+    term = ' '.join(query.lower().split())
+    if len(feeds) < MIN_LOCAL_RESULTS or searched_terms.get(term) is None:
+        try:
+            upstream_feeds = index.search(query)['feeds']
+        except requests.RequestException:
+            if not feeds:
+                raise
+            upstream_feeds = []
+        else:
+            searched_terms.set(term, True, SEARCHED_TTL)
+            write_later(index_feeds, upstream_feeds)
+
+        known = {feed['id'] for feed in feeds}
+        feeds += [feed for feed in upstream_feeds if feed['id'] not in known]
 
-    search_result = index.search(request.query)
+    episodes = EpisodeSearch.ranked(query, SEARCH_RESULTS)
+    posts = PostSearch.ranked(query, SEARCH_RESULTS)
 
     body = render_template(
-        'search.gmi', count=search_result['count'], search_term=request.query, results=search_result['feeds'])
+        'search.gmi', count=len(feeds), search_term=query, results=feeds, episodes=episodes, posts=posts)
     return Response(Status.SUCCESS, 'text/gemini', body)
 
 
+def index_feeds(feeds):
+    for feed in feeds:
+        FeedSearch.add(feed)
+
+
 @app.route('/about')
 def about_view(request):
     body = render_template('about.gmi')
@@ -342,12 +557,23 @@ def register_view(request):
         return Response(Status.INPUT, "Username must be less than 32 characters")
     if not username.isascii() or re.search('[^a-zA-Z0-9_-]', username):
         return Response(Status.INPUT, "Username contains invalid characters. Only letters, numbers, underscores, and hyphens are allowed.")
-    if User.select().where(User.name ** username).exists():
+    if User.select().where(User.name_lower == username.lower()).exists():
         return Response(Status.INPUT, "Username is already taken")
     if str.lower(username) in RESERVED_NAMES:
         return Response(Status.INPUT, "Username is reserved")
 
+    user = write(register_user, username, fingerprint, cert)
+    if user is None:
+        return Response(Status.INPUT, "Username is already taken")
+    sessions.invalidate(fingerprint)
+
+    return Response(Status.REDIRECT_TEMPORARY, '/')
+
+
+def register_user(username, fingerprint, cert):
     user = User.register(name=username)
+    if user is None:
+        return None
     Certificate.create(
         user=user,
         fingerprint=fingerprint,
@@ -355,57 +581,70 @@ def register_view(request):
         not_valid_before=cert.not_valid_before,
         not_valid_after=cert.not_valid_after,
     )
-
-    return Response(Status.REDIRECT_TEMPORARY, '/')
+    return user
 
 
-@app.auth_route('/share/(?P<episode_id>[0-9]+)')
+@app.auth_route('/share/(?P<episode_id>[0-9]+)', timeout=UPSTREAM_TIMEOUT, upstream=True)
 def share_view(request, episode_id: str):
+    if request.query:
+        episode_future = mirror.submit_episode(episode_id)
+        feed_future = index.then(episode_future, lookup_episode_feed)
+
     # check for recent posts of the same episode
-    recent_posts = Post.most_recent()
-    for post in recent_posts:
-        if post.episode_id == episode_id:
-            return Response(Status.REDIRECT_TEMPORARY, f'/post/{post.id}')
+    recent_post = Post.active_discussion(episode_id)
+    if recent_post is not None:
+        return Response(Status.REDIRECT_TEMPORARY, f'/post/{recent_post.id}')
 
     username = request.user.name
     if not request.query:
         return Response(Status.INPUT, f"Starting discussion as {username}. Enter a comment.")
     content = request.query
 
-    episode_result = index.episodeById(id=episode_id)
-    episode = episode_result['episode']
+    episode = episode_future.result()['episode']
     if not episode:
         return Response(Status.NOT_FOUND)
     episode_title = episode['title']
-    feed_result = index.podcastByFeedId(feedId=episode['feedId'])
-    feed = feed_result['feed']
+    feed = feed_future.result()['feed']
     if not feed:
         return Response(Status.NOT_FOUND)
     podcast_title = feed['title']
     podcast_id = feed['id']
 
+    post = write(create_post, request.user, episode_id, episode_title, podcast_id, podcast_title, content)
+    page_cache.invalidate('posts')
+    return Response(Status.REDIRECT_TEMPORARY, f'/post/{post.id}')
+
+
+def create_post(author, episode_id, episode_title, podcast_id, podcast_title, content):
     post = Post.create(
-        author=request.user,
+        author=author,
         episode_id=episode_id,
         episode_title=episode_title,
         podcast_id=podcast_id,
         podcast_title=podcast_title,
         content=content,
-        created=datetime.now()
+        created=datetime.now(),
+        **Post.formatting(content)
     )
     parse_mentions(post=post)
-    return Response(Status.REDIRECT_TEMPORARY, f'/post/{post.id}')
+    PostSearch.add(post)
+    return post
 
 
 @app.optional_auth_route('/post/(?P<post_id>[0-9]+)')
 def post_view(request, post_id: str):
-    try:
-        post = Post.get(Post.id == post_id)
-    except Post.DoesNotExist:
+    def render():
+        try:
+            post = Post.select(Post, User).join(User).where(Post.id == post_id).get()
+        except Post.DoesNotExist:
+            return None
+        comments = list(Comment.for_post(post.id))
+        return render_template('post.gmi', post=post, comments=comments, now=datetime.now())
+
+    body = page_cache.get_or_render(f'post:{post_id}', (f'post:{post_id}',), render)
+    if body is None:
         return Response(Status.NOT_FOUND, "Post not found")
-    comments = post.comments.order_by(Comment.created.desc())
-    body = render_template('post.gmi', user=request.user, post=post,
-                           comments=comments, now=datetime.now())
+    body = personalize(body, request.user)
     return Response(Status.SUCCESS, 'text/gemini', body)
 
 
@@ -420,24 +659,31 @@ def comment_view(request, post_id: str):
         post = Post.get(Post.id == post_id)
     except Post.DoesNotExist:
         return Response(Status.NOT_FOUND, "Post not found")
+    write(create_comment, request.user, post, content)
+    page_cache.invalidate('comments', f'post:{post_id}')
+    return Response(Status.REDIRECT_TEMPORARY, f'/post/{post_id}')
+
+
+def create_comment(author, post, content):
     comment = Comment.create(
-        author=request.user,
+        author=author,
         post=post,
         content=content,
-        created=datetime.now()
+        created=datetime.now(),
+        **Comment.formatting(content)
     )
 
     # notify post author
-    if post.author != comment.author:
-        Notification.create(
-            user=post.author,
-            comment=comment,
-            message=f"{comment.author.name} commented on {post.episode_title}",
-            created=datetime.now()
-        )
+    if post.author_id != author.id:
+        Notification.add([{
+            'user': post.author_id,
+            'comment': comment.id,
+            'message': f"{author.name} commented on {post.episode_title}",
+            'created': datetime.now(),
+        }])
 
     parse_mentions(comment=comment)
-    return Response(Status.REDIRECT_TEMPORARY, f'/post/{post_id}')
+    return comment
 
 
 @app.auth_route('/post/(?P<post_id>[0-9]+)/delete')
@@ -446,18 +692,22 @@ def post_delete_view(request, post_id: str):
         post = Post.get(Post.id == post_id)
     except Post.DoesNotExist:
         return Response(Status.NOT_FOUND, "Post not found")
-    author_certificate = Certificate.get(Certificate.user == post.author)
-    if not author_certificate.fingerprint == request.environ['TLS_CLIENT_HASH_B64']:
+    if post.author_id != request.user.id:
         return Response(Status.CERTIFICATE_NOT_AUTHORISED, "You don't have permission to do that.")
 
     if not request.query or str.lower(request.query) != 'yes':
         return Response(Status.INPUT, 'Are you sure you want to delete this post? Type "yes" to confirm.')
 
-    Notification.delete().where((Notification.post == post) |
-                                (Notification.comment << post.comments)).execute()
+    write(delete_post, post)
+    page_cache.invalidate('posts', f'post:{post_id}')
+    return Response(Status.REDIRECT_TEMPORARY, '/')
+
+
+def delete_post(post):
+    Notification.remove((Notification.post == post) | (Notification.comment << post.comments))
     Comment.delete().where(Comment.post == post).execute()
     post.delete_instance(recursive=True)
-    return Response(Status.REDIRECT_TEMPORARY, '/')
+    PostSearch.remove(post.id)
 
 
 @app.auth_route('/comment/(?P<comment_id>[0-9]+)/delete')
@@ -466,36 +716,165 @@ def comment_delete_view(request, comment_id: str):
         comment = Comment.get(Comment.id == comment_id)
     except Comment.DoesNotExist:
         return Response(Status.NOT_FOUND, "Comment not found")
-    author_certificate = Certificate.get(Certificate.user == comment.author)
-    if not author_certificate.fingerprint == request.environ['TLS_CLIENT_HASH_B64']:
+    if comment.author_id != request.user.id:
         return Response(Status.CERTIFICATE_NOT_AUTHORISED, "You don't have permission to do that.")
 
     if not request.query or str.lower(request.query) != 'yes':
         return Response(Status.INPUT, 'Are you sure you want to delete this comment? Type "yes" to confirm.')
 
-    post_id = comment.post.id
-    Notification.delete().where(Notification.comment == comment).execute()
-    comment.delete_instance(recursive=True)
+    post_id = comment.post_id
+    write(delete_comment, comment)
+    page_cache.invalidate('comments', f'post:{post_id}')
     return Response(Status.REDIRECT_TEMPORARY, f'/post/{post_id}')
 
 
+def delete_comment(comment):
+    Notification.remove(Notification.comment == comment)
+    comment.delete_instance(recursive=True)
+
+
 @app.auth_route('/notifications')
 def notifications_view(request):
-    notifications = Notification.select().where(
-        Notification.user == request.user)
-    body = render_template('notifications.gmi',
-                           user=request.user, notifications=notifications, now=datetime.now())
+    return render_notifications_page(request.user)
+
+
+@app.auth_route('/notifications/older/(?P<cursor>[0-9]{20}-[0-9]+)')
+def notifications_page_view(request, cursor: str):
+    before = parse_cursor(cursor)
+    if before is None:
+        return Response(Status.BAD_REQUEST, 'Invalid cursor')
+    return render_notifications_page(request.user, before=before)
+
+
+def render_notifications_page(user, before=None):
+    # fetch one extra row to find out whether there's another page
+    notifications = Notification.page(user, NOTIFICATIONS_PAGE_SIZE + 1, before=before)
+    older = page_cursor(notifications[NOTIFICATIONS_PAGE_SIZE - 1]) \
+        if len(notifications) > NOTIFICATIONS_PAGE_SIZE else None
+    body = render_template('notifications.gmi', user=user, notifications=notifications[:NOTIFICATIONS_PAGE_SIZE],
+                           newest=before is None, older=older, now=datetime.now())
     return Response(Status.SUCCESS, 'text/gemini', body)
 
 
 @app.auth_route('/notifications/clear')
 def notifications_clear_view(request):
-    Notification.delete().where(Notification.user == request.user).execute()
+    newest_id = Notification.newest_id(request.user)
+    if newest_id is not None:
+        # one chunk per transaction, anything newer is kept
+        while write(Notification.clear, request.user, newest_id, NOTIFICATIONS_CLEAR_CHUNK) == NOTIFICATIONS_CLEAR_CHUNK:
+            pass
     return Response(Status.REDIRECT_TEMPORARY, '/')
 
 
 @app.route('/archive')
 def archive_view(request):
-    posts = Post.most_recent(count=None)
-    body = render_template('archive.gmi', posts=posts)
+    body = page_cache.get_or_render('archive', ('posts',), render_archive_page)
+    return Response(Status.SUCCESS, 'text/gemini', body)
+
+
+@app.route('/archive/(?P<direction>older|newer)/(?P<cursor>[0-9]{20}-[0-9]+)')
+def archive_page_view(request, direction: str, cursor: str):
+    key = parse_cursor(cursor)
+    if key is None:
+        return Response(Status.BAD_REQUEST, 'Invalid cursor')
+
+    def render():
+        if direction == 'older':
+            return render_archive_page(before=key)
+        else:
+            return render_archive_page(after=key)
+
+    body = page_cache.get_or_render(f'archive:{direction}:{cursor}', ('posts',), render)
+    return Response(Status.SUCCESS, 'text/gemini', body)
+
+
+@app.route('/archive/all')
+def archive_all_view(request):
+    # Every post, a batch at a time: each is fetched and rendered on a
+    # worker thread, and the next one only once the client has taken the
+    # last (see workers.paced), so no read is held open between them.
+    before = None
+    done = False
+
+    def render_batch():
+        nonlocal before, done
+        posts = Post.page(ARCHIVE_STREAM_BATCH, before=before)
+        done = len(posts) < ARCHIVE_STREAM_BATCH
+        if posts:
+            before = (posts[-1].created, posts[-1].id)
+        return render_template('archive_posts.gmi', posts=posts)
+
+    def generate():
+        yield render_template('archive.gmi', posts=[], newer=None, older=None, full=True)
+        while not done:
+            # the batch's queries count towards this request
+            yield app.workers.run(metrics.run_in(metrics.current(), render_batch))
+
+    return Response(Status.SUCCESS, 'text/gemini', generate())
+
+
+def page_cursor(row):
+    return f"{row.created.strftime('%Y%m%d%H%M%S%f')}-{row.id}"
+
+
+def parse_cursor(cursor):
+    # None for a cursor that doesn't hold a valid time
+    created, row_id = cursor.split('-')
+    try:
+        return datetime.strptime(created, '%Y%m%d%H%M%S%f'), int(row_id)
+    except ValueError:
+        return None
+
+
+def render_archive_page(before=None, after=None):
+    # fetch one extra row to find out whether there's another page
+    posts = Post.page(ARCHIVE_PAGE_SIZE + 1, before=before, after=after)
+    more = len(posts) > ARCHIVE_PAGE_SIZE
+    if after is not None:
+        posts = posts[-ARCHIVE_PAGE_SIZE:]
+        newer = page_cursor(posts[0]) if more else None
+        older = page_cursor(posts[-1]) if posts else None
+    else:
+        posts = posts[:ARCHIVE_PAGE_SIZE]
+        newer = page_cursor(posts[0]) if before is not None and posts else None
+        older = page_cursor(posts[-1]) if more else None
+    return render_template('archive.gmi', posts=posts, newer=newer, older=older, full=False)
+
+
+@app.operator_route('/admin/metrics')
+def metrics_view(request):
+    components = {
+        'workers': app.workers.stats(),
+        'upstream workers': app.upstream_workers.stats(),
+        'index': index.stats(),
+        'pages': page_cache.stats(),
+        'feed episodes': feed_episodes.stats(),
+        'sessions': sessions.stats(),
+        'mirror': mirror.stats(),
+        'transport': get_transport().stats(),
+        'play limits': play_limiter.stats(),
+        'play streams': play_streams.stats(),
+        'search limits': search_limiter.stats(),
+    }
+    if database.writer is not None:
+        components['writer'] = database.writer.stats()
+    if proxy.episode_cache is not None:
+        components['episode cache'] = proxy.episode_cache.stats()
+    if run_dir is not None:
+        now = time.time()
+        components['processes'] = {
+            f"worker {status['index']}": {
+                'pid': status['pid'],
+                'state': status['state'],
+                'connections': status['connections'],
+                'requests': status['requests'],
+                'heartbeat_age': round(now - status['heartbeat'], 1),
+            } for status in sorted(read_health(run_dir).values(), key=lambda status: status['index'])}
+    body = render_template('metrics.gmi', routes=metrics.summary(), slow_requests=list(metrics.slow_requests),
+                           slow_request_seconds=metrics.slow_request_seconds, components=components)
     return Response(Status.SUCCESS, 'text/gemini', body)
+
+
+@app.operator_route('/admin/metrics/prometheus')
+def metrics_prometheus_view(request):
+    return Response(Status.SUCCESS, 'text/plain; version=0.0.4', metrics.prometheus())
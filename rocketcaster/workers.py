@@ -0,0 +1,220 @@
+import time
+import threading
+import requests
+from jetforce import Response, Status
+from jetforce.app.base import DeferredResponse
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError, Deferred, TimeoutError
+from twisted.internet.threads import deferToThreadPool
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+from .database import WriteQueueFull
+from .metrics import metrics
+
+DEFAULT_TIMEOUT = 30  # seconds
+
+current = threading.local()
+
+
+def time_left():
+    # seconds until the request handled on this thread times out, None
+    # outside of one; upstream calls use it to give up in time
+    deadline = getattr(current, 'deadline', None)
+    return deadline - time.monotonic() if deadline is not None else None
+
+
+class Drain:
+    # A push producer on the client's connection. Twisted pauses it once the
+    # connection's send buffer fills up and resumes it when that has been
+    # written out, and paced() waits for that before the next chunk.
+    def __init__(self, transport):
+        self.transport = transport
+        self.paused = False
+        self.stopped = False
+        self.waiting = None
+        transport.registerProducer(self, True)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        waiting, self.waiting = self.waiting, None
+        if waiting is not None and not waiting.called:
+            waiting.callback(None)
+
+    def stopProducing(self):
+        # the connection is gone
+        self.stopped = True
+        self.resumeProducing()
+
+    def wait(self):
+        self.waiting = Deferred()
+        return self.waiting
+
+    def close(self):
+        self.transport.unregisterProducer()
+
+
+def paced(chunks, transport):
+    # Only asks the body for its next chunk once the connection has taken
+    # the last one, so a client that stops reading holds up the body (and
+    # the upstream download or file read behind it) instead of having it
+    # pile up in memory. Without a transport, as when calling the app
+    # directly, chunks are passed straight through.
+    if transport is None:
+        yield from chunks
+        return
+    chunks = iter(chunks)
+    drain = Drain(transport)
+    try:
+        while not drain.stopped:
+            if drain.paused:
+                yield drain.wait()  # resolves to None, which jetforce doesn't write
+                continue
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                break
+            yield chunk
+    finally:
+        drain.close()
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+class WorkerPool:
+    # Runs route handlers off the reactor thread so a slow upstream or
+    # database call only ties up one worker instead of the whole server.
+    def __init__(self, size=8, max_queue=64, timeout=DEFAULT_TIMEOUT, name='rocketcaster'):
+        self.size = size
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.name = name
+        self.pool = None
+        self.pending = 0
+        self.shed = 0
+        self.timeouts = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.pool = ThreadPool(self.size, self.size, name=self.name)
+        self.pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self.pool.stop)
+
+    def run(self, func, *args):
+        # for work a response body needs done off the reactor thread
+        if self.pool is None:
+            self.start()
+        return deferToThreadPool(reactor, self.pool, func, *args)
+
+    def wrap(self, func, timeout=None):
+        timeout = timeout or self.timeout
+
+        def wrapped(request, **kwargs):
+            # queueing counts towards the request's time in the metrics
+            request.environ['rocketcaster.received'] = time.perf_counter()
+            deadline = time.monotonic() + timeout
+            if self.pool is None:
+                self.start()
+
+            with self.lock:
+                if self.pending >= self.size + self.max_queue:
+                    self.shed += 1
+                    return Response(Status.SLOW_DOWN, '5')
+                self.pending += 1
+
+            def run():
+                # counted until the handler really returns, even if the
+                # request timed out or the client went away
+                current.deadline = deadline
+                try:
+                    return func(request, **kwargs)
+                finally:
+                    current.deadline = None
+                    with self.lock:
+                        self.pending -= 1
+
+            result = Deferred()
+            deferToThreadPool(reactor, self.pool, run).addBoth(self.settle, result)
+            result.addTimeout(timeout, reactor)
+            result.addErrback(self.error_response, request)
+            return self.deferred_response(result, request.environ.get('rocketcaster.transport'))
+
+        return wrapped
+
+    @staticmethod
+    def settle(value, result):
+        # Hands the handler's response on, unless the request timed out or
+        # the client went away while it ran. Nothing sends that response, so
+        # its body is closed here to give back what it holds open, like an
+        # upstream connection and its transport slot.
+        if not result.called:
+            if isinstance(value, Failure):
+                result.errback(value)
+            else:
+                result.callback(value)
+        elif not isinstance(value, Failure):
+            close = getattr(getattr(value, 'body', None), 'close', None)
+            if close is not None:
+                close()
+
+    def error_response(self, failure, request):
+        if failure.check(CancelledError):
+            return failure
+        if failure.check(TimeoutError):
+            self.timeouts += 1
+            # the handler's response, whenever it comes, is dropped (see
+            # settle), so the request is recorded as it was answered
+            trace = request.environ.get('rocketcaster.trace')
+            if trace is not None:
+                trace.status = Status.TEMPORARY_FAILURE
+                metrics.finish(trace)
+            return Response(Status.TEMPORARY_FAILURE, 'The request timed out.')
+        status, meta = self.error_status(failure.value)
+        if status == Status.CGI_ERROR:
+            log.err(failure)
+        return Response(status, meta)
+
+    @staticmethod
+    def error_status(error):
+        # the status and meta a client gets for a handler's exception
+        if isinstance(error, WriteQueueFull):
+            return Status.SLOW_DOWN, '5'
+        if isinstance(error, requests.RequestException):
+            return Status.PROXY_ERROR, 'Error contacting upstream server.'
+        return Status.CGI_ERROR, 'An unexpected error occurred'
+
+    def deferred_response(self, result, transport=None):
+        send_status = Deferred()
+        response = None
+
+        def resolved(value):
+            nonlocal response
+            response = value
+            if isinstance(value, DeferredResponse):
+                value.send_status.chainDeferred(send_status)
+            else:
+                send_status.callback((value.status, value.meta))
+
+        result.addCallback(resolved)
+
+        def body():
+            # the status line is written once the handler has returned
+            yield result
+            if isinstance(response.body, (bytes, str, Deferred)):
+                yield response.body
+            elif response.body:
+                yield from paced(response.body, transport)
+
+        return DeferredResponse(send_status, body())
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'pending': self.pending,
+            'queued': max(self.pending - self.size, 0),
+            'shed': self.shed,
+            'timeouts': self.timeouts,
+        }
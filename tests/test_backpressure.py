@@ -0,0 +1,78 @@
+import ssl
+import time
+import socket
+from types import SimpleNamespace
+import pytest
+from bench.client import GeminiClient
+from bench.run import RSSMonitor, start_server
+from bench.stub import StubUpstream
+
+ENCLOSURE_SIZE = 1024 * 1024 * 96
+MAX_GROWTH = 1024 * 1024 * 24  # well under the episode's size
+STALL_SECONDS = 4
+
+
+@pytest.fixture
+def serve(tmp_path):
+    running = []
+
+    def serve(episode_cache=False):
+        upstream = StubUpstream(latency=0, enclosure_latency=0, enclosure_size=ENCLOSURE_SIZE).start()
+        args = SimpleNamespace(threads=4, queue=16, no_episode_cache=not episode_cache, rate_limits=False, workers=1)
+        process, port = start_server(args, str(tmp_path / 'db.sqlite'), upstream, str(tmp_path))
+        running.append((process, upstream))
+        return process, port
+
+    yield serve
+    for process, upstream in running:
+        process.terminate()
+        process.wait()
+        upstream.stop()
+
+
+def stalled_request(port, path):
+    # sends the request, reads the status line and then nothing more
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    conn = context.wrap_socket(sock, server_hostname='localhost')
+    conn.sendall(f'gemini://localhost{path}\r\n'.encode())
+    header = conn.recv(1024)
+    return conn, header
+
+
+def assert_bounded(process, port, paths):
+    monitor = RSSMonitor(process.pid, interval=0.02)
+    time.sleep(0.5)
+    before = monitor.rss()
+    monitor.reset()
+
+    connections = [stalled_request(port, path) for path in paths]
+    try:
+        for _, header in connections:
+            assert header.startswith(b'20 ')
+        time.sleep(STALL_SECONDS)
+        assert monitor.peak - before < MAX_GROWTH
+    finally:
+        monitor.stop()
+        for conn, _ in connections:
+            conn.close()
+
+
+def test_stalled_readers_dont_buffer_the_episode(serve):
+    process, port = serve()
+    assert_bounded(process, port, ['/episode/1000/play', '/episode/1001/play'])
+
+
+def test_stalled_readers_following_a_download(serve):
+    process, port = serve(episode_cache=True)
+    assert_bounded(process, port, ['/episode/1000/play', '/episode/1000/play'])
+
+
+def test_stalled_readers_of_a_cached_episode(serve):
+    process, port = serve(episode_cache=True)
+    status, _, size, _ = GeminiClient('127.0.0.1', port).request('/episode/1000/play')
+    assert (status, size) == (20, ENCLOSURE_SIZE)
+    assert_bounded(process, port, ['/episode/1000/play', '/episode/1000/play'])
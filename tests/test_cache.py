@@ -0,0 +1,148 @@
+import time
+import threading
+import pytest
+from rocketcaster.cache import CachedIndex, FeedEpisodes, LRUCache
+
+WAITERS = 8
+
+
+class StubClient:
+    # counts calls; with a gate set, every call blocks until it opens
+    def __init__(self, error=None):
+        self.calls = 0
+        self.error = error
+        self.gate = None
+        self.lock = threading.Lock()
+
+    def podcastByFeedId(self, key):
+        with self.lock:
+            self.calls += 1
+            calls = self.calls
+        if self.gate is not None:
+            self.gate.wait(5)
+        if self.error is not None:
+            raise self.error
+        return f'{key}:{calls}'
+
+    def episodesByFeedId(self, feedId, since=0, max_results=10):
+        return {'items': [{'id': self.podcastByFeedId(feedId), 'datePublished': 1700000000}]}
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def concurrently(index, key):
+    # starts WAITERS lookups of one key while upstream is held up, and
+    # releases it once all but the first are waiting on that one
+    index.client.gate = threading.Event()
+    results = [None] * WAITERS
+
+    def run(i):
+        try:
+            results[i] = index.podcastByFeedId(key)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(WAITERS)]
+    for thread in threads:
+        thread.start()
+    wait_for(lambda: index.counters['podcastByFeedId']['coalesced'] == WAITERS - 1)
+    index.client.gate.set()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_one_upstream_call_per_key_within_the_ttl():
+    client = StubClient()
+    index = CachedIndex(lambda: client, {'podcastByFeedId': 60})
+    assert index.podcastByFeedId(1) == '1:1'
+    assert index.podcastByFeedId(1) == '1:1'
+    assert index.podcastByFeedId(2) == '2:2'
+    assert client.calls == 2
+    assert index.counters['podcastByFeedId']['hits'] == 1
+
+
+def test_concurrent_misses_share_one_call():
+    client = StubClient()
+    index = CachedIndex(lambda: client, {'podcastByFeedId': 60})
+    assert concurrently(index, 1) == ['1:1'] * WAITERS
+    assert client.calls == 1
+
+
+def test_stale_entries_are_served_while_refreshing_once():
+    client = StubClient()
+    index = CachedIndex(lambda: client, {'podcastByFeedId': 0.05})
+    assert index.podcastByFeedId(1) == '1:1'
+    time.sleep(0.1)
+
+    client.gate = threading.Event()
+    assert [index.podcastByFeedId(1) for _ in range(5)] == ['1:1'] * 5
+    client.gate.set()
+    wait_for(lambda: not index.refreshing)
+    assert client.calls == 2
+    assert index.counters['podcastByFeedId']['stale_hits'] == 5
+    assert index.podcastByFeedId(1) == '1:2'
+
+
+def test_errors_reach_every_waiter():
+    error = ValueError('upstream failed')
+    client = StubClient(error=error)
+    index = CachedIndex(lambda: client, {'podcastByFeedId': 60})
+    assert concurrently(index, 1) == [error] * WAITERS
+    assert client.calls == 1
+
+    # nothing was cached, the next lookup tries again
+    with pytest.raises(ValueError):
+        index.podcastByFeedId(1)
+    assert client.calls == 2
+
+
+def test_least_recently_used_entries_are_evicted_at_the_byte_cap():
+    client = StubClient()
+    cache = LRUCache(max_bytes=2500, sizeof=lambda value: 1000)
+    index = CachedIndex(lambda: client, {'podcastByFeedId': 60}, cache=cache)
+    index.podcastByFeedId(1)
+    index.podcastByFeedId(2)
+    index.podcastByFeedId(1)  # now more recently used than 2
+    index.podcastByFeedId(3)
+    assert cache.evictions == 1
+    assert cache.size <= 2500
+
+    assert index.podcastByFeedId(1) == '1:1'
+    assert index.podcastByFeedId(3) == '3:3'
+    assert index.podcastByFeedId(2) == '2:4'  # fetched again
+    assert client.calls == 4
+
+
+def test_entries_expire_after_their_stale_time():
+    cache = LRUCache()
+    cache.set('term', True, 0.05)
+    cache.set('feed', [1, 2], 0.05, stale_ttl=60)
+    assert cache.get('term') is not None
+    time.sleep(0.1)
+    assert cache.get('term') is None
+    assert cache.get('feed').value == [1, 2]  # stale, for the caller to refresh
+    assert len(cache) == 1
+    assert cache.size == len('feed') + len('[1, 2]')
+
+
+def test_concurrent_feed_updates_share_one_call():
+    client = StubClient()
+    feeds = FeedEpisodes(CachedIndex(lambda: client, {}), ttl=60)
+    client.gate = threading.Event()
+    results = [None] * WAITERS
+    threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, feeds.newest(7))) for i in range(WAITERS)]
+    for thread in threads:
+        thread.start()
+    wait_for(lambda: feeds.coalesced == WAITERS - 1)
+    client.gate.set()
+    for thread in threads:
+        thread.join()
+    assert results == [[{'id': '7:1', 'datePublished': 1700000000}]] * WAITERS
+    assert client.calls == 1
+    assert feeds.full_fetches == 1
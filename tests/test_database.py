@@ -0,0 +1,24 @@
+import sqlite3
+import threading
+from rocketcaster.database import Database
+
+
+def test_a_renewed_snapshot_sees_later_commits(tmp_path):
+    path = str(tmp_path / 'db.sqlite')
+    db = Database(path)
+    db.execute_sql('CREATE TABLE item (id INTEGER PRIMARY KEY)')
+    counts = []
+
+    def read():
+        with db.snapshot():
+            counts.append(db.execute_sql('SELECT COUNT(*) FROM item').fetchone()[0])
+            with sqlite3.connect(path) as conn:
+                conn.execute('INSERT INTO item DEFAULT VALUES')
+            counts.append(db.execute_sql('SELECT COUNT(*) FROM item').fetchone()[0])
+            db.renew_snapshot()
+            counts.append(db.execute_sql('SELECT COUNT(*) FROM item').fetchone()[0])
+
+    thread = threading.Thread(target=read)
+    thread.start()
+    thread.join()
+    assert counts == [0, 0, 1]
@@ -0,0 +1,47 @@
+from rocketcaster.gemtext import html_to_gemtext
+
+
+def test_blocks_lists_and_headings():
+    html = '<h2>Notes</h2><p>First  line<br>second line</p><ul><li>one</li><li>two</li></ul>'
+    assert html_to_gemtext(html) == '## Notes\n\nFirst line\nsecond line\n\n* one\n* two'
+
+
+def test_links_follow_their_block():
+    html = '<p>See <a href="https://example.com/a?x=1&amp;y=2">the site</a> for more.</p><p>Next</p>'
+    assert html_to_gemtext(html) == 'See the site for more.\n=> https://example.com/a?x=1&y=2 the site\n\nNext'
+
+
+def test_relative_links_are_resolved_against_the_base():
+    html = ('<p><a href="/transcript">Transcript</a> <a href="notes.html">Notes</a> '
+            '<a href="//cdn.example.org/art.jpg">Art</a> <a href="mailto:host@example.com">Mail</a></p>')
+    assert html_to_gemtext(html, 'https://example.com/show/42').splitlines() == [
+        'Transcript Notes Art Mail',
+        '=> https://example.com/transcript Transcript',
+        '=> https://example.com/show/notes.html Notes',
+        '=> https://cdn.example.org/art.jpg Art',
+        '=> mailto:host@example.com Mail',
+    ]
+    assert html_to_gemtext('<a href="/transcript">Transcript</a>') == 'Transcript\n=> /transcript Transcript'
+
+
+def test_anchors_and_scripts_arent_links():
+    html = '<p><a href="#top">Top</a> <a href="javascript:void(0)">Play</a></p>'
+    assert html_to_gemtext(html, 'https://example.com/show/42') == 'Top Play'
+
+
+def test_text_cant_start_a_line_with_a_marker():
+    html = ('<p># not a heading</p><p>* not a bullet</p><p>&gt; not a quote</p>'
+            '<p>=&gt; not a link</p><p>```not a fence</p><ul><li>* still a bullet</li></ul>')
+    assert html_to_gemtext(html).splitlines() == [
+        ' # not a heading', '',
+        ' * not a bullet', '',
+        ' > not a quote', '',
+        ' => not a link', '',
+        ' ```not a fence', '',
+        '* * still a bullet',
+    ]
+
+
+def test_scripts_styles_and_comments_are_dropped():
+    html = '<style>p { color: red }</style><!-- hidden --><p>Shown</p><script>alert(1)</script>'
+    assert html_to_gemtext(html) == 'Shown'
@@ -0,0 +1,45 @@
+import pytest
+from jetforce import Request
+from twisted.internet.defer import TimeoutError
+from twisted.python.failure import Failure
+from rocketcaster.database import WriteQueueFull
+from rocketcaster.metrics import Metrics, metrics
+from rocketcaster.workers import WorkerPool
+
+
+def request(path):
+    url = f'gemini://localhost{path}'
+    return Request({'GEMINI_URL': url, 'HOSTNAME': 'localhost', 'SERVER_PORT': 1965,
+                    'REMOTE_ADDR': '127.0.0.1', 'QUERY_STRING': ''})
+
+
+def test_handlers_that_raise_are_recorded():
+    recorder = Metrics()
+
+    def busy(request):
+        raise WriteQueueFull()
+
+    def broken(request):
+        raise ValueError()
+
+    for func in (busy, broken):
+        traced = recorder.wrap('/route', func, WorkerPool.error_status)
+        with pytest.raises((WriteQueueFull, ValueError)):
+            traced(request('/route'))
+    assert recorder.routes['/route'].statuses == {42: 1, 44: 1}
+    assert recorder.routes['/route'].duration.count == 2
+
+
+def test_timeouts_are_recorded_once():
+    pool = WorkerPool()
+
+    def slow(request):
+        # what the handler does once the request has timed out
+        pool.error_response(Failure(TimeoutError()), request)
+        raise ValueError()
+
+    traced = metrics.wrap('/timeout-test', slow, pool.error_status)
+    with pytest.raises(ValueError):
+        traced(request('/timeout-test'))
+    assert metrics.routes['/timeout-test'].statuses == {40: 1}
+    assert pool.timeouts == 1
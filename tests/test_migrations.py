@@ -0,0 +1,58 @@
+import sqlite3
+from rocketcaster.models import init_db
+
+# the schema the first release created, before any migrations
+BASELINE = '''
+CREATE TABLE "user" ("id" INTEGER NOT NULL PRIMARY KEY, "name" TEXT NOT NULL, "created" DATETIME NOT NULL);
+CREATE UNIQUE INDEX "user_name" ON "user" ("name");
+CREATE TABLE "certificate" ("id" INTEGER NOT NULL PRIMARY KEY, "user_id" INTEGER NOT NULL, "fingerprint" TEXT NOT NULL,
+    "subject" TEXT, "not_valid_before" DATETIME, "not_valid_after" DATETIME, FOREIGN KEY ("user_id") REFERENCES "user" ("id"));
+CREATE INDEX "certificate_user_id" ON "certificate" ("user_id");
+CREATE UNIQUE INDEX "certificate_fingerprint" ON "certificate" ("fingerprint");
+CREATE TABLE "post" ("id" INTEGER NOT NULL PRIMARY KEY, "author_id" INTEGER NOT NULL, "episode_id" TEXT NOT NULL,
+    "episode_title" TEXT NOT NULL, "podcast_id" TEXT NOT NULL, "podcast_title" TEXT NOT NULL, "content" TEXT NOT NULL,
+    "created" DATETIME NOT NULL, FOREIGN KEY ("author_id") REFERENCES "user" ("id"));
+CREATE INDEX "post_author_id" ON "post" ("author_id");
+CREATE TABLE "comment" ("id" INTEGER NOT NULL PRIMARY KEY, "author_id" INTEGER NOT NULL, "post_id" INTEGER NOT NULL,
+    "content" TEXT NOT NULL, "created" DATETIME NOT NULL, FOREIGN KEY ("author_id") REFERENCES "user" ("id"),
+    FOREIGN KEY ("post_id") REFERENCES "post" ("id"));
+CREATE INDEX "comment_author_id" ON "comment" ("author_id");
+CREATE INDEX "comment_post_id" ON "comment" ("post_id");
+CREATE TABLE "notification" ("id" INTEGER NOT NULL PRIMARY KEY, "user_id" INTEGER NOT NULL, "message" TEXT NOT NULL,
+    "post_id" INTEGER, "comment_id" INTEGER, "created" DATETIME NOT NULL, FOREIGN KEY ("user_id") REFERENCES "user" ("id"),
+    FOREIGN KEY ("post_id") REFERENCES "post" ("id"), FOREIGN KEY ("comment_id") REFERENCES "comment" ("id"));
+CREATE INDEX "notification_user_id" ON "notification" ("user_id");
+CREATE INDEX "notification_post_id" ON "notification" ("post_id");
+CREATE INDEX "notification_comment_id" ON "notification" ("comment_id");
+INSERT INTO "user" VALUES (1, 'Alice', '2023-01-01 00:00:00');
+INSERT INTO "post" VALUES (1, 1, '1000', 'Episode', '1', 'Podcast', 'Hello @Alice', '2023-01-02 00:00:00');
+INSERT INTO "comment" VALUES (1, 1, 1, 'A comment', '2023-01-03 00:00:00');
+INSERT INTO "notification" VALUES (1, 1, 'Alice mentioned you', 1, NULL, '2023-01-02 00:00:00');
+'''
+
+
+def baseline(path):
+    with sqlite3.connect(path) as conn:
+        conn.executescript(BASELINE)
+    return str(path)
+
+
+def test_upgrading_the_baseline_reports_query_plan_changes(tmp_path):
+    path = baseline(tmp_path / 'db.sqlite')
+    dry_run = init_db(path, dry_run=True)
+    assert [migration.version for migration, _ in dry_run.applied] == [1, 2, 3, 4, 5]
+    with sqlite3.connect(path) as conn:
+        assert conn.execute('PRAGMA user_version').fetchone() == (0,)
+
+    report = init_db(path)
+    assert report.to_version == 5
+    # every plan was taken, including for queries on columns the upgrade added
+    assert all(before and after for before, after in report.plans.values())
+    changed = report.changed_plans()
+    assert 'front page' in changed and 'notifications' in changed
+    assert report.plans == dry_run.plans
+
+    with sqlite3.connect(path) as conn:
+        assert conn.execute('PRAGMA user_version').fetchone() == (5,)
+        assert conn.execute('SELECT name_lower, notification_count FROM user').fetchone() == ('alice', 1)
+        assert conn.execute('SELECT summary IS NOT NULL FROM post').fetchone() == (1,)
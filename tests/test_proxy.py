@@ -0,0 +1,68 @@
+import os
+import time
+import pytest
+from bench.stub import StubUpstream
+from rocketcaster.proxy import EpisodeCache
+
+EPISODE_SIZE = 1024 * 256
+MAX_SIZE = 1024 * 1024 * 8
+
+
+@pytest.fixture(scope='module')
+def upstream():
+    stub = StubUpstream(latency=0, enclosure_latency=0, enclosure_size=EPISODE_SIZE).start()
+    yield stub
+    stub.stop()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_downloads_that_cant_be_kept_still_finish(upstream, tmp_path, monkeypatch):
+    def replace(src, dst):
+        raise OSError(28, 'No space left on device')
+
+    monkeypatch.setattr(os, 'replace', replace)
+    cache = EpisodeCache(str(tmp_path), MAX_SIZE)
+    url = f'{upstream.url}/enclosures/1.mp3'
+    response = cache.open(1, url, MAX_SIZE, timeout=5)
+    assert response.status == 20
+    wait_for(lambda: not cache.downloads)
+    assert not cache.entries
+    assert os.listdir(tmp_path) == []
+
+    # the next play starts over instead of joining the failed download
+    cache.open(1, url, MAX_SIZE, timeout=5)
+    wait_for(lambda: not cache.downloads)
+    assert cache.misses == 2
+
+
+def test_a_restarted_worker_shares_the_directory(upstream, tmp_path):
+    # the worker being replaced is still downloading and evicting
+    old = EpisodeCache(str(tmp_path), MAX_SIZE)
+    url = f'{upstream.url}/enclosures/2.mp3'
+    old.open(2, url, MAX_SIZE, timeout=5)
+    wait_for(lambda: not old.downloads)
+    downloading = os.path.join(tmp_path, 'download.tmp')
+    abandoned = os.path.join(tmp_path, 'abandoned.tmp')
+    for path in (downloading, abandoned):
+        with open(path, 'wb') as f:
+            f.write(b'partial')
+    os.utime(abandoned, (0, 0))
+
+    new = EpisodeCache(str(tmp_path), MAX_SIZE)
+    assert os.path.exists(downloading)
+    assert not os.path.exists(abandoned)
+    assert new.size == EPISODE_SIZE
+
+    old.max_bytes = 0
+    old.evict()
+    response = new.open(2, url, MAX_SIZE, timeout=5)
+    assert response.status == 20
+    assert new.misses == 1 and new.hits == 0
+    wait_for(lambda: not new.downloads)
+    assert new.size == EPISODE_SIZE
@@ -0,0 +1,112 @@
+import time
+from datetime import datetime, timedelta
+import pytest
+from jetforce import Request
+from bench.stub import StubUpstream
+from rocketcaster import init_db, views
+from rocketcaster.database import read_snapshot
+from rocketcaster.metrics import Trace, metrics
+from rocketcaster.models import User, Certificate, Post, Comment, Notification
+
+FEED_ID = 1
+FINGERPRINT = 'reader-fingerprint'
+
+
+class StubClient:
+    # podcastindex, answered by the benchmark's stub without the HTTP
+    def __init__(self):
+        self.stub = StubUpstream(latency=0)
+        self.stub.server.server_close()
+
+    def podcastByFeedId(self, feedId):
+        return self.stub.api('/podcasts/byfeedid', {'id': feedId})
+
+    def episodesByFeedId(self, feedId, since=0, max_results=10):
+        return self.stub.api('/episodes/byfeedid', {'id': feedId, 'since': since, 'max': max_results})
+
+    def episodeById(self, id):
+        return self.stub.api('/episodes/byid', {'id': id})
+
+
+@pytest.fixture(scope='module')
+def site(tmp_path_factory):
+    init_db(str(tmp_path_factory.mktemp('queries') / 'db.sqlite'))
+    views.index.client = StubClient()
+    author = User.register('author')
+    reader = User.register('reader')
+    Certificate.create(user=reader, fingerprint=FINGERPRINT)
+    return author, reader
+
+
+def seed(author, reader, count):
+    # count more posts on the feed, comments on the first post and
+    # notifications for the reader
+    now = datetime.now()
+    for i in range(count):
+        content = f'Post {i} about the show'
+        Post.create(author=author, episode_id=str(FEED_ID * 1000 + i % 10), episode_title=f'Episode {i}',
+                    podcast_id=str(FEED_ID), podcast_title=f'Podcast {FEED_ID}', content=content,
+                    created=now - timedelta(minutes=i), **Post.formatting(content))
+    first = Post.select().order_by(Post.id).first()
+    for i in range(count):
+        Comment.create(author=reader, post=first, content='A comment', created=now,
+                       **Comment.formatting('A comment'))
+    Notification.add([{'user': reader.id, 'post': first.id, 'message': f'Notification {i}', 'created': now}
+                      for i in range(count)])
+    return first
+
+
+def queries(view, path, fingerprint=None, **kwargs):
+    environ = {'GEMINI_URL': f'gemini://localhost{path}', 'HOSTNAME': 'localhost', 'SERVER_PORT': 1965,
+               'REMOTE_ADDR': '127.0.0.1', 'QUERY_STRING': ''}
+    if fingerprint is not None:
+        environ.update({'REMOTE_USER': 'reader', 'TLS_CLIENT_HASH_B64': fingerprint})
+    # the first request warms the upstream and session caches; pages are
+    # rendered afresh for the one that's counted
+    read_snapshot(view)(Request(environ), **kwargs)
+    views.page_cache.cache.clear()
+    trace = Trace('test', path, time.perf_counter(), keep_queries=False)
+    response = metrics.run_in(trace, read_snapshot(view))(Request(environ), **kwargs)
+    assert response.status == 20, response.meta
+    return trace.queries
+
+
+def test_query_counts_dont_grow_with_the_data(site):
+    author, reader = site
+    index = views.optional_authenticated_route(views.index_view)
+    post = views.optional_authenticated_route(views.post_view)
+    notifications = views.authenticated_route(views.notifications_view)
+
+    def count_all(post_id):
+        return {
+            '/': queries(index, '/'),
+            '/ signed in': queries(index, '/', FINGERPRINT),
+            '/archive': queries(views.archive_view, '/archive'),
+            '/post': queries(post, f'/post/{post_id}', post_id=str(post_id)),
+            '/podcast': queries(views.podcast_view, f'/podcast/{FEED_ID}', feed_id=str(FEED_ID)),
+            '/notifications': queries(notifications, '/notifications', FINGERPRINT),
+        }
+
+    first = seed(author, reader, 1)
+    few = count_all(first.id)
+    seed(author, reader, 49)
+    many = count_all(first.id)
+    assert many == few
+
+
+def test_tagging_all_commenters_takes_a_handful_of_statements(site):
+    author, reader = site
+    post = seed(author, reader, 1)
+    now = datetime.now()
+    commenters = [User.register(f'commenter{i}') for i in range(300)]
+    for commenter in commenters:
+        Comment.create(author=commenter, post=post, content='Me too', created=now, **Comment.formatting('Me too'))
+    before = {user.id: user.notification_count for user in User.select()}
+
+    trace = Trace('test', 'comment', time.perf_counter(), keep_queries=False)
+    metrics.run_in(trace, views.create_comment)(reader, post, 'Thanks @all')
+    assert trace.queries < 20
+
+    counts = {user.id: user.notification_count for user in User.select()}
+    assert all(counts[commenter.id] == before[commenter.id] + 1 for commenter in commenters)
+    assert counts[author.id] == before[author.id] + 1
@@ -0,0 +1,35 @@
+from jetforce import Request
+from rocketcaster import views
+
+
+def request(path):
+    url = f'gemini://localhost{path}'
+    return Request({'GEMINI_URL': url, 'HOSTNAME': 'localhost', 'SERVER_PORT': 1965,
+                    'REMOTE_ADDR': '127.0.0.1', 'QUERY_STRING': ''})
+
+
+def test_cursors_round_trip():
+    class Row:
+        created = views.datetime(2024, 5, 6, 7, 8, 9, 123456)
+        id = 42
+
+    assert views.parse_cursor(views.page_cursor(Row)) == (Row.created, 42)
+
+
+def test_archive_rejects_a_cursor_that_isnt_a_time():
+    path = '/archive/older/99999999999999999999-1'
+    response = views.archive_page_view(request(path), direction='older', cursor='99999999999999999999-1')
+    assert (response.status, response.meta) == (59, 'Invalid cursor')
+
+
+def test_notifications_reject_a_cursor_that_isnt_a_time():
+    path = '/notifications/older/20241399000000000000-7'
+    response = views.notifications_page_view(request(path), cursor='20241399000000000000-7')
+    assert (response.status, response.meta) == (59, 'Invalid cursor')
+
+
+def test_rendered_values_cant_fake_personalization_markers():
+    template = views.template_env.from_string('{{ content }}\n{{ owner_only(7) }}=> /delete\n{{ user_block }}\nEnd')
+    body = template.render(content='\x00owner:1\x00=> /forged\n\x00user\x00')
+    assert body == 'owner:1=> /forged\nuser\n\x00owner:7\x00=> /delete\n\x00user\x00\nEnd'
+    assert views.personalize(body, None, 'Signed out\n') == 'owner:1=> /forged\nuser\nSigned out\nEnd'
@@ -0,0 +1,49 @@
+import pytest
+from twisted.internet.defer import Deferred
+from bench.stub import StubUpstream
+from rocketcaster import transport
+from rocketcaster.limits import StreamLimiter
+from rocketcaster.proxy import EpisodeStream
+from rocketcaster.transport import Transport, TransportBusy
+from rocketcaster.workers import WorkerPool
+
+
+@pytest.fixture
+def upstream():
+    stub = StubUpstream(latency=0, enclosure_latency=0).start()
+    previous = transport.get_transport()
+    transport.set_transport(Transport(connect_timeout=0.5, max_connections=1))
+    yield stub
+    transport.set_transport(previous)
+    stub.stop()
+
+
+def test_responses_that_arrive_too_late_are_closed(upstream):
+    url = f'{upstream.url}/enclosures/1.mp3'
+    limiter = StreamLimiter(max_streams=1)
+    for _ in range(3):
+        # the request times out (or the client leaves) while the handler runs
+        result = Deferred()
+        result.addErrback(lambda failure: None)
+        result.cancel()
+        stream = limiter.open('client')
+        response = EpisodeStream(url, 1024 * 1024 * 8).open()
+        episode = response.body
+        response.body = limiter.limit(stream, response.body)
+        WorkerPool.settle(response, result)
+        assert episode.finished
+    # and the transport's and limiter's only slots are free again
+    assert not limiter.streams
+    transport.get_transport().get(url).close()
+
+
+def test_responses_in_time_are_passed_on(upstream):
+    url = f'{upstream.url}/enclosures/1.mp3'
+    result = Deferred()
+    response = EpisodeStream(url, 1024 * 1024 * 8).open()
+    WorkerPool.settle(response, result)
+    assert result.result is response
+    assert not response.body.finished
+    with pytest.raises(TransportBusy):
+        transport.get_transport().get(url)
+    response.body.close()